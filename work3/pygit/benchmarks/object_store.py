@@ -0,0 +1,69 @@
+"""Benchmark pygit's loose and SQLite object stores.
+
+Writes a number of small blobs to a fresh repo of each kind, reads them all
+back, and reports throughput and disk usage. Run from anywhere:
+
+    python benchmarks/object_store.py [num_objects]
+"""
+
+import os, shutil, sys, tempfile, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+import pygit
+
+
+def disk_usage(path):
+    """Return total size in bytes of the files under path."""
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            total += os.lstat(os.path.join(root, name)).st_blocks * 512
+    return total
+
+
+def benchmark(object_store, num_objects):
+    """Write then read num_objects small blobs in a new repo using given
+    object store, return tuple of (write_rate, read_rate, disk_bytes).
+    """
+    temp_dir = tempfile.mkdtemp()
+    original_cwd = os.getcwd()
+    try:
+        os.chdir(temp_dir)
+        pygit.init('repo', object_store=object_store)
+        repo = pygit.get_repository('repo')
+        blobs = ['blob {}\n'.format(i).encode() for i in range(num_objects)]
+
+        start = time.perf_counter()
+        with repo.object_store.transaction():
+            sha1s = [repo.hash_object(data, 'blob') for data in blobs]
+        write_time = time.perf_counter() - start
+
+        pygit.reset_repositories()
+        repo = pygit.get_repository('repo')
+        start = time.perf_counter()
+        for sha1 in sha1s:
+            repo.read_object(sha1)
+        read_time = time.perf_counter() - start
+
+        disk_bytes = disk_usage(os.path.join('repo', '.git'))
+        repo.object_store.close()
+    finally:
+        os.chdir(original_cwd)
+        shutil.rmtree(temp_dir)
+    return (num_objects / write_time, num_objects / read_time, disk_bytes)
+
+
+def main():
+    num_objects = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    print('{} small blobs'.format(num_objects))
+    for object_store in ('loose', 'sqlite'):
+        write_rate, read_rate, disk_bytes = benchmark(object_store,
+                                                      num_objects)
+        print('{:6}: write {:5.1f}k obj/s, read {:5.1f}k obj/s, '
+              '{:.1f} MB on disk'.format(object_store, write_rate / 1000,
+                                         read_rate / 1000, disk_bytes / 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+"""Benchmark pygit's CLI startup: the time spent importing modules for each
+subcommand, measured with "python -X importtime" (not counting modules the
+interpreter imports for every script). Each command is run several times
+and the best run is checked against its budget; the exit status is 1 if
+any command is over budget. Timings depend on the machine and its load, so
+this isn't part of the test suite. Run from anywhere:
+
+    python benchmarks/startup.py [runs]
+"""
+
+import os, shutil, subprocess, sys, tempfile
+
+PYGIT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(
+        __file__))), 'pygit.py')
+
+# Import time budget of each subcommand in milliseconds
+BUDGETS = {
+    'hash-object': 40,
+    'ls-files': 40,
+    'status': 40,
+    'add': 40,
+    'cat-file': 40,
+    'diff': 60,
+    'log': 40,
+    'blame': 60,
+    'checkout': 60,
+    'grep': 60,
+    'branch': 40,
+    'rev-list': 40,
+    'merge-base': 40,
+    'push': 100,
+    'fsck': 100,
+    'archive': 80,
+}
+
+
+def import_times(args, check=True):
+    """Run python -X importtime with given arguments, return dict mapping
+    module name to its own import time in microseconds. If check is False,
+    a non-zero exit status is ignored.
+    """
+    result = subprocess.run([sys.executable, '-X', 'importtime'] + args,
+                            stdout=subprocess.DEVNULL,
+                            stderr=subprocess.PIPE, check=check)
+    times = {}
+    for line in result.stderr.decode().splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, _, name = line[12:].split('|')
+        times[name.strip()] = int(self_us)
+    return times
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    temp_dir = tempfile.mkdtemp()
+    original_cwd = os.getcwd()
+    over_budget = False
+    try:
+        os.chdir(temp_dir)
+        subprocess.run([sys.executable, PYGIT, 'init', 'repo'],
+                       stdout=subprocess.DEVNULL, check=True)
+        os.chdir('repo')
+        with open('a.txt', 'wb') as f:
+            f.write(b'a\n')
+        sha1 = subprocess.run(
+                [sys.executable, PYGIT, 'hash-object', '-w', 'a.txt'],
+                stdout=subprocess.PIPE, check=True).stdout.decode().strip()
+        subprocess.run([sys.executable, PYGIT, 'add', 'a.txt'], check=True)
+        subprocess.run([sys.executable, PYGIT, 'commit', '-m', 'first',
+                        '-a', 'A U Thor <author@example.com>'],
+                       stdout=subprocess.DEVNULL, check=True)
+        commands = {
+            'hash-object': ['hash-object', 'a.txt'],
+            'ls-files': ['ls-files'],
+            'status': ['status'],
+            'add': ['add', 'a.txt'],
+            'cat-file': ['cat-file', 'blob', sha1],
+            'diff': ['diff'],
+            'log': ['log'],
+            'blame': ['blame', 'a.txt'],
+            'checkout': ['checkout', 'master'],
+            'grep': ['grep', 'a'],
+            'branch': ['branch'],
+            'rev-list': ['rev-list', '--count', 'master'],
+            'merge-base': ['merge-base', 'master', 'HEAD'],
+            # Nothing listens on the discard port, so this fails after
+            # importing what a push needs
+            'push': ['push', '-u', 'user', '-p', 'password',
+                     'http://127.0.0.1:9/repo.git'],
+            'fsck': ['fsck', '-j', '1'],
+            'archive': ['archive', 'HEAD'],
+        }
+        baseline = set(import_times(['-c', 'pass']))
+        for command, args in commands.items():
+            import_ms = min(sum(t for name, t in import_times(
+                                    [PYGIT] + args,
+                                    check=command != 'push').items()
+                                if name not in baseline)
+                            for _ in range(runs)) / 1000
+            ok = import_ms <= BUDGETS[command]
+            over_budget = over_budget or not ok
+            print('{:12} {:5.1f} ms (budget {} ms){}'.format(
+                    command, import_ms, BUDGETS[command],
+                    '' if ok else '  OVER BUDGET'))
+    finally:
+        os.chdir(original_cwd)
+        shutil.rmtree(temp_dir)
+    sys.exit(1 if over_budget else 0)
+
+
+if __name__ == '__main__':
+    main()
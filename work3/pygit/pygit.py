@@ -5,8 +5,12 @@ Read the story here: http://benhoyt.com/writings/pygit/
 Released under a permissive MIT license (see LICENSE.txt).
 """
 
-import argparse, collections, difflib, enum, hashlib, operator, os, stat
-import struct, sys, time, urllib.request, zlib
+# Modules that class and module-level definitions need, plus small ones
+# used on hot paths (array, bisect, heapq), are imported here; slower ones
+# (argparse, concurrent.futures, difflib, sqlite3, tarfile, urllib.request)
+# are imported by the functions that use them, to keep startup fast
+import abc, array, bisect, collections, contextlib, enum, hashlib, heapq
+import io, operator, os, re, stat, struct, sys, threading, time, zlib
 
 
 # Data for one entry in the git index (.git/index)
@@ -15,6 +19,97 @@ IndexEntry = collections.namedtuple('IndexEntry', [
     'gid', 'size', 'sha1', 'flags', 'path',
 ])
 
+# Fixed-size fields at the start of each index entry (all but the path)
+INDEX_ENTRY_STRUCT = struct.Struct('!LLLLLLLLLL20sH')
+
+# Fixed-size record of an entry in a CompactIndex: the on-disk fields
+# followed by the extended flags (zero if there are none)
+COMPACT_ENTRY_STRUCT = struct.Struct('!LLLLLLLLLL20sHH')
+
+# Trailer written in place of the index checksum when index.skipHash is
+# set; an index ending in it isn't verified, whatever the config says now
+NULL_SHA1 = b'\x00' * 20
+
+# Extended flags of an index entry (index version 3) are kept in the high 16
+# bits of IndexEntry.flags; on disk INDEX_EXTENDED in the low 16 bits marks an
+# entry that has them. Sparse-directory entries and files outside the
+# sparse-checkout cone have INDEX_SKIP_WORKTREE set
+INDEX_EXTENDED = 0x4000
+INDEX_SKIP_WORKTREE = 0x4000 << 16
+
+
+# Parsed .git/packed-refs: stat_key identifies the file version it was read
+# from, names is the sorted list of ref names, by_name maps name to SHA-1
+PackedRefs = collections.namedtuple('PackedRefs', [
+    'stat_key', 'names', 'by_name',
+])
+
+# Changed-path Bloom filters read from .git/objects/info/changed-paths:
+# filters maps commit SHA-1 to filter bytes
+ChangedPaths = collections.namedtuple('ChangedPaths', ['stat_key', 'filters'])
+
+# Reachability bitmaps read from .git/objects/info/bitmaps: names is a tuple
+# of object SHA-1s by bit position, positions maps SHA-1 to bit position,
+# and bitmaps maps commit SHA-1 to its zlib-compressed little-endian bitset
+BitmapIndex = collections.namedtuple('BitmapIndex', [
+    'stat_key', 'names', 'positions', 'bitmaps',
+])
+
+# Repository.read_object() keeps up to OBJECT_CACHE_SIZE objects of at most
+# OBJECT_CACHE_MAX_BYTES each in memory
+OBJECT_CACHE_SIZE = 4096
+OBJECT_CACHE_MAX_BYTES = 65536
+
+# get_repository() keeps handles (and their caches) for this many repos
+REPOSITORY_CACHE_SIZE = 16
+
+# Name of the object database under .git used instead of loose objects when
+# it exists (see SqliteObjectStore)
+SQLITE_OBJECTS_FILE = 'objects.sqlite'
+
+# Parsed pack .idx or multi-pack-index file: pack_names lists the .idx name
+# of each pack covered, fanout is the 256-entry table of cumulative counts
+# by first byte, sha1s the sorted SHA1Table, and pack_ids (None for a single
+# pack's .idx) and offsets are uint32 arrays giving each object's location;
+# an offset with the high bit set indexes the large_offsets table instead
+PackIndex = collections.namedtuple('PackIndex', [
+    'pack_names', 'fanout', 'sha1s', 'pack_ids', 'offsets', 'large_offsets',
+])
+
+# objects/info/alternates files are followed this many levels deep
+ALTERNATES_MAX_DEPTH = 5
+
+# Name of the multi-pack-index file in objects/pack
+MULTI_PACK_INDEX_FILE = 'multi-pack-index'
+
+# Pack entry types for deltas against another object (other entry types are
+# ObjectType values)
+PACK_OFS_DELTA = 6
+PACK_REF_DELTA = 7
+
+# Number of objects checked per task sent to an fsck worker process
+FSCK_BATCH_SIZE = 256
+
+# A replaced .git/sharedindex.<sha1> is only removed once it hasn't been
+# written or used for this many seconds (git's splitIndex.sharedIndexExpire
+# default of two weeks), as other index files may still link to it
+SHARED_INDEX_EXPIRE = 14 * 24 * 60 * 60
+
+
+# Rename detection compares MinHash signatures of RENAME_NUM_HASHES values in
+# bands of RENAME_BAND_SIZE; files sharing any band are scored as candidates
+# (every pair is scored if there are at most RENAME_ALL_PAIRS_LIMIT pairs).
+# MINHASH_SEEDS holds a fixed (salt, odd multiplier) pair per hash function
+RENAME_NUM_HASHES = 16
+RENAME_BAND_SIZE = 2
+RENAME_ALL_PAIRS_LIMIT = 100
+MINHASH_SEEDS = [
+    (int.from_bytes(digest[:8], 'big'),
+     int.from_bytes(digest[8:16], 'big') | 1)
+    for digest in (hashlib.sha1(b'minhash %d' % i).digest()
+                   for i in range(RENAME_NUM_HASHES))
+]
+
 
 class ObjectType(enum.Enum):
     """Object type enum. There are other types too, but we don't need them.
@@ -23,6 +118,7 @@ class ObjectType(enum.Enum):
     commit = 1
     tree = 2
     blob = 3
+    tag = 4
 
 
 def read_file(path):
@@ -37,296 +133,3414 @@ def write_file(path, data):
         f.write(data)
 
 
-def init(repo):
-    """Create directory for repo and initialize .git directory."""
+def init(repo, object_store='loose'):
+    """Create directory for repo and initialize .git directory. If
+    object_store is 'sqlite', objects are stored in a SQLite database
+    instead of loose files.
+    """
+    if object_store not in ('loose', 'sqlite'):
+        raise ValueError('unknown object store {!r}'.format(object_store))
     os.mkdir(repo)
     os.mkdir(os.path.join(repo, '.git'))
     for name in ['objects', 'refs', 'refs/heads']:
         os.mkdir(os.path.join(repo, '.git', name))
     write_file(os.path.join(repo, '.git', 'HEAD'), b'ref: refs/heads/master')
+    if object_store == 'sqlite':
+        store = SqliteObjectStore(os.path.join(repo, '.git',
+                                               SQLITE_OBJECTS_FILE))
+        store.create()
+        store.close()
     print('initialized empty repository: {}'.format(repo))
 
 
-def hash_object(data, obj_type, write=True):
-    """Compute hash of object data of given type and write to object store if
-    "write" is True. Return SHA-1 object hash as hex string.
+def clone(source, repo, shared=False):
+    """Clone the local repo with working tree at source into new directory
+    repo and check out the branch HEAD points to, return its commit SHA-1
+    (None if source has no commits). With "shared", no objects are copied:
+    the clone's objects/info/alternates points at the source's object
+    directory, so cloning takes almost no time or disk (but objects must
+    then never be deleted from the source). Otherwise object files are
+    hard-linked where possible, else copied, and the source's own
+    alternates are kept with relative paths made absolute. All refs are
+    written to the clone's packed-refs.
     """
-    header = '{} {}'.format(obj_type, len(data)).encode()
-    full_data = header + b'\x00' + data
-    sha1 = hashlib.sha1(full_data).hexdigest()
-    if write:
-        path = os.path.join('.git', 'objects', sha1[:2], sha1[2:])
-        if not os.path.exists(path):
-            os.makedirs(os.path.dirname(path), exist_ok=True)
-            write_file(path, zlib.compress(full_data))
-    return sha1
+    import shutil
+    source_repo = get_repository(source)
+    if not os.path.isdir(source_repo.git_dir):
+        raise ValueError('{!r} is not a git repository'.format(source))
+    init(repo)
+    target_repo = get_repository(repo)
+    source_objects = source_repo.git_path('objects')
+    if shared:
+        os.makedirs(target_repo.git_path('objects', 'info'), exist_ok=True)
+        write_file(target_repo.git_path('objects', 'info', 'alternates'),
+                   (source_objects + '\n').encode())
+    else:
+        alternates_path = os.path.join(source_objects, 'info', 'alternates')
+        for root, dirs, files in os.walk(source_objects):
+            target_dir = os.path.join(target_repo.git_path('objects'),
+                                      os.path.relpath(root, source_objects))
+            os.makedirs(target_dir, exist_ok=True)
+            for name in files:
+                if os.path.join(root, name) == alternates_path:
+                    continue
+                try:
+                    os.link(os.path.join(root, name),
+                            os.path.join(target_dir, name))
+                except OSError:
+                    shutil.copy2(os.path.join(root, name), target_dir)
+        if os.path.exists(alternates_path):
+            lines = []
+            for line in read_file(alternates_path).decode().splitlines():
+                if line.strip() and not line.strip().startswith('#'):
+                    line = os.path.normpath(os.path.join(source_objects,
+                                                         line.strip()))
+                lines.append(line + '\n')
+            write_file(target_repo.git_path('objects', 'info', 'alternates'),
+                       ''.join(lines).encode())
+        if isinstance(source_repo.object_store, SqliteObjectStore):
+            import sqlite3
+            with contextlib.closing(sqlite3.connect(target_repo.git_path(
+                    SQLITE_OBJECTS_FILE))) as conn:
+                source_repo.object_store.connection.backup(conn)
+    target_repo.write_packed_refs(dict(source_repo.list_refs()))
+    branch = source_repo.read_head()
+    if branch is not None:
+        target_repo.write_head(branch)
+        commit_sha1 = target_repo.read_ref(branch)
+    else:
+        commit_sha1 = read_file(source_repo.git_path('HEAD')).decode()[:40]
+        write_file(target_repo.git_path('HEAD'), commit_sha1.encode())
+    if commit_sha1 is not None:
+        checkout(branch or commit_sha1, target_repo)
+    return commit_sha1
 
 
-def find_object(sha1_prefix):
-    """Find object with given SHA-1 prefix and return path to object in object
-    store, or raise ValueError if there are no objects or multiple objects
-    with this prefix.
+class CompactIndex:
+    """Read-only sequence of IndexEntry objects stored compactly: the fixed
+    fields of each entry as a COMPACT_ENTRY_STRUCT record in one bytearray,
+    and the paths UTF-8 encoded back to back in another, with an array of
+    offsets. That's 68 bytes per entry plus its path, rather than a few
+    hundred for an IndexEntry tuple. Entries are made on access, so
+    iteration gives the same tuples in the same order as a list would;
+    find() looks up a path by binary search if the entries are sorted by
+    path (as they are in any index git or pygit writes).
     """
-    if len(sha1_prefix) < 2:
-        raise ValueError('hash prefix must be 2 or more characters')
-    obj_dir = os.path.join('.git', 'objects', sha1_prefix[:2])
-    rest = sha1_prefix[2:]
-    objects = [name for name in os.listdir(obj_dir) if name.startswith(rest)]
-    if not objects:
-        raise ValueError('object {!r} not found'.format(sha1_prefix))
-    if len(objects) >= 2:
-        raise ValueError('multiple objects ({}) with prefix {!r}'.format(
-                len(objects), sha1_prefix))
-    return os.path.join(obj_dir, objects[0])
 
+    def __init__(self, entries=()):
+        self.records = bytearray()
+        self.paths = bytearray()
+        self.offsets = array.array('I', [0])
+        self.sorted = True
+        pack = COMPACT_ENTRY_STRUCT.pack
+        previous = b''
+        for entry in entries:
+            flags = entry.flags & 0xffff
+            extended = entry.flags >> 16
+            if extended:
+                flags |= INDEX_EXTENDED
+            self.records += pack(*entry[:11], flags, extended)
+            path = entry.path.encode()
+            self.paths += path
+            self.offsets.append(len(self.paths))
+            if path < previous:
+                self.sorted = False
+            previous = path
 
-def read_object(sha1_prefix):
-    """Read object with given SHA-1 prefix and return tuple of
-    (object_type, data_bytes), or raise ValueError if not found.
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('index entry out of range')
+        fields = COMPACT_ENTRY_STRUCT.unpack_from(
+                self.records, i * COMPACT_ENTRY_STRUCT.size)
+        return self.make_entry(fields, self.offsets[i], self.offsets[i + 1])
+
+    def __iter__(self):
+        offsets = self.offsets
+        records = COMPACT_ENTRY_STRUCT.iter_unpack(self.records)
+        for i, fields in enumerate(records):
+            yield self.make_entry(fields, offsets[i], offsets[i + 1])
+
+    def __eq__(self, other):
+        if isinstance(other, CompactIndex):
+            return (self.records == other.records and
+                    self.paths == other.paths and
+                    self.offsets == other.offsets)
+        return list(self) == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return '<CompactIndex of {} entries>'.format(len(self))
+
+    def make_entry(self, fields, path_start, path_end):
+        """Return IndexEntry for unpacked record fields and the offsets of
+        its path.
+        """
+        flags = (fields[11] & ~INDEX_EXTENDED) | (fields[12] << 16)
+        path = self.paths[path_start:path_end].decode()
+        return IndexEntry._make(fields[:11] + (flags, path))
+
+    def path(self, i):
+        """Return path of entry at position i."""
+        return self.paths[self.offsets[i]:self.offsets[i + 1]].decode()
+
+    def find(self, path):
+        """Return position of the first entry with given path, or None if
+        there isn't one.
+        """
+        key = path.encode()
+        paths = self.paths
+        offsets = self.offsets
+        if not self.sorted:
+            for i in range(len(self)):
+                if paths[offsets[i]:offsets[i + 1]] == key:
+                    return i
+            return None
+        low = 0
+        high = len(self)
+        while low < high:
+            mid = (low + high) // 2
+            if paths[offsets[mid]:offsets[mid + 1]] < key:
+                low = mid + 1
+            else:
+                high = mid
+        if low < len(self) and paths[offsets[low]:offsets[low + 1]] == key:
+            return low
+        return None
+
+    def get(self, path):
+        """Return IndexEntry of given path, or None if it's not in index."""
+        i = self.find(path)
+        return None if i is None else self[i]
+
+
+def parse_index_data(data):
+    """Parse index file data (version 2 or 3, checksum not verified), return
+    tuple of (entries, extensions), where entries is a CompactIndex and
+    extensions maps each extension's signature to its data. The fixed
+    fields of each entry are copied across without building an IndexEntry.
+    """
+    signature, version, num_entries = struct.unpack('!4sLL', data[:12])
+    assert signature == b'DIRC', \
+            'invalid index signature {}'.format(signature)
+    assert version in (2, 3), 'unknown index version {}'.format(version)
+    entries = CompactIndex()
+    records = entries.records
+    paths = entries.paths
+    offsets = entries.offsets
+    no_extended = bytes(2)
+    previous = b''
+    i = 12
+    for _ in range(num_entries):
+        flags, = struct.unpack_from('!H', data, i + 60)
+        path_start = i + 62
+        records += data[i:path_start]
+        if flags & INDEX_EXTENDED:
+            assert version >= 3, 'extended flags in version 2 index'
+            records += data[path_start:path_start + 2]
+            path_start += 2
+        else:
+            records += no_extended
+        name_length = flags & 0xfff
+        if name_length < 0xfff:
+            path_end = path_start + name_length
+        else:
+            path_end = data.index(b'\x00', path_start + 0xfff)
+        path = data[path_start:path_end]
+        paths += path
+        offsets.append(len(paths))
+        if path < previous:
+            entries.sorted = False
+        previous = path
+        i += (path_end - i + 8) & ~7
+    assert i <= len(data) - 20, 'truncated index'
+    extensions = {}
+    while i < len(data) - 20:
+        signature, size = struct.unpack_from('!4sL', data, i)
+        extensions[signature] = data[i + 8:i + 8 + size]
+        i += 8 + size
+    return (entries, extensions)
+
+
+def build_index_data(entries, extensions=()):
+    """Return index file data (without the trailing checksum) for list of
+    IndexEntry objects and list of (signature, data) extensions. Version 3
+    is used if any entry has extended flags.
+    """
+    packed_entries = []
+    pack = INDEX_ENTRY_STRUCT.pack
+    version = 2
+    for entry in entries:
+        flags = entry.flags & 0xffff
+        extended = entry.flags >> 16
+        if extended:
+            flags |= INDEX_EXTENDED
+            version = 3
+        entry_head = pack(
+                entry.ctime_s, entry.ctime_n, entry.mtime_s,
+                entry.mtime_n, entry.dev, entry.ino, entry.mode,
+                entry.uid, entry.gid, entry.size, entry.sha1, flags)
+        if extended:
+            entry_head += struct.pack('!H', extended)
+        path = entry.path.encode()
+        length = ((len(entry_head) + len(path) + 8) // 8) * 8
+        packed_entry = entry_head + path + \
+                b'\x00' * (length - len(entry_head) - len(path))
+        packed_entries.append(packed_entry)
+    header = struct.pack('!4sLL', b'DIRC', version, len(entries))
+    for signature, data in extensions:
+        packed_entries.append(signature + struct.pack('!L', len(data)) + data)
+    return header + b''.join(packed_entries)
+
+
+def encode_ewah(positions):
+    """Encode sorted list of bit positions as a git EWAH bitmap: runs of
+    empty 64-bit words are run-length encoded, other words stored as
+    literals.
+    """
+    words = [0] * ((positions[-1] // 64 + 1) if positions else 0)
+    for pos in positions:
+        words[pos // 64] |= 1 << (pos % 64)
+    buffer = []
+    rlw_pos = 0
+    i = 0
+    while True:
+        run = 0
+        while i < len(words) and words[i] == 0:
+            run += 1
+            i += 1
+        literals = []
+        while i < len(words) and words[i] != 0:
+            literals.append(words[i])
+            i += 1
+        rlw_pos = len(buffer)
+        buffer.append((run << 1) | (len(literals) << 33))
+        buffer.extend(literals)
+        if i >= len(words):
+            break
+    bit_size = positions[-1] + 1 if positions else 0
+    return (struct.pack('!LL', bit_size, len(buffer)) +
+            struct.pack('!{}Q'.format(len(buffer)), *buffer) +
+            struct.pack('!L', rlw_pos))
+
+
+def decode_ewah(data, offset=0):
+    """Decode git EWAH bitmap at given offset in data, return tuple of
+    (sorted list of set bit positions, offset just past the bitmap).
+    """
+    bit_size, num_words = struct.unpack_from('!LL', data, offset)
+    words = struct.unpack_from('!{}Q'.format(num_words), data, offset + 8)
+    positions = []
+    base = 0
+    i = 0
+    while i < num_words:
+        rlw = words[i]
+        run = (rlw >> 1) & 0xffffffff
+        num_literals = rlw >> 33
+        if rlw & 1:
+            positions.extend(range(base, base + run * 64))
+        base += run * 64
+        for word in words[i + 1:i + 1 + num_literals]:
+            while word:
+                low_bit = word & -word
+                positions.append(base + low_bit.bit_length() - 1)
+                word ^= low_bit
+            base += 64
+        i += 1 + num_literals
+    positions = [pos for pos in positions if pos < bit_size]
+    return (positions, offset + 8 + num_words * 8 + 4)
+
+
+def object_store_for(objects_dir):
+    """Return the ObjectStore for given objects directory: a
+    SqliteObjectStore if there's a SQLITE_OBJECTS_FILE beside it, otherwise
+    a LooseObjectStore.
+    """
+    path = os.path.join(os.path.dirname(objects_dir), SQLITE_OBJECTS_FILE)
+    if os.path.exists(path):
+        return SqliteObjectStore(path)
+    return LooseObjectStore(objects_dir)
+
+
+class ObjectStore(abc.ABC):
+    """Interface of an object store: a mapping of SHA-1 hex string to the
+    zlib-compressed object ("<type> <size>\\x00<data>") with that hash.
+    """
+
+    @abc.abstractmethod
+    def find(self, sha1_prefix):
+        """Return full SHA-1 of object with given SHA-1 prefix, or raise
+        ValueError if there are no objects or multiple objects with this
+        prefix.
+        """
+
+    @abc.abstractmethod
+    def contains(self, sha1):
+        """Return True if object with given full SHA-1 is in the store."""
+
+    @abc.abstractmethod
+    def open(self, sha1):
+        """Return readable binary file object over the compressed data of
+        object with given full SHA-1.
+        """
+
+    def read(self, sha1):
+        """Return compressed data of object with given full SHA-1."""
+        with self.open(sha1) as f:
+            return f.read()
+
+    @abc.abstractmethod
+    def write_raw(self, sha1, compressed):
+        """Store compressed data of object with given SHA-1 (which must not
+        already be in the store).
+        """
+
+    def write(self, sha1, full_data):
+        """Compress and store full object data with given SHA-1, unless the
+        store already has it.
+        """
+        if not self.contains(sha1):
+            self.write_raw(sha1, zlib.compress(full_data))
+
+    @abc.abstractmethod
+    def list(self):
+        """Return iterable of the SHA-1s of all objects in the store."""
+
+    def create(self):
+        """Create the store's files if they don't exist yet."""
+
+    def transaction(self):
+        """Return context manager that groups the writes made inside it
+        (a no-op for stores without transactions).
+        """
+        return contextlib.nullcontext()
+
+    def close(self):
+        """Release any resources held by the store."""
+
+
+class LooseObjectStore(ObjectStore):
+    """Git's loose object format: each object in its own file under
+    objects/xx/yyyy. Directory listings used for prefix lookups are cached
+    until the directory's mtime changes.
+    """
+
+    def __init__(self, objects_dir):
+        self.objects_dir = objects_dir
+        self._dirs = {}
+
+    def path(self, sha1):
+        """Return path of the file for object with given full SHA-1."""
+        return os.path.join(self.objects_dir, sha1[:2], sha1[2:])
+
+    def create(self):
+        os.makedirs(self.objects_dir, exist_ok=True)
+
+    def list_dir(self, obj_dir, refresh=False):
+        """Return list of file names in given loose object directory (empty
+        if it doesn't exist), cached until its mtime changes or "refresh" is
+        True.
+        """
+        try:
+            mtime_ns = os.stat(obj_dir).st_mtime_ns
+        except FileNotFoundError:
+            return []
+        cached = self._dirs.get(obj_dir)
+        if not refresh and cached is not None and cached[0] == mtime_ns:
+            return cached[1]
+        names = os.listdir(obj_dir)
+        self._dirs[obj_dir] = (mtime_ns, names)
+        return names
+
+    def find(self, sha1_prefix):
+        if len(sha1_prefix) < 2:
+            raise ValueError('hash prefix must be 2 or more characters')
+        if len(sha1_prefix) == 40 and self.contains(sha1_prefix):
+            return sha1_prefix
+        obj_dir = os.path.join(self.objects_dir, sha1_prefix[:2])
+        rest = sha1_prefix[2:]
+        objects = [name for name in self.list_dir(obj_dir)
+                   if name.startswith(rest)]
+        if not objects:
+            # Directory mtime granularity can hide a just-written object
+            objects = [name for name in self.list_dir(obj_dir, refresh=True)
+                       if name.startswith(rest)]
+        if not objects:
+            raise ValueError('object {!r} not found'.format(sha1_prefix))
+        if len(objects) >= 2:
+            raise ValueError('multiple objects ({}) with prefix {!r}'.format(
+                    len(objects), sha1_prefix))
+        return sha1_prefix[:2] + objects[0]
+
+    def contains(self, sha1):
+        return os.path.exists(self.path(sha1))
+
+    def open(self, sha1):
+        return open(self.path(sha1), 'rb')
+
+    def write_raw(self, sha1, compressed):
+        path = self.path(sha1)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        write_file(path, compressed)
+
+    def list(self):
+        for name in sorted(os.listdir(self.objects_dir)):
+            if len(name) != 2 or not re.match(r'[0-9a-f]{2}$', name):
+                continue
+            for rest in sorted(self.list_dir(
+                    os.path.join(self.objects_dir, name), refresh=True)):
+                if len(rest) == 38:
+                    yield name + rest
+
+
+class SqliteObjectStore(ObjectStore):
+    """Object store in a single SQLite database file in WAL mode, with
+    compressed objects keyed by 20-byte binary SHA-1. Each thread gets its
+    own connection so readers don't block each other.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+
+    @property
+    def connection(self):
+        """Return this thread's connection, opening it on first use."""
+        import sqlite3
+        conn = getattr(self._local, 'connection', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, isolation_level=None,
+                                   check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = conn
+            self._local.depth = 0
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+
+    def create(self):
+        self.connection.execute('CREATE TABLE IF NOT EXISTS objects '
+                                '(sha1 BLOB PRIMARY KEY, data BLOB NOT NULL)')
+
+    def find(self, sha1_prefix):
+        if len(sha1_prefix) < 2:
+            raise ValueError('hash prefix must be 2 or more characters')
+        if not re.match(r'[0-9a-f]+$', sha1_prefix) or len(sha1_prefix) > 40:
+            raise ValueError('object {!r} not found'.format(sha1_prefix))
+        low = bytes.fromhex(sha1_prefix.ljust(40, '0'))
+        high = bytes.fromhex(sha1_prefix.ljust(40, 'f'))
+        rows = self.connection.execute(
+                'SELECT sha1 FROM objects WHERE sha1 BETWEEN ? AND ? '
+                'LIMIT 2', (low, high)).fetchall()
+        if not rows:
+            raise ValueError('object {!r} not found'.format(sha1_prefix))
+        if len(rows) >= 2:
+            count, = self.connection.execute(
+                    'SELECT COUNT(*) FROM objects WHERE sha1 BETWEEN ? AND ?',
+                    (low, high)).fetchone()
+            raise ValueError('multiple objects ({}) with prefix {!r}'.format(
+                    count, sha1_prefix))
+        return rows[0][0].hex()
+
+    def contains(self, sha1):
+        return self.connection.execute(
+                'SELECT 1 FROM objects WHERE sha1 = ?',
+                (bytes.fromhex(sha1),)).fetchone() is not None
+
+    def open(self, sha1):
+        row = self.connection.execute(
+                'SELECT rowid FROM objects WHERE sha1 = ?',
+                (bytes.fromhex(sha1),)).fetchone()
+        if row is None:
+            raise ValueError('object {!r} not found'.format(sha1))
+        if hasattr(self.connection, 'blobopen'):
+            return self.connection.blobopen('objects', 'data', row[0],
+                                            readonly=True)
+        return io.BytesIO(self.read(sha1))
+
+    def read(self, sha1):
+        row = self.connection.execute(
+                'SELECT data FROM objects WHERE sha1 = ?',
+                (bytes.fromhex(sha1),)).fetchone()
+        if row is None:
+            raise ValueError('object {!r} not found'.format(sha1))
+        return row[0]
+
+    def write_raw(self, sha1, compressed):
+        self.connection.execute(
+                'INSERT OR IGNORE INTO objects (sha1, data) VALUES (?, ?)',
+                (bytes.fromhex(sha1), compressed))
+
+    def list(self):
+        for sha1, in self.connection.execute(
+                'SELECT sha1 FROM objects ORDER BY sha1'):
+            yield sha1.hex()
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """Group writes made inside the context into one transaction
+        (nested uses join the outermost one).
+        """
+        conn = self.connection
+        if self._local.depth == 0:
+            conn.execute('BEGIN IMMEDIATE')
+        self._local.depth += 1
+        try:
+            yield
+        except BaseException:
+            self._local.depth -= 1
+            if self._local.depth == 0:
+                conn.execute('ROLLBACK')
+            raise
+        self._local.depth -= 1
+        if self._local.depth == 0:
+            conn.execute('COMMIT')
+
+    def close(self):
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections = []
+        self._local = threading.local()
+
+
+def read_pack_index(path):
+    """Read pack index (.idx version 2) file at given path, return PackIndex.
+    Offsets with the high bit set index into the large offset table.
+    """
+    data = read_file(path)
+    signature, version = struct.unpack('!4sL', data[:8])
+    assert signature == b'\xfftOc', \
+            'invalid pack index signature {}'.format(signature)
+    assert version == 2, 'unknown pack index version {}'.format(version)
+    fanout = struct.unpack_from('!256L', data, 8)
+    num_objects = fanout[255]
+    sha1s_start = 8 + 256 * 4
+    offsets_start = sha1s_start + num_objects * 24
+    large_start = offsets_start + num_objects * 4
+    return PackIndex([os.path.basename(path)], fanout,
+                     SHA1Table(data, sha1s_start, num_objects), None,
+                     read_uint32_array(data, offsets_start, num_objects),
+                     data[large_start:len(data) - 40])
+
+
+def read_multi_pack_index(path):
+    """Read git multi-pack-index file at given path, return PackIndex."""
+    data = read_file(path)
+    assert hashlib.sha1(data[:-20]).digest() == data[-20:], \
+            'invalid multi-pack-index checksum'
+    signature, version, hash_version, num_chunks, _, num_packs = \
+            struct.unpack('!4sBBBBL', data[:12])
+    assert signature == b'MIDX', \
+            'invalid multi-pack-index signature {}'.format(signature)
+    assert version == 1 and hash_version == 1, \
+            'unknown multi-pack-index version {}'.format(version)
+    chunks = {}
+    for i in range(num_chunks):
+        chunk_id, start = struct.unpack_from('!4sQ', data, 12 + i * 12)
+        end, = struct.unpack_from('!Q', data, 12 + i * 12 + 16)
+        chunks[chunk_id] = (start, end)
+    for chunk_id in (b'PNAM', b'OIDF', b'OIDL', b'OOFF'):
+        assert chunk_id in chunks, \
+                'multi-pack-index has no {} chunk'.format(chunk_id.decode())
+    start, end = chunks[b'PNAM']
+    pack_names = data[start:end].rstrip(b'\x00').decode().split('\x00')
+    assert len(pack_names) == num_packs, 'invalid multi-pack-index pack names'
+    fanout = struct.unpack_from('!256L', data, chunks[b'OIDF'][0])
+    num_objects = fanout[255]
+    locations = read_uint32_array(data, chunks[b'OOFF'][0], num_objects * 2)
+    start, end = chunks.get(b'LOFF', (0, 0))
+    return PackIndex(pack_names, fanout,
+                     SHA1Table(data, chunks[b'OIDL'][0], num_objects),
+                     locations[0::2], locations[1::2], data[start:end])
+
+
+def read_uint32_array(data, start, count):
+    """Return array of count big-endian unsigned 32-bit ints at start of
+    data.
+    """
+    values = array.array('I', data[start:start + count * 4])
+    assert values.itemsize == 4, 'array type "I" is not 32 bits'
+    if sys.byteorder == 'little':
+        values.byteswap()
+    return values
+
+
+def pack_index_location(index, i):
+    """Return tuple of (pack_name, offset) for position i in PackIndex."""
+    pack_id = index.pack_ids[i] if index.pack_ids is not None else 0
+    offset = index.offsets[i]
+    if offset & 0x80000000:
+        offset, = struct.unpack_from('!Q', index.large_offsets,
+                                     (offset & 0x7fffffff) * 8)
+    return (index.pack_names[pack_id][:-4] + '.pack', offset)
+
+
+def find_in_pack_index(index, sha1_prefix):
+    """Return list of positions in PackIndex of (up to two) objects with
+    given SHA-1 hex prefix: one bisect within the prefix's fanout bucket.
     """
-    path = find_object(sha1_prefix)
-    full_data = zlib.decompress(read_file(path))
-    nul_index = full_data.index(b'\x00')
-    header = full_data[:nul_index]
-    obj_type, size_str = header.decode().split()
-    size = int(size_str)
-    data = full_data[nul_index + 1:]
-    assert size == len(data), 'expected size {}, got {} bytes'.format(
+    low = bytes.fromhex(sha1_prefix.ljust(40, '0'))
+    high = bytes.fromhex(sha1_prefix.ljust(40, 'f'))
+    first = low[0]
+    i = bisect.bisect_left(index.sha1s, low,
+                           index.fanout[first - 1] if first else 0,
+                           index.fanout[first])
+    return [j for j in range(i, min(i + 2, len(index.sha1s)))
+            if index.sha1s[j] <= high]
+
+
+def read_pack_entry_header(f, offset):
+    """Read header of entry at given offset in open pack file f. Return
+    tuple of (type_num, size, base, data_offset): size is the inflated size
+    of the entry's data, base is the base object's offset for a
+    PACK_OFS_DELTA or SHA-1 for a PACK_REF_DELTA (else None), and
+    data_offset is where the entry's zlib data starts.
+    """
+    f.seek(offset)
+    header = f.read(32)
+    byte = header[0]
+    type_num = (byte >> 4) & 7
+    size = byte & 0x0f
+    shift = 4
+    i = 1
+    while byte & 0x80:
+        byte = header[i]
+        i += 1
+        size |= (byte & 0x7f) << shift
+        shift += 7
+    base = None
+    if type_num == PACK_OFS_DELTA:
+        byte = header[i]
+        i += 1
+        delta_offset = byte & 0x7f
+        while byte & 0x80:
+            byte = header[i]
+            i += 1
+            delta_offset = ((delta_offset + 1) << 7) | (byte & 0x7f)
+        base = offset - delta_offset
+    elif type_num == PACK_REF_DELTA:
+        base = header[i:i + 20].hex()
+        i += 20
+    return (type_num, size, base, offset + i)
+
+
+def read_pack_entry(f, offset):
+    """Read entry at given offset in open pack file f. Return tuple of
+    (type_num, data, base, end): data is inflated, base is as returned by
+    read_pack_entry_header, and end is the offset just past the entry.
+    """
+    type_num, size, base, data_offset = read_pack_entry_header(f, offset)
+    f.seek(data_offset)
+    decompressor = zlib.decompressobj()
+    chunk = f.read(256)
+    num_read = data_offset + len(chunk)
+    parts = []
+    while True:
+        parts.append(decompressor.decompress(chunk))
+        if decompressor.eof:
+            break
+        chunk = f.read(65536)
+        assert chunk, 'truncated pack entry at offset {}'.format(offset)
+        num_read += len(chunk)
+    data = b''.join(parts)
+    assert len(data) == size, 'expected size {}, got {} bytes'.format(
             size, len(data))
+    return (type_num, data, base, num_read - len(decompressor.unused_data))
+
+
+def read_pack_object(f, offset, read_base):
+    """Read object at given offset in open pack file f, applying any chain of
+    deltas, and return tuple of (object_type, data). read_base(sha1) must
+    return (object_type, data) of the base of a PACK_REF_DELTA.
+    """
+    deltas = []
+    while True:
+        type_num, data, base, _ = read_pack_entry(f, offset)
+        if type_num == PACK_OFS_DELTA:
+            deltas.append(data)
+            offset = base
+        elif type_num == PACK_REF_DELTA:
+            deltas.append(data)
+            obj_type, data = read_base(base)
+            break
+        else:
+            obj_type = ObjectType(type_num).name
+            break
+    for delta in reversed(deltas):
+        data = apply_delta(data, delta)
     return (obj_type, data)
 
 
-def cat_file(mode, sha1_prefix):
-    """Write the contents of (or info about) object with given SHA-1 prefix to
-    stdout. If mode is 'commit', 'tree', or 'blob', print raw data bytes of
-    object. If mode is 'size', print the size of the object. If mode is
-    'type', print the type of the object. If mode is 'pretty', print a
-    prettified version of the object.
+def read_delta_size(delta, i):
+    """Decode a size varint at offset i in delta, return (size, next i)."""
+    size = 0
+    shift = 0
+    while True:
+        byte = delta[i]
+        i += 1
+        size |= (byte & 0x7f) << shift
+        shift += 7
+        if not byte & 0x80:
+            return (size, i)
+
+
+def apply_delta(base, delta):
+    """Apply git delta (copy-from-base and insert instructions) to base data,
+    return the resulting data.
     """
-    obj_type, data = read_object(sha1_prefix)
-    if mode in ['commit', 'tree', 'blob']:
-        if obj_type != mode:
-            raise ValueError('expected object type {}, got {}'.format(
-                    mode, obj_type))
-        sys.stdout.buffer.write(data)
-    elif mode == 'size':
-        print(len(data))
-    elif mode == 'type':
-        print(obj_type)
-    elif mode == 'pretty':
-        if obj_type in ['commit', 'blob']:
-            sys.stdout.buffer.write(data)
-        elif obj_type == 'tree':
-            for mode, path, sha1 in read_tree(data=data):
-                type_str = 'tree' if stat.S_ISDIR(mode) else 'blob'
-                print('{:06o} {} {}\t{}'.format(mode, type_str, sha1, path))
+    base_size, i = read_delta_size(delta, 0)
+    assert base_size == len(base), 'delta expects base of {} bytes, got ' \
+            '{}'.format(base_size, len(base))
+    result_size, i = read_delta_size(delta, i)
+    parts = []
+    while i < len(delta):
+        op = delta[i]
+        i += 1
+        if op & 0x80:
+            offset = size = 0
+            for bit in range(4):
+                if op & (1 << bit):
+                    offset |= delta[i] << (bit * 8)
+                    i += 1
+            for bit in range(3):
+                if op & (0x10 << bit):
+                    size |= delta[i] << (bit * 8)
+                    i += 1
+            parts.append(base[offset:offset + (size or 0x10000)])
         else:
-            assert False, 'unhandled object type {!r}'.format(obj_type)
-    else:
-        raise ValueError('unexpected mode {!r}'.format(mode))
+            assert op, 'invalid delta instruction 0'
+            parts.append(delta[i:i + op])
+            i += op
+    result = b''.join(parts)
+    assert len(result) == result_size, 'expected delta result of {} ' \
+            'bytes, got {}'.format(result_size, len(result))
+    return result
 
 
-def read_index():
-    """Read git index file and return list of IndexEntry objects."""
+class SHA1Table:
+    """Read-only sequence of the 20-byte SHA-1s stored back to back in a
+    pack index or multi-pack-index, so bisect can search the file data
+    without building a list.
+    """
+
+    def __init__(self, data, start, count):
+        self.data = data
+        self.start = start
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        start = self.start + i * 20
+        return self.data[start:start + 20]
+
+
+class PackFile(io.RawIOBase):
+    """Binary file object with its own position over a pack file handle
+    that is shared between threads: each read seeks the shared handle and
+    reads while holding its lock. Closing it leaves the shared handle open.
+    """
+
+    def __init__(self, f, lock):
+        super().__init__()
+        self._f = f
+        self._lock = lock
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        self._pos = offset
+        return offset
+
+    def tell(self):
+        return self._pos
+
+    def readinto(self, buffer):
+        with self._lock:
+            self._f.seek(self._pos)
+            num_bytes = self._f.readinto(buffer)
+        self._pos += num_bytes
+        return num_bytes
+
+
+class PackStore:
+    """Objects in the pack files under objects/pack. If there's a
+    multi-pack-index, one bisect in it finds an object however many packs
+    it covers; packs added since it was written are probed through their
+    own .idx files. The parsed indexes are cached until the pack directory
+    changes, and one handle per .pack file stays open until it changes or
+    close() is called.
+    """
+
+    def __init__(self, objects_dir):
+        self.pack_dir = os.path.join(objects_dir, 'pack')
+        self._indexes = None
+        self._lock = threading.Lock()
+        self._files = {}
+
+    def indexes(self):
+        """Return list of PackIndex: the multi-pack-index (if any), then the
+        .idx of each pack it doesn't cover.
+        """
+        try:
+            st = os.stat(self.pack_dir)
+        except FileNotFoundError:
+            return []
+        stat_key = (st.st_ino, st.st_size, st.st_mtime_ns)
+        cached = self._indexes
+        if cached is not None and cached[0] == stat_key:
+            return cached[1]
+        names = set(os.listdir(self.pack_dir))
+        indexes = []
+        covered = set()
+        if MULTI_PACK_INDEX_FILE in names:
+            midx = read_multi_pack_index(os.path.join(
+                    self.pack_dir, MULTI_PACK_INDEX_FILE))
+            indexes.append(midx)
+            covered.update(midx.pack_names)
+        for name in sorted(names):
+            if (name.endswith('.idx') and name not in covered and
+                    name[:-4] + '.pack' in names):
+                indexes.append(read_pack_index(os.path.join(
+                        self.pack_dir, name)))
+        self._indexes = (stat_key, indexes)
+        return indexes
+
+    def locate(self, sha1):
+        """Return tuple of (pack_name, offset) of object with given full
+        SHA-1, or None if it isn't packed.
+        """
+        for index in self.indexes():
+            positions = find_in_pack_index(index, sha1)
+            if positions:
+                return pack_index_location(index, positions[0])
+        return None
+
+    def find(self, sha1_prefix):
+        """Return sorted list of full SHA-1s of (up to two) packed objects
+        with given SHA-1 prefix.
+        """
+        if not re.match(r'[0-9a-f]{2,40}$', sha1_prefix):
+            return []
+        found = set()
+        for index in self.indexes():
+            for i in find_in_pack_index(index, sha1_prefix):
+                found.add(index.sha1s[i].hex())
+        return sorted(found)[:2]
+
+    def contains(self, sha1):
+        return self.locate(sha1) is not None
+
+    def pack_file(self, pack_name):
+        """Return PackFile reading the pack with given name through its
+        shared handle, (re)opening the handle if there isn't one or the
+        file's stat data has changed since it was opened.
+        """
+        path = os.path.join(self.pack_dir, pack_name)
+        st = os.stat(path)
+        stat_key = (st.st_ino, st.st_size, st.st_mtime_ns)
+        with self._lock:
+            cached = self._files.get(pack_name)
+            if cached is None or cached[0] != stat_key:
+                if cached is not None:
+                    with cached[2]:
+                        cached[1].close()
+                cached = (stat_key, open(path, 'rb'), threading.Lock())
+                self._files[pack_name] = cached
+        return PackFile(cached[1], cached[2])
+
+    def close(self):
+        """Close the shared pack file handles (they're reopened as needed)."""
+        with self._lock:
+            for _, f, lock in self._files.values():
+                with lock:
+                    f.close()
+            self._files.clear()
+
+    def open(self, sha1):
+        """Return tuple of (f, object_type, size) for packed object with
+        given full SHA-1 that isn't stored as a delta, where f is a PackFile
+        positioned at the start of the object's zlib data. Return None if
+        it's a delta; raise ValueError if it isn't packed.
+        """
+        location = self.locate(sha1)
+        if location is None:
+            raise ValueError('object {!r} not found'.format(sha1))
+        pack_name, offset = location
+        f = self.pack_file(pack_name)
+        type_num, size, _, data_offset = read_pack_entry_header(f, offset)
+        if type_num in (PACK_OFS_DELTA, PACK_REF_DELTA):
+            return None
+        f.seek(data_offset)
+        return (f, ObjectType(type_num).name, size)
+
+    def read(self, sha1):
+        """Return tuple of (object_type, data) of packed object with given
+        full SHA-1, or raise ValueError if it isn't packed.
+        """
+        location = self.locate(sha1)
+        if location is None:
+            raise ValueError('object {!r} not found'.format(sha1))
+        pack_name, offset = location
+        return read_pack_object(self.pack_file(pack_name), offset, self.read)
+
+    def list(self):
+        """Return sorted list of SHA-1s of all packed objects."""
+        sha1s = set()
+        for index in self.indexes():
+            sha1s.update(index.sha1s[i].hex()
+                         for i in range(len(index.sha1s)))
+        return sorted(sha1s)
+
+
+def index_pack(pack_path, repo='.'):
+    """Write the version 2 .idx file for the pack at given path (which
+    should be objects/pack/pack-<sha1>.pack), return number of objects.
+    Bases of PACK_REF_DELTA entries are looked up in the pack itself, then
+    in the repo.
+    """
+    entries = []
+    offsets = {}
+    with open(pack_path, 'rb') as f:
+        signature, version, num_objects = struct.unpack('!4sLL', f.read(12))
+        assert signature == b'PACK', \
+                'invalid pack signature {}'.format(signature)
+        assert version in (2, 3), 'unknown pack version {}'.format(version)
+
+        def read_base(sha1):
+            if sha1 in offsets:
+                return read_pack_object(f, offsets[sha1], read_base)
+            return read_object(sha1, repo)
+
+        offset = 12
+        for _ in range(num_objects):
+            end = read_pack_entry(f, offset)[3]
+            obj_type, data = read_pack_object(f, offset, read_base)
+            header = '{} {}'.format(obj_type, len(data)).encode()
+            sha1 = hashlib.sha1(header + b'\x00' + data).hexdigest()
+            f.seek(offset)
+            entries.append((bytes.fromhex(sha1), zlib.crc32(
+                    f.read(end - offset)), offset))
+            offsets[sha1] = offset
+            offset = end
+        f.seek(offset)
+        pack_sha1 = f.read(20)
+    entries.sort()
+    fanout = [0] * 256
+    for sha1, _, _ in entries:
+        fanout[sha1[0]] += 1
+    for i in range(1, 256):
+        fanout[i] += fanout[i - 1]
+    large_offsets = []
+    packed_offsets = []
+    for _, _, offset in entries:
+        if offset >= 0x80000000:
+            packed_offsets.append(0x80000000 | len(large_offsets))
+            large_offsets.append(offset)
+        else:
+            packed_offsets.append(offset)
+    data = b''.join([
+        struct.pack('!4sL256L', b'\xfftOc', 2, *fanout),
+        b''.join(sha1 for sha1, _, _ in entries),
+        struct.pack('!{}L'.format(len(entries)), *(c for _, c, _ in entries)),
+        struct.pack('!{}L'.format(len(entries)), *packed_offsets),
+        struct.pack('!{}Q'.format(len(large_offsets)), *large_offsets),
+        pack_sha1,
+    ])
+    write_file(pack_path[:-5] + '.idx', data + hashlib.sha1(data).digest())
+    return len(entries)
+
+
+def write_multi_pack_index(repo='.'):
+    """Write objects/pack/multi-pack-index covering every pack, in git's
+    format. An object in several packs is taken from the newest one.
+    Return tuple of (num_packs, num_objects).
+    """
+    pack_dir = get_repository(repo).pack_store.pack_dir
+    names = sorted(name for name in os.listdir(pack_dir)
+                   if name.endswith('.idx') and
+                   os.path.exists(os.path.join(pack_dir, name[:-4] + '.pack')))
+    by_age = sorted(range(len(names)), key=lambda i: os.stat(os.path.join(
+            pack_dir, names[i][:-4] + '.pack')).st_mtime_ns)
+    objects = {}
+    for pack_id in by_age:
+        index = read_pack_index(os.path.join(pack_dir, names[pack_id]))
+        for i in range(len(index.sha1s)):
+            objects[index.sha1s[i]] = (pack_id,
+                                       pack_index_location(index, i)[1])
+    sha1s = sorted(objects)
+    fanout = [0] * 256
+    for sha1 in sha1s:
+        fanout[sha1[0]] += 1
+    for i in range(1, 256):
+        fanout[i] += fanout[i - 1]
+    locations = []
+    large_offsets = []
+    for sha1 in sha1s:
+        pack_id, offset = objects[sha1]
+        if offset >= 0x80000000:
+            offset = 0x80000000 | len(large_offsets)
+            large_offsets.append(objects[sha1][1])
+        locations.extend((pack_id, offset))
+    pack_names = b''.join(name.encode() + b'\x00' for name in names)
+    chunks = [
+        (b'PNAM', pack_names + b'\x00' * (-len(pack_names) % 4)),
+        (b'OIDF', struct.pack('!256L', *fanout)),
+        (b'OIDL', b''.join(sha1s)),
+        (b'OOFF', struct.pack('!{}L'.format(len(locations)), *locations)),
+    ]
+    if large_offsets:
+        chunks.append((b'LOFF', struct.pack(
+                '!{}Q'.format(len(large_offsets)), *large_offsets)))
+    header = struct.pack('!4sBBBBL', b'MIDX', 1, 1, len(chunks), 0,
+                         len(names))
+    offset = len(header) + (len(chunks) + 1) * 12
+    table = []
+    for chunk_id, chunk in chunks:
+        table.append(struct.pack('!4sQ', chunk_id, offset))
+        offset += len(chunk)
+    table.append(struct.pack('!4sQ', b'\x00' * 4, offset))
+    data = header + b''.join(table) + b''.join(c for _, c in chunks)
+    path = os.path.join(pack_dir, MULTI_PACK_INDEX_FILE)
+    write_file(path + '.lock', data + hashlib.sha1(data).digest())
+    os.replace(path + '.lock', path)
+    return (len(names), len(sha1s))
+
+
+def verify_multi_pack_index(repo='.'):
+    """Check objects/pack/multi-pack-index against the packs it covers:
+    checksum, sorted object table consistent with its fanout, each
+    object's pack and offset agreeing with that pack's .idx, and every
+    object in those .idx files being listed (covered .idx files aren't
+    searched when reading objects). Return list of error messages (empty if
+    all is well).
+    """
+    pack_dir = get_repository(repo).pack_store.pack_dir
     try:
-        data = read_file(os.path.join('.git', 'index'))
+        midx = read_multi_pack_index(os.path.join(pack_dir,
+                                                  MULTI_PACK_INDEX_FILE))
     except FileNotFoundError:
-        return []
-    digest = hashlib.sha1(data[:-20]).digest()
-    assert digest == data[-20:], 'invalid index checksum'
-    signature, version, num_entries = struct.unpack('!4sLL', data[:12])
-    assert signature == b'DIRC', \
-            'invalid index signature {}'.format(signature)
-    assert version == 2, 'unknown index version {}'.format(version)
-    entry_data = data[12:-20]
-    entries = []
-    i = 0
-    while i + 62 < len(entry_data):
-        fields_end = i + 62
-        fields = struct.unpack('!LLLLLLLLLL20sH', entry_data[i:fields_end])
-        path_end = entry_data.index(b'\x00', fields_end)
-        path = entry_data[fields_end:path_end]
-        entry = IndexEntry(*(fields + (path.decode(),)))
-        entries.append(entry)
-        entry_len = ((62 + len(path) + 8) // 8) * 8
-        i += entry_len
-    assert len(entries) == num_entries
-    return entries
+        return ['no multi-pack-index']
+    except (AssertionError, struct.error) as error:
+        return [str(error)]
+    errors = []
+    pack_indexes = []
+    for name in midx.pack_names:
+        try:
+            pack_indexes.append(read_pack_index(os.path.join(pack_dir,
+                                                             name)))
+        except (AssertionError, OSError) as error:
+            errors.append('pack {}: {}'.format(name, error))
+            pack_indexes.append(None)
+    sha1s = midx.sha1s
+    for byte in range(256):
+        count = bisect.bisect_left(sha1s, bytes([byte + 1]) if byte < 255
+                                   else b'\xff' * 21)
+        if midx.fanout[byte] != count:
+            errors.append('fanout entry {} is {}, expected {}'.format(
+                    byte, midx.fanout[byte], count))
+            break
+    for i in range(len(sha1s)):
+        sha1 = sha1s[i]
+        if i and sha1s[i - 1] >= sha1:
+            errors.append('object {} out of order'.format(sha1.hex()))
+        pack_index = pack_indexes[midx.pack_ids[i]]
+        if pack_index is None:
+            continue
+        positions = find_in_pack_index(pack_index, sha1.hex())
+        if not positions:
+            errors.append('object {} not in {}'.format(
+                    sha1.hex(), pack_index.pack_names[0]))
+        elif (pack_index_location(pack_index, positions[0]) !=
+                pack_index_location(midx, i)):
+            errors.append('object {} has wrong offset'.format(sha1.hex()))
+    for pack_index in pack_indexes:
+        if pack_index is None:
+            continue
+        for i in range(len(pack_index.sha1s)):
+            sha1 = pack_index.sha1s[i].hex()
+            if not find_in_pack_index(midx, sha1):
+                errors.append('object {} in {} not in multi-pack-index'.format(
+                        sha1, pack_index.pack_names[0]))
+    return errors
+
+
+class Repository:
+    """Handle on the git repository with working tree at given path. It owns
+    the paths under .git and caches what it parses (the index, packed refs,
+    loose object directory listings, small objects, and the bitmap and
+    changed-path files), so a long-running process serving many requests
+    against the same repo only rereads a file when its stat data changes.
+    """
+
+    def __init__(self, path='.'):
+        self.path = os.path.abspath(path)
+        self.git_dir = os.path.join(self.path, '.git')
+        self._lock = threading.Lock()
+        self._object_store = None
+        self._pack_store = None
+        self._alternates = None
+        self._objects = collections.OrderedDict()
+        self._index = None
+        self._shared_index = None
+        self._config = None
+        self._packed_refs = None
+        self._changed_paths = None
+        self._bitmap_index = None
+
+    def __repr__(self):
+        return 'Repository({!r})'.format(self.path)
+
+    def git_path(self, *names):
+        """Return absolute path of given file under .git (names may contain
+        forward slashes).
+        """
+        return os.path.join(self.git_dir, *names)
+
+    def stat_key(self, path):
+        """Return key identifying the current version of file at path, or
+        None if it doesn't exist. Files that are replaced rather than
+        rewritten in place get a new inode, so any change alters the key.
+        """
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+    @property
+    def object_store(self):
+        """Return the repo's ObjectStore: a SqliteObjectStore if
+        .git/objects.sqlite exists, otherwise a LooseObjectStore.
+        """
+        if self._object_store is None:
+            self._object_store = object_store_for(self.git_path('objects'))
+        return self._object_store
+
+    @property
+    def pack_store(self):
+        """Return the PackStore for the packs under .git/objects/pack."""
+        if self._pack_store is None:
+            self._pack_store = PackStore(self.git_path('objects'))
+        return self._pack_store
+
+    def read_alternates(self):
+        """Return list of (object_store, pack_store) tuples for the object
+        directories listed in .git/objects/info/alternates, one per line
+        (absolute or relative to .git/objects, "#" starts a comment), and
+        in their own alternates files up to ALTERNATES_MAX_DEPTH levels
+        deep. The list is cached until this repo's alternates file changes.
+        """
+        path = self.git_path('objects', 'info', 'alternates')
+        stat_key = self.stat_key(path)
+        if stat_key is None:
+            return []
+        if self._alternates is not None and self._alternates[0] == stat_key:
+            return self._alternates[1]
+        alternates = []
+        seen = {os.path.realpath(self.git_path('objects'))}
+        pending = [(self.git_path('objects'), 0)]
+        while pending:
+            objects_dir, depth = pending.pop(0)
+            try:
+                data = read_file(os.path.join(objects_dir, 'info',
+                                              'alternates'))
+            except FileNotFoundError:
+                continue
+            for line in data.decode().splitlines():
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                alternate_dir = os.path.normpath(os.path.join(objects_dir,
+                                                              line))
+                real_path = os.path.realpath(alternate_dir)
+                if real_path in seen or not os.path.isdir(alternate_dir):
+                    continue
+                seen.add(real_path)
+                alternates.append((object_store_for(alternate_dir),
+                                   PackStore(alternate_dir)))
+                if depth + 1 < ALTERNATES_MAX_DEPTH:
+                    pending.append((alternate_dir, depth + 1))
+        if self._alternates is not None:
+            for _, pack_store in self._alternates[1]:
+                pack_store.close()
+        self._alternates = (stat_key, alternates)
+        return alternates
+
+    def close(self):
+        """Close the pack files held open by this repo's pack store and its
+        alternates'. The handle can still be used; they're reopened as
+        needed.
+        """
+        if self._pack_store is not None:
+            self._pack_store.close()
+        if self._alternates is not None:
+            for _, pack_store in self._alternates[1]:
+                pack_store.close()
+
+    def hash_object(self, data, obj_type, write=True):
+        """Compute hash of object data of given type and write to object
+        store if "write" is True. Return SHA-1 object hash as hex string.
+        """
+        header = '{} {}'.format(obj_type, len(data)).encode()
+        full_data = header + b'\x00' + data
+        sha1 = hashlib.sha1(full_data).hexdigest()
+        if write and not any(pack_store.contains(sha1) or
+                             object_store.contains(sha1)
+                             for object_store, pack_store
+                             in self.read_alternates()):
+            self.object_store.write(sha1, full_data)
+        return sha1
+
+    def find_object(self, sha1_prefix):
+        """Find object with given SHA-1 prefix and return its full SHA-1, or
+        raise ValueError if there are no objects or multiple objects with
+        this prefix. Packed objects are looked up first (a full SHA-1 found
+        there needs no loose directory listing), then the object store, and
+        only if neither has it the alternate object directories.
+        """
+        packed = self.pack_store.find(sha1_prefix)
+        if len(packed) == 1 and len(sha1_prefix) == 40:
+            return packed[0]
+        try:
+            sha1 = self.object_store.find(sha1_prefix)
+        except ValueError as error:
+            if packed:
+                sha1 = packed[0]
+            else:
+                sha1 = self.find_alternate_object(sha1_prefix, error)
+        if len(set(packed) | {sha1}) > 1:
+            raise ValueError('multiple objects with prefix {!r}'.format(
+                    sha1_prefix))
+        return sha1
+
+    def find_alternate_object(self, sha1_prefix, error):
+        """Return full SHA-1 of the object with given prefix in the
+        alternate object directories, or raise error (from the local
+        lookup) if there's none there either.
+        """
+        found = set()
+        for object_store, pack_store in self.read_alternates():
+            found.update(pack_store.find(sha1_prefix))
+            try:
+                found.add(object_store.find(sha1_prefix))
+            except ValueError:
+                pass
+        if not found:
+            raise error
+        if len(found) > 1:
+            raise ValueError('multiple objects ({}) with prefix {!r}'.format(
+                    len(found), sha1_prefix))
+        return found.pop()
+
+    def object_source(self, sha1):
+        """Return the PackStore or ObjectStore holding object with given
+        full SHA-1: local packs first, then the local store, then each
+        alternate's packs and store. Raise ValueError if none has it.
+        """
+        if self.pack_store.contains(sha1):
+            return self.pack_store
+        alternates = self.read_alternates()
+        if not alternates or self.object_store.contains(sha1):
+            return self.object_store
+        for object_store, pack_store in alternates:
+            if pack_store.contains(sha1):
+                return pack_store
+            if object_store.contains(sha1):
+                return object_store
+        raise ValueError('object {!r} not found'.format(sha1))
+
+    def contains(self, sha1):
+        """Return True if object with given full SHA-1 is in a local pack,
+        the local store, or an alternate's packs or store.
+        """
+        if self.pack_store.contains(sha1) or self.object_store.contains(sha1):
+            return True
+        return any(pack_store.contains(sha1) or object_store.contains(sha1)
+                   for object_store, pack_store in self.read_alternates())
+
+    def open_object_data(self, sha1_prefix):
+        """Open object with given SHA-1 prefix for incremental inflating, or
+        raise ValueError if not found. Return tuple of (f, decompressor,
+        object_type, size, data_so_far): inflating the rest of binary file
+        f with the zlib decompressor gives the data after data_so_far.
+        Loose, database and non-delta packed objects are streamed from
+        their files; a packed delta has to be resolved in memory, so all
+        its data is in data_so_far.
+        """
+        sha1 = self.find_object(sha1_prefix)
+        source = self.object_source(sha1)
+        if not isinstance(source, PackStore):
+            return open_stored_object(source, sha1)
+        decompressor = zlib.decompressobj()
+        opened = source.open(sha1)
+        if opened is not None:
+            f, obj_type, size = opened
+            return (f, decompressor, obj_type, size, b'')
+        obj_type, data = source.read(sha1)
+        # Leave the decompressor at the end of an empty stream
+        decompressor.decompress(zlib.compress(b''))
+        return (io.BytesIO(), decompressor, obj_type, len(data), data)
+
+    def read_object(self, sha1_prefix):
+        """Read object with given SHA-1 prefix and return tuple of
+        (object_type, data_bytes), or raise ValueError if not found. Up to
+        OBJECT_CACHE_SIZE objects of at most OBJECT_CACHE_MAX_BYTES are kept
+        in a least-recently-used cache.
+        """
+        # Objects are cached by full SHA-1, so a prefix is resolved first
+        sha1 = sha1_prefix
+        if len(sha1_prefix) != 40:
+            sha1 = self.find_object(sha1_prefix)
+        with self._lock:
+            cached = self._objects.get(sha1)
+            if cached is not None:
+                self._objects.move_to_end(sha1)
+                return cached
+        if len(sha1_prefix) == 40:
+            sha1 = self.find_object(sha1_prefix)
+        source = self.object_source(sha1)
+        if isinstance(source, PackStore):
+            obj_type, data = source.read(sha1)
+            size = len(data)
+        else:
+            full_data = zlib.decompress(source.read(sha1))
+            nul_index = full_data.index(b'\x00')
+            header = full_data[:nul_index]
+            obj_type, size_str = header.decode().split()
+            size = int(size_str)
+            data = full_data[nul_index + 1:]
+            assert size == len(data), \
+                    'expected size {}, got {} bytes'.format(size, len(data))
+        if size <= OBJECT_CACHE_MAX_BYTES:
+            with self._lock:
+                self._objects[sha1] = (obj_type, data)
+                if len(self._objects) > OBJECT_CACHE_SIZE:
+                    self._objects.popitem(last=False)
+        return (obj_type, data)
+
+    def migrate_objects(self, store_type):
+        """Copy every object into a new store of given type ('loose' or
+        'sqlite') in a single transaction, switch to it and remove the old
+        store. Return number of objects copied.
+        """
+        if store_type not in ('loose', 'sqlite'):
+            raise ValueError('unknown object store {!r}'.format(store_type))
+        old_store = self.object_store
+        if isinstance(old_store, SqliteObjectStore) == (store_type ==
+                                                        'sqlite'):
+            raise ValueError('objects are already in a {} store'.format(
+                    store_type))
+        sqlite_path = self.git_path(SQLITE_OBJECTS_FILE)
+        if store_type == 'sqlite':
+            new_store = SqliteObjectStore(sqlite_path + '.tmp')
+        else:
+            new_store = LooseObjectStore(self.git_path('objects'))
+        new_store.create()
+        num_objects = 0
+        with new_store.transaction():
+            for sha1 in old_store.list():
+                if not new_store.contains(sha1):
+                    new_store.write_raw(sha1, old_store.read(sha1))
+                num_objects += 1
+        new_store.close()
+        old_store.close()
+        if store_type == 'sqlite':
+            os.replace(sqlite_path + '.tmp', sqlite_path)
+            for sha1 in old_store.list():
+                os.remove(old_store.path(sha1))
+            for name in os.listdir(old_store.objects_dir):
+                if re.match(r'[0-9a-f]{2}$', name):
+                    try:
+                        os.rmdir(os.path.join(old_store.objects_dir, name))
+                    except OSError:
+                        pass
+        else:
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(sqlite_path + suffix):
+                    os.remove(sqlite_path + suffix)
+        self._object_store = None
+        return num_objects
+
+    def read_config(self):
+        """Read .git/config and return dict mapping "section.key" (or
+        "section.subsection.key") to list of values in file order. Section
+        and key names are lowercased since git treats them
+        case-insensitively; a key without "=" has the value "true". The
+        parsed file is cached until its stat data changes.
+        """
+        path = self.git_path('config')
+        stat_key = self.stat_key(path)
+        if stat_key is None:
+            return {}
+        if self._config is not None and self._config[0] == stat_key:
+            return self._config[1]
+        config = {}
+        section = None
+        for line in read_file(path).decode().splitlines():
+            line = line.strip()
+            if not line or line[0] in '#;':
+                continue
+            match = re.match(r'\[([-.\w]+)(?:\s+"(.*)")?\]$', line)
+            if match:
+                section = match.group(1).lower()
+                if match.group(2) is not None:
+                    section += '.' + match.group(2)
+            elif section is not None:
+                key, _, value = line.partition('=')
+                name = '{}.{}'.format(section, key.strip().lower())
+                config.setdefault(name, []).append(
+                        value.strip() if _ else 'true')
+        self._config = (stat_key, config)
+        return config
+
+    def config_bool(self, name, default=False):
+        """Return value of boolean config variable with given lowercase
+        name (the last one if it's set more than once), or default if it
+        isn't set.
+        """
+        values = self.read_config().get(name)
+        if not values:
+            return default
+        return values[-1].lower() in ('true', 'yes', 'on', '1')
+
+    def set_config(self, name, value):
+        """Set config variable with given name ("section.key" or
+        "section.subsection.key") to string value in .git/config, replacing
+        its last existing value or adding it to the end of its section.
+        """
+        section, key = name.rsplit('.', 1)
+        section_name, _, subsection = section.partition('.')
+        path = self.git_path('config')
+        try:
+            lines = read_file(path).decode().splitlines()
+        except FileNotFoundError:
+            lines = []
+        new_line = '\t{} = {}'.format(key, value)
+        current = None
+        section_end = None
+        key_line = None
+        for i, line in enumerate(lines):
+            stripped = line.strip()
+            match = re.match(r'\[([-.\w]+)(?:\s+"(.*)")?\]$', stripped)
+            if match:
+                current = (match.group(1).lower() == section_name.lower() and
+                           (match.group(2) or '') == subsection)
+                if current:
+                    section_end = i + 1
+            elif current and stripped and stripped[0] not in '#;':
+                section_end = i + 1
+                if stripped.partition('=')[0].strip().lower() == key.lower():
+                    key_line = i
+        if key_line is not None:
+            lines[key_line] = new_line
+        elif section_end is not None:
+            lines.insert(section_end, new_line)
+        else:
+            header = '[{}]'.format(section_name) if not subsection else \
+                    '[{} "{}"]'.format(section_name, subsection)
+            lines.extend([header, new_line])
+        write_file(path + '.lock', ('\n'.join(lines) + '\n').encode())
+        os.replace(path + '.lock', path)
+
+    def read_index(self):
+        """Read git index file and return list of IndexEntry objects (see
+        read_compact_index).
+        """
+        return list(self.read_compact_index())
+
+    def read_compact_index(self):
+        """Read git index file and return CompactIndex of its entries. The
+        parsed entries are cached (and shared by callers, so must not be
+        modified) until the file's stat data changes. The checksum isn't
+        verified if it's all zeros (written with index.skipHash set), like
+        git. A split index is merged with its shared index.
+        """
+        path = self.git_path('index')
+        stat_key = self.stat_key(path)
+        if stat_key is None:
+            return CompactIndex()
+        if self._index is not None and self._index[0] == stat_key:
+            return self._index[1]
+        data = read_file(path)
+        if (data[-20:] != NULL_SHA1 and
+                hashlib.sha1(data[:-20]).digest() != data[-20:]):
+            raise ValueError('invalid index checksum')
+        entries, extensions = parse_index_data(data)
+        if b'link' in extensions:
+            entries = CompactIndex(
+                    self.merge_split_index(entries, extensions[b'link']))
+        self._index = (stat_key, entries)
+        return entries
+
+    def read_shared_index(self, sha1):
+        """Read .git/sharedindex.<sha1> and return tuple of (sha1, entries,
+        positions), where positions maps path to position in entries. The
+        file never changes, so the last one read is kept.
+        """
+        if self._shared_index is not None and self._shared_index[0] == sha1:
+            return self._shared_index
+        data = read_file(self.git_path('sharedindex.' + sha1))
+        assert hashlib.sha1(data[:-20]).hexdigest() == sha1, \
+                'invalid shared index checksum'
+        entries, _ = parse_index_data(data)
+        positions = {e.path: i for i, e in enumerate(entries)}
+        self._shared_index = (sha1, entries, positions)
+        return self._shared_index
+
+    def merge_split_index(self, split_entries, link):
+        """Merge entries of a split index with data of its "link" extension
+        into the shared index it points to, return full list of entries.
+        The first split entries replace the shared entries at the positions
+        set in the replace bitmap (and have no path of their own), the rest
+        are new.
+        """
+        _, base, _ = self.read_shared_index(link[:20].hex())
+        deleted = replaced = []
+        if len(link) > 20:
+            deleted, offset = decode_ewah(link, 20)
+            replaced, _ = decode_ewah(link, offset)
+        assert len(replaced) <= len(split_entries), \
+                'too many replacements in split index'
+        entries = list(base)
+        for pos, entry in zip(replaced, split_entries):
+            assert not entry.path, 'replacement entry has a path'
+            entries[pos] = entry._replace(
+                    path=base[pos].path,
+                    flags=entry.flags | (base[pos].flags & 0xfff))
+        if deleted:
+            deleted = set(deleted)
+            entries = [e for i, e in enumerate(entries) if i not in deleted]
+        entries.extend(split_entries[len(replaced):])
+        entries.sort(key=operator.attrgetter('path'))
+        return entries
+
+    def split_index_entries(self, entries):
+        """Return tuple of (split_entries, link_data) to write entries as a
+        split index: entries that differ from the current shared index, and
+        the "link" extension describing the difference. A new shared index
+        with all entries is written first if there isn't one yet, or if
+        more than splitIndex.maxPercentChange percent (default 20) of the
+        entries would differ. The shared index in use has its mtime
+        refreshed; replaced ones are left for expire_shared_indexes.
+        """
+        shared = None
+        if self._index is None:
+            self.read_compact_index()
+        if self._shared_index is not None and os.path.exists(
+                self.git_path('sharedindex.' + self._shared_index[0])):
+            shared = self._shared_index
+        max_percent = int((self.read_config().get(
+                'splitindex.maxpercentchange') or ['20'])[-1])
+        if shared is not None:
+            _, base, positions = shared
+            replaced = []
+            new = []
+            matched = 0
+            for entry in entries:
+                pos = positions.get(entry.path)
+                if pos is None:
+                    new.append(entry)
+                elif base[pos] is entry or base[pos] == entry:
+                    matched += 1
+                else:
+                    replaced.append((pos, entry))
+            deleted = []
+            if matched + len(replaced) < len(base):
+                present = {e.path for e in entries}
+                deleted = [i for i, e in enumerate(base)
+                           if e.path not in present]
+            num_changed = len(replaced) + len(new) + len(deleted)
+            if num_changed * 100 > max_percent * max(len(entries), 1):
+                shared = None
+            else:
+                os.utime(self.git_path('sharedindex.' + shared[0]))
+        if shared is None:
+            data = build_index_data(entries)
+            sha1 = hashlib.sha1(data).hexdigest()
+            path = self.git_path('sharedindex.' + sha1)
+            write_file(path + '.lock', data + bytes.fromhex(sha1))
+            os.replace(path + '.lock', path)
+            self._shared_index = (sha1, CompactIndex(entries),
+                                  {e.path: i for i, e in enumerate(entries)})
+            self.expire_shared_indexes()
+            replaced = new = deleted = []
+        replaced.sort(key=operator.itemgetter(0))
+        split_entries = [e._replace(path='', flags=e.flags & ~0xfff)
+                         for _, e in replaced] + new
+        link = (bytes.fromhex(self._shared_index[0]) + encode_ewah(deleted) +
+                encode_ewah([pos for pos, _ in replaced]))
+        return (split_entries, link)
+
+    def expire_shared_indexes(self):
+        """Remove .git/sharedindex.* files other than the current one that
+        are more than SHARED_INDEX_EXPIRE seconds old.
+        """
+        cutoff = time.time() - SHARED_INDEX_EXPIRE
+        for name in os.listdir(self.git_dir):
+            if (not name.startswith('sharedindex.') or
+                    name == 'sharedindex.' + self._shared_index[0]):
+                continue
+            path = self.git_path(name)
+            try:
+                if os.stat(path).st_mtime < cutoff:
+                    os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def write_index(self, entries):
+        """Write list of IndexEntry objects to git index file, replacing the
+        file atomically. If index.skipHash is set in .git/config the
+        trailing checksum is left as zeros, which saves hashing the whole
+        file on every write and read (for trusted local use). An index
+        containing sparse-directory entries gets git's "sdir" extension.
+        If core.splitIndex is set (and the index isn't sparse), only the
+        entries that differ from a shared base index are written.
+        """
+        entries = list(entries)
+        if any(stat.S_ISDIR(e.mode) for e in entries):
+            data = build_index_data(entries, [(b'sdir', b'')])
+        elif self.config_bool('core.splitindex'):
+            split_entries, link = self.split_index_entries(entries)
+            data = build_index_data(split_entries, [(b'link', link)])
+        else:
+            data = build_index_data(entries)
+        if self.config_bool('index.skiphash'):
+            digest = NULL_SHA1
+        else:
+            digest = hashlib.sha1(data).digest()
+        path = self.git_path('index')
+        write_file(path + '.lock', data + digest)
+        os.replace(path + '.lock', path)
+        self._index = (self.stat_key(path), CompactIndex(entries))
+
+    def read_packed_refs(self):
+        """Read .git/packed-refs and return PackedRefs tuple. The parsed
+        table is cached until the file's stat data changes.
+        """
+        path = self.git_path('packed-refs')
+        stat_key = self.stat_key(path)
+        if stat_key is None:
+            return PackedRefs(None, [], {})
+        if (self._packed_refs is not None and
+                self._packed_refs.stat_key == stat_key):
+            return self._packed_refs
+        by_name = {}
+        for line in read_file(path).decode().splitlines():
+            if not line or line[0] in '#^':
+                continue
+            sha1, name = line.split(' ', 1)
+            by_name[name] = sha1
+        self._packed_refs = PackedRefs(stat_key, sorted(by_name), by_name)
+        return self._packed_refs
+
+    def write_packed_refs(self, refs):
+        """Write dict of refs (mapping name to SHA-1) to .git/packed-refs,
+        replacing the file atomically.
+        """
+        lines = ['# pack-refs with: sorted \n']
+        lines.extend('{} {}\n'.format(refs[name], name)
+                     for name in sorted(refs))
+        path = self.git_path('packed-refs')
+        write_file(path + '.lock', ''.join(lines).encode())
+        os.replace(path + '.lock', path)
+
+    def read_ref(self, name):
+        """Return SHA-1 hex string that ref with given full name (for
+        example "refs/heads/master" or "HEAD") points to, following symbolic
+        refs, or None if there's no such ref. Loose refs take precedence
+        over packed refs. Raise ValueError if name isn't a valid ref name.
+        """
+        if name != 'HEAD':
+            check_ref_name(name)
+        try:
+            data = read_file(self.git_path(name)).decode().strip()
+        except (FileNotFoundError, IsADirectoryError, NotADirectoryError):
+            return self.read_packed_refs().by_name.get(name)
+        if data.startswith('ref: '):
+            return self.read_ref(data[5:])
+        return data
+
+    def write_ref(self, name, sha1):
+        """Point loose ref with given full name at SHA-1 hex string."""
+        check_ref_name(name)
+        path = self.git_path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        write_file(path, (sha1 + '\n').encode())
+
+    def read_head(self):
+        """Return full name of branch HEAD refers to, or None if HEAD is
+        detached (points directly at a commit).
+        """
+        data = read_file(self.git_path('HEAD')).decode().strip()
+        return data[5:] if data.startswith('ref: ') else None
+
+    def write_head(self, name):
+        """Point HEAD at branch with given full ref name."""
+        write_file(self.git_path('HEAD'), 'ref: {}'.format(name).encode())
+
+    def list_refs(self, prefix='refs/'):
+        """Return sorted list of (name, sha1) tuples for refs whose names
+        start with prefix. Only the matching slice of the packed table and
+        the loose ref directory under prefix are visited.
+        """
+        packed = self.read_packed_refs()
+        refs = {}
+        i = bisect.bisect_left(packed.names, prefix)
+        while i < len(packed.names) and packed.names[i].startswith(prefix):
+            refs[packed.names[i]] = packed.by_name[packed.names[i]]
+            i += 1
+        base_dir = self.git_path(prefix[:prefix.rfind('/') + 1])
+        for root, dirs, files in os.walk(base_dir):
+            for file in files:
+                path = os.path.join(root, file)
+                name = os.path.relpath(path, self.git_dir).replace('\\', '/')
+                if name.startswith(prefix) and not name.endswith('.lock'):
+                    try:
+                        sha1 = self.read_ref(name)
+                    except ValueError:
+                        continue
+                    if sha1 is not None:
+                        refs[name] = sha1
+        return sorted(refs.items())
+
+    def pack_refs(self):
+        """Move all loose refs into .git/packed-refs and remove the loose
+        files, return number of refs packed.
+        """
+        refs = dict(self.read_packed_refs().by_name)
+        loose_paths = []
+        for root, dirs, files in os.walk(self.git_path('refs')):
+            for file in files:
+                path = os.path.join(root, file)
+                data = read_file(path).decode().strip()
+                if file.endswith('.lock') or data.startswith('ref: '):
+                    continue
+                name = os.path.relpath(path, self.git_dir).replace('\\', '/')
+                refs[name] = data
+                loose_paths.append(path)
+        self.write_packed_refs(refs)
+        for path in loose_paths:
+            os.remove(path)
+            dir_path = os.path.dirname(path)
+            while os.path.relpath(dir_path, self.git_dir).replace(
+                    '\\', '/') not in ('refs', 'refs/heads', 'refs/tags'):
+                try:
+                    os.rmdir(dir_path)
+                except OSError:
+                    break
+                dir_path = os.path.dirname(dir_path)
+        return len(refs)
+
+    def read_changed_paths(self):
+        """Read .git/objects/info/changed-paths and return ChangedPaths
+        tuple. The parsed filters are cached until the file's stat data
+        changes.
+        """
+        path = self.git_path('objects', 'info', 'changed-paths')
+        stat_key = self.stat_key(path)
+        if stat_key is None:
+            return ChangedPaths(None, {})
+        if (self._changed_paths is not None and
+                self._changed_paths.stat_key == stat_key):
+            return self._changed_paths
+        data = read_file(path)
+        signature, version = struct.unpack('!4sL', data[:8])
+        assert signature == b'PCPB', \
+                'invalid changed-paths signature {}'.format(signature)
+        assert version == 1, 'unknown changed-paths version {}'.format(
+                version)
+        filters = {}
+        i = 8
+        while i + 24 <= len(data):
+            length, = struct.unpack('!L', data[i + 20:i + 24])
+            if i + 24 + length > len(data):
+                break  # torn final record from an interrupted append
+            filters[data[i:i + 20].hex()] = data[i + 24:i + 24 + length]
+            i += 24 + length
+        self._changed_paths = ChangedPaths(stat_key, filters)
+        return self._changed_paths
+
+    def read_bitmap_index(self):
+        """Read .git/objects/info/bitmaps and return BitmapIndex, or None if
+        there's no bitmap file. The parsed index is cached until the file's
+        stat data changes.
+        """
+        path = self.git_path('objects', 'info', 'bitmaps')
+        stat_key = self.stat_key(path)
+        if stat_key is None:
+            return None
+        if (self._bitmap_index is not None and
+                self._bitmap_index.stat_key == stat_key):
+            return self._bitmap_index
+        data = read_file(path)
+        assert hashlib.sha1(data[:-20]).digest() == data[-20:], \
+                'invalid bitmap checksum'
+        signature, version, num_objects, num_bitmaps = struct.unpack(
+                '!4sLLL', data[:16])
+        assert signature == b'PBMP', \
+                'invalid bitmap signature {}'.format(signature)
+        assert version == 1, 'unknown bitmap version {}'.format(version)
+        i = 16 + num_objects * 20
+        names = tuple(data[j:j + 20].hex() for j in range(16, i, 20))
+        bitmaps = {}
+        for _ in range(num_bitmaps):
+            commit_sha1 = data[i:i + 20].hex()
+            length, = struct.unpack('!L', data[i + 20:i + 24])
+            bitmaps[commit_sha1] = data[i + 24:i + 24 + length]
+            i += 24 + length
+        positions = {sha1: pos for pos, sha1 in enumerate(names)}
+        self._bitmap_index = BitmapIndex(stat_key, names, positions, bitmaps)
+        return self._bitmap_index
+
+
+# Repository handles by absolute working tree path, least recently used
+# first, see get_repository()
+_repositories = collections.OrderedDict()
+_repositories_lock = threading.Lock()
+
+
+def get_repository(path='.'):
+    """Return the Repository handle for the working tree at given path (the
+    current directory by default), creating it on first use; a Repository
+    is returned as it is. The REPOSITORY_CACHE_SIZE most recently used
+    handles are kept so their caches stay warm. Functions below with a
+    "repo" argument take either a Repository or a working tree path and
+    resolve it here; the rest use the current directory's handle.
+    """
+    if isinstance(path, Repository):
+        return path
+    path = os.path.abspath(path)
+    with _repositories_lock:
+        repo = _repositories.get(path)
+        if repo is not None:
+            _repositories.move_to_end(path)
+            return repo
+        repo = _repositories[path] = Repository(path)
+        if len(_repositories) > REPOSITORY_CACHE_SIZE:
+            _, evicted = _repositories.popitem(last=False)
+            evicted.close()
+    return repo
+
+
+def hash_object(data, obj_type, write=True, repo='.'):
+    """Compute hash of object data of given type and write to object store if
+    "write" is True. Return SHA-1 object hash as hex string.
+    """
+    return get_repository(repo).hash_object(data, obj_type, write=write)
+
+
+def find_object(sha1_prefix, repo='.'):
+    """Find object with given SHA-1 prefix and return its full SHA-1, or
+    raise ValueError if there are no objects or multiple objects with this
+    prefix.
+    """
+    return get_repository(repo).find_object(sha1_prefix)
+
+
+def read_object(sha1_prefix, repo='.'):
+    """Read object with given SHA-1 prefix and return tuple of
+    (object_type, data_bytes), or raise ValueError if not found.
+    """
+    return get_repository(repo).read_object(sha1_prefix)
+
+
+def migrate_objects(store_type, repo='.'):
+    """Move all objects to a store of given type ('loose' or 'sqlite'),
+    return number of objects moved.
+    """
+    return get_repository(repo).migrate_objects(store_type)
+
+
+def inflate_header(f, decompressor):
+    """Inflate just enough of object file f with given zlib decompressor to
+    parse its header, return tuple of (object_type, size, data_so_far).
+    """
+    header = b''
+    while b'\x00' not in header:
+        assert len(header) < 64, 'invalid object header {!r}'.format(header)
+        chunk = decompressor.unconsumed_tail or f.read(256)
+        assert chunk, 'truncated object header {!r}'.format(header)
+        header += decompressor.decompress(chunk, 32)
+    nul_index = header.index(b'\x00')
+    obj_type, size_str = header[:nul_index].decode().split()
+    return (obj_type, int(size_str), header[nul_index + 1:])
+
+
+def open_stored_object(object_store, sha1):
+    """Open object with given full SHA-1 in ObjectStore for incremental
+    inflating, return tuple as for Repository.open_object_data.
+    """
+    f = object_store.open(sha1)
+    decompressor = zlib.decompressobj()
+    try:
+        obj_type, size, data = inflate_header(f, decompressor)
+    except BaseException:
+        f.close()
+        raise
+    return (f, decompressor, obj_type, size, data)
+
+
+def read_object_header(sha1_prefix, repo='.'):
+    """Read only the header of object with given SHA-1 prefix and return
+    tuple of (object_type, size), or raise ValueError if not found. Just the
+    first few bytes are inflated, however large the object is.
+    """
+    repo = get_repository(repo)
+    f, _, obj_type, size, _ = repo.open_object_data(sha1_prefix)
+    f.close()
+    return (obj_type, size)
+
+
+class ObjectReader(io.RawIOBase):
+    """Readable file object over the data of object with given SHA-1 prefix,
+    inflated incrementally as it's read. The object's type and size are
+    available as obj_type and size attributes.
+    """
+
+    def __init__(self, sha1_prefix, repo='.'):
+        super().__init__()
+        (self._file, self._decompressor, self.obj_type, self.size,
+         self._pending) = get_repository(repo).open_object_data(sha1_prefix)
+        self._remaining = self.size - len(self._pending)
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        num_bytes = 0
+        while num_bytes < len(buffer):
+            if not self._pending:
+                if self._decompressor.eof:
+                    break
+                chunk = self._decompressor.unconsumed_tail or \
+                        self._file.read(len(buffer))
+                assert chunk, 'truncated object, {} bytes missing'.format(
+                        self._remaining)
+                self._pending = self._decompressor.decompress(
+                        chunk, len(buffer) - num_bytes)
+                self._remaining -= len(self._pending)
+                continue
+            size = min(len(buffer) - num_bytes, len(self._pending))
+            buffer[num_bytes:num_bytes + size] = self._pending[:size]
+            self._pending = self._pending[size:]
+            num_bytes += size
+        if num_bytes < len(buffer):
+            assert self._remaining == 0, \
+                    'expected size {}, got {} bytes'.format(
+                            self.size, self.size - self._remaining)
+        return num_bytes
+
+    def close(self):
+        self._file.close()
+        super().close()
+
+
+def write_object_data(sha1_prefix, output_file, expected_type=None,
+                      chunk_size=65536, repo='.'):
+    """Inflate data of object with given SHA-1 prefix straight to
+    output_file in chunks of at most chunk_size bytes, so memory use stays
+    bounded however large the object is. Raise ValueError if not found, or
+    if expected_type is given and doesn't match. Return tuple of
+    (object_type, size).
+    """
+    with ObjectReader(sha1_prefix, repo) as reader:
+        if expected_type is not None and reader.obj_type != expected_type:
+            raise ValueError('expected object type {}, got {}'.format(
+                    expected_type, reader.obj_type))
+        for chunk in iter(lambda: reader.read(chunk_size), b''):
+            output_file.write(chunk)
+    return (reader.obj_type, reader.size)
+
+
+def cat_file(mode, sha1_prefix, repo='.'):
+    """Write the contents of (or info about) object with given SHA-1 prefix to
+    stdout. If mode is 'commit', 'tree', or 'blob', print raw data bytes of
+    object. If mode is 'size', print the size of the object. If mode is
+    'type', print the type of the object. If mode is 'pretty', print a
+    prettified version of the object. Raw data is streamed to stdout as it's
+    inflated.
+    """
+    repo = get_repository(repo)
+    if mode in ['size', 'type']:
+        obj_type, size = read_object_header(sha1_prefix, repo)
+        print(size if mode == 'size' else obj_type)
+    elif mode in ['commit', 'tree', 'blob']:
+        sys.stdout.flush()
+        write_object_data(sha1_prefix, sys.stdout.buffer, expected_type=mode,
+                          repo=repo)
+    elif mode == 'pretty':
+        obj_type, size = read_object_header(sha1_prefix, repo)
+        if obj_type in ['commit', 'blob']:
+            sys.stdout.flush()
+            write_object_data(sha1_prefix, sys.stdout.buffer, repo=repo)
+        elif obj_type == 'tree':
+            for mode, path, sha1 in read_tree(sha1=sha1_prefix, repo=repo):
+                type_str = 'tree' if stat.S_ISDIR(mode) else 'blob'
+                print('{:06o} {} {}\t{}'.format(mode, type_str, sha1, path))
+        else:
+            assert False, 'unhandled object type {!r}'.format(obj_type)
+    else:
+        raise ValueError('unexpected mode {!r}'.format(mode))
+
+
+def cat_file_batch(contents=True, input_file=None, output_file=None,
+                   repo='.'):
+    """Read object names (SHA-1 prefixes or ref names) from input_file
+    (stdin by default), one per line, and write "<sha1> <type> <size>" for
+    each to output_file (stdout by default), followed by the object's data
+    and a newline if "contents" is True. Unknown names give "<name>
+    missing" and SHA-1 prefixes matching several objects give "<name>
+    ambiguous". Output is flushed after each object so a long-running
+    caller can drive this interactively; object directory listings stay
+    cached between requests.
+    """
+    repo = get_repository(repo)
+    if input_file is None:
+        input_file = sys.stdin.buffer
+    if output_file is None:
+        output_file = sys.stdout.buffer
+    for line in iter(input_file.readline, b''):
+        name = line.strip()
+        if not name:
+            continue
+        try:
+            sha1 = resolve_rev(name.decode(), repo)
+            obj_type, size = read_object_header(sha1, repo)
+        except ValueError as error:
+            # UnicodeDecodeError is a ValueError too
+            status = b'missing'
+            if str(error).startswith('multiple objects'):
+                status = b'ambiguous'
+            output_file.write(name + b' ' + status + b'\n')
+            output_file.flush()
+            continue
+        output_file.write('{} {} {}\n'.format(sha1, obj_type, size).encode())
+        if contents:
+            write_object_data(sha1, output_file, repo=repo)
+            output_file.write(b'\n')
+        output_file.flush()
+
+
+def check_object(sha1, chunk_size=65536, repo_path='.'):
+    """Inflate object with given SHA-1 (in the repo at repo_path) in chunks
+    of at most chunk_size bytes, recomputing its hash and checking its
+    header and size. Return tuple of (object_type, links, error), where
+    links lists the SHA-1s a tree, commit or tag refers to, and error is
+    None if the object is good or else a message saying what is wrong
+    (object_type is "unknown" if the header couldn't be read). Only
+    non-blob data is kept in memory (to parse the links).
+    """
+    repo = get_repository(repo_path)
+    obj_type = 'unknown'
+    try:
+        if repo.object_store.contains(sha1):
+            opened = open_stored_object(repo.object_store, sha1)
+        else:
+            opened = repo.open_object_data(sha1)
+        f, decompressor, obj_type, size, data = opened
+        with f:
+            if obj_type not in ('blob', 'tree', 'commit', 'tag'):
+                return (obj_type, [], 'unknown object type {!r}'.format(
+                        obj_type))
+            hasher = hashlib.sha1('{} {}\x00'.format(obj_type, size).encode())
+            parts = []
+            num_bytes = 0
+            while True:
+                hasher.update(data)
+                num_bytes += len(data)
+                if obj_type != 'blob':
+                    parts.append(data)
+                if decompressor.eof or num_bytes > size:
+                    break
+                chunk = decompressor.unconsumed_tail or f.read(chunk_size)
+                if not chunk:
+                    return (obj_type, [], 'truncated object')
+                data = decompressor.decompress(chunk, chunk_size)
+    except (AssertionError, ValueError, zlib.error) as error:
+        return (obj_type, [], str(error) or 'invalid object')
+    if num_bytes != size:
+        return (obj_type, [], 'expected size {}, got {} bytes'.format(
+                size, num_bytes))
+    if hasher.hexdigest() != sha1:
+        return (obj_type, [], 'hash mismatch, content has {}'.format(
+                hasher.hexdigest()))
+    data = b''.join(parts)
+    links = []
+    try:
+        if obj_type == 'tree':
+            links = [s for mode, _, s in read_tree(data=data)
+                     if mode != 0o160000]
+        elif obj_type in ('commit', 'tag'):
+            header = data.partition(b'\n\n')[0]
+            for line in header.split(b'\n'):
+                if line.startswith((b'tree ', b'parent ', b'object ')):
+                    links.append(line.split(b' ', 1)[1].decode())
+            if not links or any(not re.match(r'[0-9a-f]{40}$', s)
+                                for s in links):
+                return (obj_type, [], 'invalid {} header'.format(obj_type))
+    except ValueError as error:
+        return (obj_type, [], 'invalid {}: {}'.format(obj_type, error))
+    return (obj_type, links, None)
+
+
+def check_objects(repo_path, sha1s):
+    """Run check_object on each SHA-1 in the repo at given path, return
+    list of (sha1, object_type, links, error) tuples. This is the unit of
+    work fsck sends to a worker process.
+    """
+    return [(sha1,) + check_object(sha1, repo_path=repo_path)
+            for sha1 in sha1s]
+
+
+def reset_repositories():
+    """Forget Repository handles inherited from a parent process (their
+    open database connections mustn't be shared with it), closing their
+    pack files.
+    """
+    for repo in _repositories.values():
+        repo.close()
+    _repositories.clear()
+
+
+def fsck(max_workers=None, repo='.'):
+    """Verify every object in the store and in packs, FSCK_BATCH_SIZE
+    objects per task on a process pool (so inflating and hashing use all
+    CPUs), and check that every object referred to by a tree, commit, tag,
+    ref or the index exists. Return tuple of (num_objects, bad, missing),
+    where bad maps SHA-1 of each corrupt object to an error message and
+    missing maps SHA-1 of each absent object to the first object (or ref,
+    or "index") found referring to it. Objects in alternate object
+    directories count as present but aren't verified.
+    """
+    import concurrent.futures
+    repo = get_repository(repo)
+    present = set(repo.object_store.list())
+    present.update(repo.pack_store.list())
+    sha1s = sorted(present)
+    for object_store, pack_store in repo.read_alternates():
+        present.update(object_store.list())
+        present.update(pack_store.list())
+    bad = {}
+    missing = {}
+    batches = [sha1s[i:i + FSCK_BATCH_SIZE]
+               for i in range(0, len(sha1s), FSCK_BATCH_SIZE)]
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers, initializer=reset_repositories) as executor:
+        for results in executor.map(check_objects,
+                                    [repo.path] * len(batches), batches):
+            for sha1, obj_type, links, error in results:
+                if error is not None:
+                    bad[sha1] = error
+                for link in links:
+                    if link not in present:
+                        missing.setdefault(link, sha1)
+    roots = list_refs(repo=repo)
+    if read_head(repo) is None:
+        roots.append(('HEAD', read_file(repo.git_path('HEAD')).decode()[:40]))
+    roots.extend(('index', e.sha1.hex()) for e in read_compact_index(repo))
+    for name, sha1 in roots:
+        if sha1 not in present:
+            missing.setdefault(sha1, name)
+    return (len(sha1s), bad, missing)
+
+
+def read_index(repo='.'):
+    """Read git index file and return list of IndexEntry objects."""
+    return get_repository(repo).read_index()
+
+
+def read_compact_index(repo='.'):
+    """Read git index file and return (read-only) CompactIndex of entries."""
+    return get_repository(repo).read_compact_index()
+
+
+def ls_files(details=False, repo='.'):
+    """Print list of files in index (including mode, SHA-1, and stage number
+    if "details" is True).
+    """
+    for entry in read_compact_index(repo):
+        if details:
+            stage = (entry.flags >> 12) & 3
+            print('{:6o} {} {:}\t{}'.format(
+                    entry.mode, entry.sha1.hex(), stage, entry.path))
+        else:
+            print(entry.path)
+
+
+def get_status(repo='.'):
+    """Get status of repo's working copy, return tuple of (changed_paths,
+    new_paths, deleted_paths). Directories collapsed into sparse-directory
+    index entries aren't walked. Paths are looked up in the compact index
+    by binary search, and tracked entries seen are marked in a bytearray.
+    """
+    repo = get_repository(repo)
+    entries = read_compact_index(repo)
+    seen = bytearray(len(entries))
+    changed = []
+    new = []
+    for root, dirs, files in os.walk(repo.path):
+        root = os.path.relpath(root, repo.path).replace('\\', '/')
+        prefix = root + '/' if root != '.' else ''
+        dirs[:] = [d for d in dirs
+                   if d != '.git' and not is_sparse_dir(entries,
+                                                        prefix + d + '/')]
+        for file in files:
+            path = prefix + file
+            i = entries.find(path)
+            entry = None if i is None else entries[i]
+            if entry is None or entry.flags & INDEX_SKIP_WORKTREE:
+                new.append(path)
+                continue
+            while i < len(entries) and entries.path(i) == path:
+                seen[i] = 1
+                i += 1
+            data = read_file(os.path.join(repo.path, path))
+            if hash_object(data, 'blob', write=False, repo=repo) != \
+                    entry.sha1.hex():
+                changed.append(path)
+    deleted = set()
+    i = seen.find(0)
+    while i != -1:
+        entry = entries[i]
+        if not entry.flags & INDEX_SKIP_WORKTREE:
+            deleted.add(entry.path)
+        i = seen.find(0, i + 1)
+    return (sorted(changed), sorted(new), sorted(deleted))
+
+
+def is_sparse_dir(entries, path):
+    """Return True if CompactIndex has a sparse-directory entry for given
+    directory path ("dir/").
+    """
+    i = entries.find(path)
+    return i is not None and stat.S_ISDIR(entries[i].mode)
+
+
+def minhash_signature(lines):
+    """Return MinHash signature (tuple of RENAME_NUM_HASHES ints) of the set
+    of distinct lines in given list.
+    """
+    hashes = {zlib.crc32(line) << 32 | zlib.adler32(line) for line in lines}
+    return tuple(min(((h ^ salt) * multiplier) & 0xffffffffffffffff
+                     for h in hashes)
+                 for salt, multiplier in MINHASH_SEEDS)
+
+
+def similarity(lines1, lines2):
+    """Return fraction of lines (0.0 to 1.0) that the two lists of lines have
+    in common, relative to the longer list.
+    """
+    common = collections.Counter(lines1) & collections.Counter(lines2)
+    return sum(common.values()) / max(len(lines1), len(lines2), 1)
+
+
+def find_renames(deleted, new, threshold=0.5, repo='.'):
+    """Detect renames between deleted paths (content from the index) and new
+    paths (content from the working copy). Exact SHA-1 matches are paired
+    first; the rest are bucketed by bands of their MinHash signatures (LSH)
+    so that only likely pairs get a line-by-line similarity score, rather
+    than all pairs (unless there are only a few pairs). Return sorted list
+    of (old_path, new_path, similarity) tuples.
+    """
+    if not deleted or not new:
+        return []
+    repo = get_repository(repo)
+    entries = read_compact_index(repo)
+    deleted_by_sha1 = collections.defaultdict(list)
+    for path in deleted:
+        deleted_by_sha1[entries.get(path).sha1.hex()].append(path)
+    renames = []
+    new_data = {}
+    for path in new:
+        data = read_file(os.path.join(repo.path, path))
+        sha1 = hash_object(data, 'blob', write=False, repo=repo)
+        if deleted_by_sha1.get(sha1):
+            renames.append((deleted_by_sha1[sha1].pop(0), path, 1.0))
+        else:
+            new_data[path] = data
+
+    old_lines = {}
+    for paths in deleted_by_sha1.values():
+        for path in paths:
+            obj_type, data = read_object(entries.get(path).sha1.hex(), repo)
+            old_lines[path] = data.splitlines()
+    new_lines = {path: data.splitlines() for path, data in new_data.items()}
+    if len(old_lines) * len(new_lines) <= RENAME_ALL_PAIRS_LIMIT:
+        candidates = {(old_path, new_path) for old_path in old_lines
+                      for new_path in new_lines}
+    else:
+        buckets = collections.defaultdict(lambda: ([], []))
+        for side, files in enumerate([old_lines, new_lines]):
+            for path, lines in files.items():
+                if not lines:
+                    continue
+                signature = minhash_signature(lines)
+                for i in range(0, len(signature), RENAME_BAND_SIZE):
+                    band = (i, signature[i:i + RENAME_BAND_SIZE])
+                    buckets[band][side].append(path)
+        candidates = set()
+        for old_paths, new_paths in buckets.values():
+            for old_path in old_paths:
+                for new_path in new_paths:
+                    candidates.add((old_path, new_path))
+    scored = []
+    for old_path, new_path in candidates:
+        score = similarity(old_lines[old_path], new_lines[new_path])
+        if score >= threshold:
+            scored.append((-score, old_path, new_path))
+    used_old = set()
+    used_new = set()
+    for score, old_path, new_path in sorted(scored):
+        if old_path not in used_old and new_path not in used_new:
+            used_old.add(old_path)
+            used_new.add(new_path)
+            renames.append((old_path, new_path, -score))
+    return sorted(renames)
+
+
+def status(repo='.'):
+    """Show status of repo's working copy, with renamed files detected."""
+    changed, new, deleted = get_status(repo)
+    renames = find_renames(deleted, new, repo=repo)
+    renamed_old = {old_path for old_path, new_path, score in renames}
+    renamed_new = {new_path for old_path, new_path, score in renames}
+    new = [p for p in new if p not in renamed_new]
+    deleted = [p for p in deleted if p not in renamed_old]
+    if changed:
+        print('changed files:')
+        for path in changed:
+            print('   ', path)
+    if new:
+        print('new files:')
+        for path in new:
+            print('   ', path)
+    if deleted:
+        print('deleted files:')
+        for path in deleted:
+            print('   ', path)
+    if renames:
+        print('renamed files:')
+        for old_path, new_path, score in renames:
+            print('    {} -> {} ({:.0%})'.format(old_path, new_path, score))
+
+
+def diff(repo='.'):
+    """Show diff of files changed (between repo's index and working copy).
+    Renamed files are shown as a rename plus any changes to their content.
+    """
+    import difflib
+    repo = get_repository(repo)
+    changed, new, deleted = get_status(repo)
+    pairs = [(path, path) for path in changed]
+    pairs.extend((old_path, new_path) for old_path, new_path, score
+                 in find_renames(deleted, new, repo=repo))
+    entries = read_compact_index(repo)
+    for i, (old_path, path) in enumerate(pairs):
+        if old_path != path:
+            print('rename from {}'.format(old_path))
+            print('rename to {}'.format(path))
+        sha1 = entries.get(old_path).sha1.hex()
+        obj_type, data = read_object(sha1, repo)
+        assert obj_type == 'blob'
+        index_lines = data.decode().splitlines()
+        working_lines = read_file(
+                os.path.join(repo.path, path)).decode().splitlines()
+        diff_lines = difflib.unified_diff(
+                index_lines, working_lines,
+                '{} (index)'.format(old_path),
+                '{} (working copy)'.format(path),
+                lineterm='')
+        for line in diff_lines:
+            print(line)
+        if i < len(pairs) - 1:
+            print('-' * 70)
+
+
+def write_index(entries, repo='.'):
+    """Write list of IndexEntry objects to git index file."""
+    get_repository(repo).write_index(entries)
+
+
+def make_index_entry(path, st, sha1, mode=None):
+    """Build an IndexEntry for path from its os.stat() result and SHA-1 hex
+    string. Stat fields are truncated to 32 bits like git does.
+    """
+    flags = len(path.encode())
+    assert flags < (1 << 12)
+    return IndexEntry(
+            int(st.st_ctime), st.st_ctime_ns % 1000000000,
+            int(st.st_mtime), st.st_mtime_ns % 1000000000,
+            st.st_dev & 0xffffffff, st.st_ino & 0xffffffff,
+            st.st_mode if mode is None else mode, st.st_uid, st.st_gid,
+            st.st_size & 0xffffffff, bytes.fromhex(sha1), flags, path)
+
+
+def add(paths, repo='.'):
+    """Add all file paths (relative to repo's working tree) to git index."""
+    repo = get_repository(repo)
+    paths = [p.replace('\\', '/') for p in paths]
+    entries = [e for e in read_compact_index(repo) if e.path not in paths]
+    with repo.object_store.transaction():
+        for path in paths:
+            full_path = os.path.join(repo.path, path)
+            sha1 = hash_object(read_file(full_path), 'blob', repo=repo)
+            entries.append(make_index_entry(path, os.stat(full_path), sha1))
+    entries.sort(key=operator.attrgetter('path'))
+    write_index(entries, repo)
+
+
+def write_tree_entries(entries, trees=None, repo='.'):
+    """Write tree objects for list of IndexEntry objects and return SHA-1 of
+    the root tree. Sparse-directory entries are used as subtrees as they
+    are. If "trees" dict is given, the SHA-1 of each tree written is added
+    to it keyed by directory path ("" for the root, else "dir/").
+    """
+    repo = get_repository(repo)
+    root = {}
+    for entry in entries:
+        parts = entry.path.rstrip('/').split('/')
+        node = root
+        for part in parts[:-1]:
+            node = node.setdefault(part, {})
+        node[parts[-1]] = entry
+
+    def write(node, prefix):
+        items = []
+        for name, value in node.items():
+            if isinstance(value, dict):
+                sha1 = bytes.fromhex(write(value, prefix + name + '/'))
+                items.append(((name + '/').encode(), 0o40000, name, sha1))
+            elif stat.S_ISDIR(value.mode):
+                items.append(((name + '/').encode(), 0o40000, name,
+                              value.sha1))
+            else:
+                items.append((name.encode(), value.mode, name, value.sha1))
+        items.sort()
+        data = b''.join('{:o} {}'.format(mode, name).encode() + b'\x00' + sha1
+                        for _, mode, name, sha1 in items)
+        sha1 = hash_object(data, 'tree', repo=repo)
+        if trees is not None:
+            trees[prefix] = sha1
+        return sha1
+
+    return write(root, '')
+
+
+def write_tree(repo='.'):
+    """Write tree objects from repo's current index entries, return SHA-1
+    of the root tree.
+    """
+    repo = get_repository(repo)
+    return write_tree_entries(read_compact_index(repo), repo=repo)
+
+
+def read_sparse_cone(repo='.'):
+    """Return sorted list of the directories in the sparse-checkout cone
+    (from .git/info/sparse-checkout), or None if sparse checkout isn't
+    enabled. An empty list means only top-level files are checked out.
+    """
+    repo = get_repository(repo)
+    if not repo.config_bool('core.sparsecheckout'):
+        return None
+    try:
+        lines = read_file(repo.git_path('info', 'sparse-checkout')).decode()
+    except FileNotFoundError:
+        return None
+    included = set()
+    parents = set()
+    for line in lines.splitlines():
+        line = line.strip()
+        if line.startswith('!/') and line.endswith('/*/'):
+            parents.add(line[2:-3])
+        elif line.startswith('/') and line.endswith('/') and line != '/':
+            included.add(line[1:-1])
+    return sorted(included - parents)
+
+
+def write_sparse_cone(cone, repo='.'):
+    """Write cone-mode patterns for given list of directories to
+    .git/info/sparse-checkout.
+    """
+    parents = set()
+    for dir_path in cone:
+        parts = dir_path.split('/')
+        parents.update('/'.join(parts[:i]) for i in range(1, len(parts)))
+    lines = ['/*', '!/*/']
+    for parent in sorted(parents):
+        lines.extend(['/{}/'.format(parent), '!/{}/*/'.format(parent)])
+    lines.extend('/{}/'.format(d) for d in cone)
+    path = get_repository(repo).git_path('info', 'sparse-checkout')
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    write_file(path, ('\n'.join(lines) + '\n').encode())
+
+
+def outside_sparse_cone(dir_path, cone):
+    """Return True if directory with given path (no trailing slash) is
+    wholly outside the sparse-checkout cone, in other words neither in nor
+    above one of its directories.
+    """
+    return not any(dir_path == d or dir_path.startswith(d + '/') or
+                   d.startswith(dir_path + '/') for d in cone)
+
+
+def find_sparse_dir(path, cone):
+    """Return path (with trailing slash) of the outermost directory
+    containing path that's outside the sparse-checkout cone, or None if
+    path is in the cone.
+    """
+    parts = path.rstrip('/').split('/')
+    for i in range(1, len(parts)):
+        dir_path = '/'.join(parts[:i])
+        if outside_sparse_cone(dir_path, cone):
+            return dir_path + '/'
+    return None
+
+
+def make_sparse_dir_entry(path, tree_sha1):
+    """Return sparse-directory IndexEntry for directory path (with trailing
+    slash) pointing at tree with given SHA-1 hex string.
+    """
+    flags = min(len(path.encode()), 0xfff) | INDEX_SKIP_WORKTREE
+    return IndexEntry(0, 0, 0, 0, 0, 0, 0o40000, 0, 0, 0,
+                      bytes.fromhex(tree_sha1), flags, path)
+
+
+def expand_sparse_index(entries, repo='.'):
+    """Return list of IndexEntry objects with every sparse-directory entry
+    replaced by entries for the files in its tree (marked skip-worktree).
+    """
+    expanded = []
+    for entry in entries:
+        if not stat.S_ISDIR(entry.mode):
+            expanded.append(entry)
+            continue
+        files = read_tree_recursive(entry.sha1.hex(), prefix=entry.path,
+                                    repo=repo)
+        for path, (mode, sha1) in files.items():
+            flags = min(len(path.encode()), 0xfff) | INDEX_SKIP_WORKTREE
+            expanded.append(IndexEntry(0, 0, 0, 0, 0, 0, mode, 0, 0, 0,
+                                       bytes.fromhex(sha1), flags, path))
+    expanded.sort(key=operator.attrgetter('path'))
+    return expanded
+
+
+def collapse_sparse_index(entries, cone, repo='.'):
+    """Return list of IndexEntry objects with the entries under each
+    directory outside the sparse-checkout cone replaced by one
+    sparse-directory entry for its tree.
+    """
+    groups = collections.OrderedDict()
+    collapsed = []
+    for entry in entries:
+        dir_path = find_sparse_dir(entry.path, cone)
+        if dir_path is None:
+            collapsed.append(entry)
+        else:
+            groups.setdefault(dir_path, []).append(
+                    entry._replace(path=entry.path[len(dir_path):]))
+    for dir_path, group in groups.items():
+        collapsed.append(make_sparse_dir_entry(
+                dir_path, write_tree_entries(group, repo=repo)))
+    collapsed.sort(key=operator.attrgetter('path'))
+    return collapsed
+
+
+def sparse_checkout(dirs, repo='.'):
+    """Limit the working copy to the cone of given directories: every file
+    under them, plus files directly inside their parent directories and at
+    the top level. If dirs is None, sparse checkout is disabled and every
+    file is checked out again. Directories outside the cone are collapsed
+    into single sparse-directory index entries, so the index and status
+    scale with the cone rather than the whole repo. Raise ValueError if a
+    file to be removed has local changes. Return tuple of (written_paths,
+    removed_paths).
+    """
+    import concurrent.futures
+    repo = get_repository(repo)
+    cone = None
+    if dirs is not None:
+        cone = sorted({d.replace('\\', '/').strip('/') for d in dirs})
+        for dir_path in cone:
+            if not dir_path or '..' in dir_path.split('/'):
+                raise ValueError('invalid sparse-checkout directory '
+                                 '{!r}'.format(dir_path))
+    entries = expand_sparse_index(read_index(repo), repo)
+    to_write = []
+    to_remove = []
+    for entry in entries:
+        in_cone = cone is None or find_sparse_dir(entry.path, cone) is None
+        skipped = entry.flags & INDEX_SKIP_WORKTREE
+        if in_cone and skipped:
+            to_write.append(entry)
+        elif not in_cone and not skipped:
+            to_remove.append(entry)
+
+    conflicts = [e.path for e in to_remove
+                 if os.path.exists(os.path.join(repo.path, e.path)) and
+                    not file_matches_sha1(e.path, e.sha1.hex(), entry=e,
+                                          repo=repo)]
+    if conflicts:
+        raise ValueError('local changes would be removed: {}'.format(
+                ', '.join(conflicts)))
+    for entry in to_remove:
+        full_path = os.path.join(repo.path, entry.path)
+        if os.path.exists(full_path):
+            os.remove(full_path)
+        remove_empty_dirs(os.path.dirname(entry.path), root=repo.path)
+    with concurrent.futures.ThreadPoolExecutor() as executor:
+        new_entries = list(executor.map(
+                lambda e: checkout_file(e.path, e.mode, e.sha1.hex(), repo),
+                to_write))
+
+    written = {e.path for e in new_entries}
+    entries = [e for e in entries if e.path not in written] + new_entries
+    entries.sort(key=operator.attrgetter('path'))
+    if cone is None:
+        repo.set_config('core.sparseCheckout', 'false')
+        repo.set_config('core.sparseCheckoutCone', 'false')
+        repo.set_config('index.sparse', 'false')
+        write_index(entries, repo)
+    else:
+        write_sparse_cone(cone, repo)
+        repo.set_config('core.sparseCheckout', 'true')
+        repo.set_config('core.sparseCheckoutCone', 'true')
+        repo.set_config('index.sparse', 'true')
+        write_index(collapse_sparse_index(entries, cone, repo), repo)
+    return (sorted(written), [e.path for e in to_remove])
+
+
+def check_ref_name(name):
+    """Raise ValueError if name isn't a valid full ref name."""
+    if (not name.startswith('refs/') or name.endswith('/') or
+            name.endswith('.lock') or '..' in name or '//' in name or
+            '@{' in name or any(c in name for c in ' ~^:?*[\\') or
+            any(ord(c) < 32 or ord(c) == 127 for c in name) or
+            any(part.startswith('.') for part in name.split('/'))):
+        raise ValueError('invalid ref name {!r}'.format(name))
+
+
+def read_packed_refs(repo='.'):
+    """Read .git/packed-refs and return PackedRefs tuple."""
+    return get_repository(repo).read_packed_refs()
+
+
+def write_packed_refs(refs, repo='.'):
+    """Write dict of refs (mapping name to SHA-1) to .git/packed-refs,
+    replacing the file atomically.
+    """
+    get_repository(repo).write_packed_refs(refs)
+
+
+def read_ref(name, repo='.'):
+    """Return SHA-1 hex string that ref with given full name (for example
+    "refs/heads/master" or "HEAD") points to, following symbolic refs, or
+    None if there's no such ref. Loose refs take precedence over packed refs.
+    Raise ValueError if name isn't a valid ref name.
+    """
+    return get_repository(repo).read_ref(name)
+
+
+def write_ref(name, sha1, repo='.'):
+    """Point loose ref with given full name at SHA-1 hex string."""
+    get_repository(repo).write_ref(name, sha1)
+
+
+def read_head(repo='.'):
+    """Return full name of branch HEAD refers to, or None if HEAD is
+    detached (points directly at a commit).
+    """
+    return get_repository(repo).read_head()
+
+
+def write_head(name, repo='.'):
+    """Point HEAD at branch with given full ref name."""
+    get_repository(repo).write_head(name)
+
+
+def list_refs(prefix='refs/', repo='.'):
+    """Return sorted list of (name, sha1) tuples for refs whose names start
+    with prefix.
+    """
+    return get_repository(repo).list_refs(prefix)
+
+
+def pack_refs(repo='.'):
+    """Move all loose refs into .git/packed-refs and remove the loose files,
+    return number of refs packed.
+    """
+    return get_repository(repo).pack_refs()
+
+
+def resolve_ref_name(name, repo='.'):
+    """Return full ref name for given short or full name ("master",
+    "heads/master", "refs/heads/master", "HEAD"), using git's lookup order,
+    or None if no such ref exists. Raise ValueError if name can't be part of
+    a valid ref name (for example if it has ".." in it).
+    """
+    repo = get_repository(repo)
+    candidates = [name, 'refs/' + name, 'refs/tags/' + name,
+                  'refs/heads/' + name, 'refs/remotes/' + name]
+    for candidate in candidates:
+        if candidate != 'HEAD' and not candidate.startswith('refs/'):
+            continue
+        if candidate != 'HEAD':
+            check_ref_name(candidate)
+        if read_ref(candidate, repo) is not None:
+            return candidate
+    return None
+
+
+def sha1_from_prefix(sha1_prefix, repo='.'):
+    """Return full SHA-1 hex string of object with given SHA-1 prefix, or
+    raise ValueError if not found or ambiguous.
+    """
+    return find_object(sha1_prefix, repo)
+
+
+def resolve_rev(rev, repo='.'):
+    """Return commit SHA-1 hex string for given ref name or SHA-1 prefix,
+    or raise ValueError if it can't be resolved.
+    """
+    repo = get_repository(repo)
+    name = resolve_ref_name(rev, repo)
+    if name is not None:
+        return read_ref(name, repo)
+    return find_object(rev, repo)
+
+
+def get_local_master_hash(repo='.'):
+    """Get current commit hash (SHA-1 string) of local master branch."""
+    return read_ref('refs/heads/master', repo)
+
+
+def create_branch(name, start_point='HEAD', repo='.'):
+    """Create branch with given short name pointing at start_point (ref name
+    or SHA-1 prefix), return its full ref name. Raise ValueError if the
+    branch already exists.
+    """
+    repo = get_repository(repo)
+    ref_name = 'refs/heads/' + name
+    check_ref_name(ref_name)
+    if read_ref(ref_name, repo) is not None:
+        raise ValueError('branch {!r} already exists'.format(name))
+    write_ref(ref_name, resolve_rev(start_point, repo), repo)
+    return ref_name
+
+
+def list_branches(repo='.'):
+    """Print list of local branches, marking the current one with "*"."""
+    repo = get_repository(repo)
+    head = read_head(repo)
+    for name, sha1 in list_refs('refs/heads/', repo):
+        print('{} {} {:7}'.format('*' if name == head else ' ',
+                                  name[len('refs/heads/'):], sha1))
+
+
+def commit(message, author=None, repo='.'):
+    """Commit the current state of repo's index to the current branch with
+    given message. Return hash of commit object.
+    """
+    repo = get_repository(repo)
+    tree = write_tree(repo)
+    head = read_head(repo)
+    parent = read_ref(head or 'HEAD', repo)
+    if author is None:
+        author = '{} <{}>'.format(
+                os.environ['GIT_AUTHOR_NAME'], os.environ['GIT_AUTHOR_EMAIL'])
+    timestamp = int(time.mktime(time.localtime()))
+    utc_offset = -time.timezone
+    author_time = '{} {}{:02}{:02}'.format(
+            timestamp,
+            '+' if utc_offset > 0 else '-',
+            abs(utc_offset) // 3600,
+            (abs(utc_offset) // 60) % 60)
+    lines = ['tree ' + tree]
+    if parent:
+        lines.append('parent ' + parent)
+    lines.append('author {} {}'.format(author, author_time))
+    lines.append('committer {} {}'.format(author, author_time))
+    lines.append('')
+    lines.append(message)
+    lines.append('')
+    data = '\n'.join(lines).encode()
+    sha1 = hash_object(data, 'commit', repo=repo)
+    write_changed_paths(sha1, tree, parent, repo=repo)
+    if head is None:
+        write_file(repo.git_path('HEAD'), (sha1 + '\n').encode())
+    else:
+        write_ref(head, sha1, repo)
+    print('committed to {}: {:7}'.format(
+            head[len('refs/heads/'):] if head else 'detached HEAD', sha1))
+    return sha1
+
+
+def read_commit_tree(commit_sha1, repo='.'):
+    """Read commit with given SHA-1 (or prefix) and return SHA-1 hex string
+    of its tree, or raise ValueError if it's not a commit.
+    """
+    obj_type, data = read_object(commit_sha1, repo)
+    if obj_type != 'commit':
+        raise ValueError('expected object type commit, got {}'.format(
+                obj_type))
+    first_line = data.split(b'\n', 1)[0].decode()
+    assert first_line.startswith('tree '), \
+            'invalid commit {!r}'.format(commit_sha1)
+    return first_line[5:45]
+
+
+def read_tree_recursive(tree_sha1, prefix='', cone=None, repo='.'):
+    """Read tree with given SHA-1 and all its subtrees, return dict mapping
+    full path of each file to (mode, sha1) tuple. If a sparse-checkout cone
+    is given, subtrees outside it aren't read but appear as a single
+    "dir/" path with the subtree's mode and SHA-1.
+    """
+    files = {}
+    for mode, path, sha1 in read_tree(sha1=tree_sha1, repo=repo):
+        if stat.S_ISDIR(mode):
+            if cone is not None and outside_sparse_cone(prefix + path, cone):
+                files[prefix + path + '/'] = (mode, sha1)
+            else:
+                files.update(read_tree_recursive(sha1, prefix + path + '/',
+                                                 cone=cone, repo=repo))
+        else:
+            files[prefix + path] = (mode, sha1)
+    return files
+
+
+def normalize_mode(mode):
+    """Return git tree mode (100644 or 100755) for given file mode."""
+    return 0o100755 if mode & 0o100 else 0o100644
+
+
+def file_matches_sha1(path, sha1, entry=None, repo='.'):
+    """Return True if contents of file at path (in repo's working tree) hash
+    to given SHA-1. If index entry is given and its stat data still matches
+    the file, trust the entry's SHA-1 instead of rehashing the file.
+    """
+    repo = get_repository(repo)
+    path = os.path.join(repo.path, path)
+    st = os.stat(path)
+    if (entry is not None and entry.size == st.st_size & 0xffffffff and
+            entry.mtime_s == int(st.st_mtime) and
+            entry.mtime_n == st.st_mtime_ns % 1000000000):
+        return entry.sha1.hex() == sha1
+    data = read_file(path)
+    return hash_object(data, 'blob', write=False, repo=repo) == sha1
+
+
+def checkout_file(path, mode, sha1, repo='.'):
+    """Write blob with given SHA-1 to path in repo's working copy (creating
+    parent directories as needed) and return a fresh IndexEntry for it.
+    """
+    repo = get_repository(repo)
+    obj_type, data = read_object(sha1, repo)
+    assert obj_type == 'blob', 'expected blob at {}, got {}'.format(
+            path, obj_type)
+    full_path = os.path.join(repo.path, path)
+    os.makedirs(os.path.dirname(full_path), exist_ok=True)
+    write_file(full_path, data)
+    st = os.stat(full_path)
+    file_mode = st.st_mode | 0o111 if mode == 0o100755 else \
+                st.st_mode & ~0o111
+    if file_mode != st.st_mode:
+        os.chmod(full_path, stat.S_IMODE(file_mode))
+        st = os.stat(full_path)
+    return make_index_entry(path, st, sha1, mode=mode)
+
+
+def remove_empty_dirs(dir_path, root='.'):
+    """Remove directory at dir_path (relative to root) and its parents while
+    they're empty.
+    """
+    while dir_path:
+        try:
+            os.rmdir(os.path.join(root, dir_path))
+        except OSError:
+            break
+        dir_path = os.path.dirname(dir_path)
+
+
+def checkout(rev, repo='.'):
+    """Update index and working copy to match the tree of given commit (ref
+    name or SHA-1 prefix), like "git read-tree -u -m". Only files whose SHA-1
+    or mode differ from the index are written, and they're inflated and
+    written on a thread pool. If rev is a branch, HEAD is switched to it;
+    otherwise HEAD is detached at the commit. Raise ValueError if local
+    changes would be overwritten. Return tuple of (written_paths,
+    deleted_paths). With sparse checkout enabled, only the cone is written
+    and directories outside it become sparse-directory index entries
+    without being read.
+    """
+    import concurrent.futures
+    repo = get_repository(repo)
+    ref_name = resolve_ref_name(rev, repo)
+    if ref_name is not None:
+        commit_sha1 = read_ref(ref_name, repo)
+    else:
+        commit_sha1 = find_object(rev, repo)
+    target = read_tree_recursive(read_commit_tree(commit_sha1, repo),
+                                 cone=read_sparse_cone(repo), repo=repo)
+    sparse_entries = [make_sparse_dir_entry(path, sha1)
+                      for path, (mode, sha1) in target.items()
+                      if path.endswith('/')]
+    target = {path: value for path, value in target.items()
+              if not path.endswith('/')}
+    entries_by_path = {e.path: e for e in read_index(repo)
+                       if not stat.S_ISDIR(e.mode)}
+    to_write = sorted(
+            path for path, (mode, sha1) in target.items()
+            if path not in entries_by_path or
+               entries_by_path[path].sha1.hex() != sha1 or
+               normalize_mode(entries_by_path[path].mode) != mode)
+    to_delete = sorted(set(entries_by_path) - set(target))
+
+    conflicts = []
+    for path in to_write + to_delete:
+        if not os.path.exists(os.path.join(repo.path, path)):
+            continue
+        entry = entries_by_path.get(path)
+        expected = entry.sha1.hex() if entry is not None else target[path][1]
+        if not file_matches_sha1(path, expected, entry=entry, repo=repo):
+            conflicts.append(path)
+    if conflicts:
+        raise ValueError('local changes would be overwritten: {}'.format(
+                ', '.join(conflicts)))
+
+    for path in to_delete:
+        full_path = os.path.join(repo.path, path)
+        if os.path.exists(full_path):
+            os.remove(full_path)
+        remove_empty_dirs(os.path.dirname(path), root=repo.path)
+    with concurrent.futures.ThreadPoolExecutor() as executor:
+        new_entries = list(executor.map(
+                lambda path: checkout_file(path, *target[path], repo=repo),
+                to_write))
+
+    written = set(to_write)
+    entries = [e for e in entries_by_path.values()
+               if e.path in target and e.path not in written]
+    entries.extend(new_entries)
+    entries.extend(sparse_entries)
+    entries.sort(key=operator.attrgetter('path'))
+    write_index(entries, repo)
+    if ref_name is not None and ref_name.startswith('refs/heads/'):
+        write_head(ref_name, repo)
+    else:
+        write_file(repo.git_path('HEAD'), (commit_sha1 + '\n').encode())
+    return (to_write, to_delete)
+
+
+def add_tree_to_archive(tar, tree_sha1, prefix, mtime, repo='.'):
+    """Add members for every entry of tree with given SHA-1 (recursively)
+    to tarfile tar, streaming blob data into the archive as it's inflated.
+    """
+    import tarfile
+    for mode, path, sha1 in read_tree(sha1=tree_sha1, repo=repo):
+        if mode == 0o160000:
+            continue
+        tarinfo = tarfile.TarInfo(prefix + path)
+        tarinfo.mtime = mtime
+        tarinfo.uname = tarinfo.gname = 'root'
+        if stat.S_ISDIR(mode):
+            tarinfo.type = tarfile.DIRTYPE
+            tarinfo.mode = 0o755
+            tar.addfile(tarinfo)
+            add_tree_to_archive(tar, sha1, prefix + path + '/', mtime,
+                                repo)
+        elif stat.S_ISLNK(mode):
+            tarinfo.type = tarfile.SYMTYPE
+            tarinfo.mode = 0o777
+            tarinfo.linkname = read_object(sha1, repo)[1].decode()
+            tar.addfile(tarinfo)
+        else:
+            with ObjectReader(sha1, repo) as reader:
+                tarinfo.size = reader.size
+                tarinfo.mode = 0o755 if mode & 0o100 else 0o644
+                tar.addfile(tarinfo, reader)
+
+
+def archive(rev, output_file, archive_format='tar', repo='.'):
+    """Write the tree of given commit (ref name or SHA-1 prefix) to
+    output_file as a tar archive, gzipped if archive_format is 'tgz'. The
+    archive is written in tarfile's streaming mode straight from the object
+    store, without a working copy; members get their tree mode and the
+    commit's time as mtime.
+    """
+    import tarfile
+    if archive_format not in ['tar', 'tgz']:
+        raise ValueError('unknown archive format {!r}'.format(archive_format))
+    repo = get_repository(repo)
+    commit_sha1 = resolve_rev(rev, repo)
+    info = read_commit_info(commit_sha1, repo)
+    mode = 'w|gz' if archive_format == 'tgz' else 'w|'
+    with tarfile.open(fileobj=output_file, mode=mode,
+                      format=tarfile.PAX_FORMAT,
+                      pax_headers={'comment': commit_sha1}) as tar:
+        add_tree_to_archive(tar, info.tree, '', info.timestamp, repo)
+
+
+def grep_blob(regex, sha1, repo='.'):
+    """Return list of (line_number, line) tuples for lines of blob with
+    given SHA-1 that match compiled bytes regex (at most one per line), or
+    None if the blob looks binary (has a NUL byte in its first 8000 bytes).
+    """
+    obj_type, data = read_object(sha1, repo)
+    if b'\x00' in data[:8000]:
+        return None
+    matches = []
+    line_number = 1
+    counted_to = 0
+    pos = 0
+    while True:
+        match = regex.search(data, pos)
+        if match is None:
+            break
+        line_start = data.rfind(b'\n', 0, match.start()) + 1
+        line_end = data.find(b'\n', match.start())
+        if line_end == -1:
+            line_end = len(data)
+        line_number += data.count(b'\n', counted_to, line_start)
+        counted_to = line_start
+        matches.append((line_number, data[line_start:line_end]))
+        pos = line_end + 1
+        if pos >= len(data):
+            break
+    return matches
 
 
-def ls_files(details=False):
-    """Print list of files in index (including mode, SHA-1, and stage number
-    if "details" is True).
+def grep(pattern, rev='HEAD', ignore_case=False, repo='.'):
+    """Search files in the tree of given commit (ref name or SHA-1 prefix)
+    for lines matching regex pattern, without a working copy. Blobs are
+    inflated and searched on a thread pool, and binary files are skipped.
+    Yield (path, line_number, line) tuples in path order as soon as each
+    file's results are ready.
     """
-    for entry in read_index():
-        if details:
-            stage = (entry.flags >> 12) & 3
-            print('{:6o} {} {:}\t{}'.format(
-                    entry.mode, entry.sha1.hex(), stage, entry.path))
+    import concurrent.futures
+    flags = re.MULTILINE | (re.IGNORECASE if ignore_case else 0)
+    regex = re.compile(pattern.encode(), flags)
+    repo = get_repository(repo)
+    files = read_tree_recursive(read_commit_tree(resolve_rev(rev, repo), repo),
+                                repo=repo)
+    paths = sorted(path for path, (mode, sha1) in files.items()
+                   if stat.S_ISREG(mode))
+    with concurrent.futures.ThreadPoolExecutor() as executor:
+        results = executor.map(
+                lambda path: grep_blob(regex, files[path][1], repo), paths)
+        for path, matches in zip(paths, results):
+            for line_number, line in matches or []:
+                yield (path, line_number, line)
+
+
+def read_path_sha1s(tree_sha1, path, known=None, blob_only=False,
+                    repo='.'):
+    """Return list of SHA-1 hex strings along path in given tree: the tree
+    itself, each subtree, then the path's own blob (or tree). Return None if
+    path doesn't exist, or if blob_only is True and path isn't a file or
+    symlink. If known (the result for the same path in another tree) is
+    given, return it as soon as a subtree matches, without reading further
+    trees.
+    """
+    parts = path.split('/')
+    sha1s = [tree_sha1]
+    for i, part in enumerate(parts):
+        if known is not None and known[i] == sha1s[i]:
+            return known
+        for mode, name, sha1 in read_tree(sha1=sha1s[i], repo=repo):
+            if name == part:
+                if i < len(parts) - 1 and not stat.S_ISDIR(mode):
+                    return None
+                if (i == len(parts) - 1 and blob_only and
+                        not stat.S_ISREG(mode) and not stat.S_ISLNK(mode)):
+                    return None
+                sha1s.append(sha1)
+                break
         else:
-            print(entry.path)
+            return None
+    return sha1s
 
 
-def get_status():
-    """Get status of working copy, return tuple of (changed_paths, new_paths,
-    deleted_paths).
+def read_blob_lines(sha1, repo='.'):
+    """Read blob with given SHA-1 and return list of its lines (as bytes,
+    including line endings).
     """
-    paths = set()
-    for root, dirs, files in os.walk('.'):
-        dirs[:] = [d for d in dirs if d != '.git']
-        for file in files:
-            path = os.path.join(root, file)
-            path = path.replace('\\', '/')
-            if path.startswith('./'):
-                path = path[2:]
-            paths.add(path)
-    entries_by_path = {e.path: e for e in read_index()}
-    entry_paths = set(entries_by_path)
-    changed = {p for p in (paths & entry_paths)
-               if hash_object(read_file(p), 'blob', write=False) !=
-                  entries_by_path[p].sha1.hex()}
-    new = paths - entry_paths
-    deleted = entry_paths - paths
-    return (sorted(changed), sorted(new), sorted(deleted))
+    obj_type, data = read_object(sha1, repo)
+    assert obj_type == 'blob', 'expected blob, got {}'.format(obj_type)
+    return data.splitlines(keepends=True)
 
 
-def status():
-    """Show status of working copy."""
-    changed, new, deleted = get_status()
-    if changed:
-        print('changed files:')
-        for path in changed:
-            print('   ', path)
-    if new:
-        print('new files:')
-        for path in new:
-            print('   ', path)
-    if deleted:
-        print('deleted files:')
-        for path in deleted:
-            print('   ', path)
+def split_blame_entries(entries, parent_lines, lines):
+    """Split blame entries (final_start, start, count) for lines by the line
+    ranges that are unchanged from parent_lines. Return tuple of (passed,
+    remaining), where passed entries are renumbered to parent line numbers.
+    """
+    import difflib
+    matcher = difflib.SequenceMatcher(None, parent_lines, lines,
+                                      autojunk=False)
+    blocks = matcher.get_matching_blocks()
+    passed = []
+    remaining = []
+    for final_start, start, count in entries:
+        pos = start
+        end = start + count
+        for parent_start, block_start, size in blocks:
+            if block_start + size <= pos:
+                continue
+            if block_start >= end:
+                break
+            match_start = max(pos, block_start)
+            match_end = min(end, block_start + size)
+            if match_start > pos:
+                remaining.append((final_start + pos - start, pos,
+                                  match_start - pos))
+            passed.append((final_start + match_start - start,
+                           parent_start + match_start - block_start,
+                           match_end - match_start))
+            pos = match_end
+        if pos < end:
+            remaining.append((final_start + pos - start, pos, end - pos))
+    return (passed, remaining)
 
 
-def diff():
-    """Show diff of files changed (between index and working copy)."""
-    changed, _, _ = get_status()
-    entries_by_path = {e.path: e for e in read_index()}
-    for i, path in enumerate(changed):
-        sha1 = entries_by_path[path].sha1.hex()
-        obj_type, data = read_object(sha1)
-        assert obj_type == 'blob'
-        index_lines = data.decode().splitlines()
-        working_lines = read_file(path).decode().splitlines()
-        diff_lines = difflib.unified_diff(
-                index_lines, working_lines,
-                '{} (index)'.format(path),
-                '{} (working copy)'.format(path),
-                lineterm='')
-        for line in diff_lines:
-            print(line)
-        if i < len(changed) - 1:
-            print('-' * 70)
+def blame(path, rev='HEAD', repo='.'):
+    """Attribute each line of file at path (as of given commit) to the
+    commit that last changed it. Yield (commit_sha1, orig_line, final_line,
+    num_lines) tuples (1-based line numbers) as soon as each line range is
+    attributed, walking history newest first. Commits whose tree has the
+    same blob SHA-1 at path as their child are passed through without a
+    diff; a line diff only runs when the blob actually changed.
+    """
+    repo = get_repository(repo)
+    commit_sha1 = resolve_rev(rev, repo)
+    info = read_commit_info(commit_sha1, repo)
+    path_sha1s = read_path_sha1s(info.tree, path, blob_only=True, repo=repo)
+    if path_sha1s is None:
+        raise ValueError('path {!r} not in {}'.format(path, rev))
+    lines = read_blob_lines(path_sha1s[-1], repo)
+    if not lines:
+        return
 
+    # Map of suspect commit to (info, path_sha1s, lines, entries), plus a
+    # heap to visit suspects newest first
+    pending = {commit_sha1: (info, path_sha1s, lines,
+                             [(0, 0, len(lines))])}
+    heap = [(-info.timestamp, commit_sha1)]
+    while heap:
+        _, commit_sha1 = heapq.heappop(heap)
+        info, path_sha1s, lines, entries = pending.pop(commit_sha1)
+        parents = []
+        for parent_sha1 in info.parents:
+            parent_info = read_commit_info(parent_sha1, repo)
+            parent_path_sha1s = read_path_sha1s(
+                    parent_info.tree, path, known=path_sha1s,
+                    blob_only=True, repo=repo)
+            if parent_path_sha1s is None:
+                continue
+            if parent_path_sha1s[-1] == path_sha1s[-1]:
+                parents = [(parent_sha1, parent_info, parent_path_sha1s,
+                            lines, entries)]
+                entries = []
+                break
+            parents.append((parent_sha1, parent_info, parent_path_sha1s,
+                            None, None))
 
-def write_index(entries):
-    """Write list of IndexEntry objects to git index file."""
-    packed_entries = []
-    for entry in entries:
-        entry_head = struct.pack('!LLLLLLLLLL20sH',
-                entry.ctime_s, entry.ctime_n, entry.mtime_s, entry.mtime_n,
-                entry.dev, entry.ino, entry.mode, entry.uid, entry.gid,
-                entry.size, entry.sha1, entry.flags)
-        path = entry.path.encode()
-        length = ((62 + len(path) + 8) // 8) * 8
-        packed_entry = entry_head + path + b'\x00' * (length - 62 - len(path))
-        packed_entries.append(packed_entry)
-    header = struct.pack('!4sLL', b'DIRC', 2, len(entries))
-    all_data = header + b''.join(packed_entries)
-    digest = hashlib.sha1(all_data).digest()
-    write_file(os.path.join('.git', 'index'), all_data + digest)
+        passed_to = []
+        for parent_sha1, parent_info, parent_path_sha1s, parent_lines, \
+                passed in parents:
+            if passed is None:
+                if not entries:
+                    break
+                parent_lines = read_blob_lines(parent_path_sha1s[-1], repo)
+                passed, entries = split_blame_entries(
+                        entries, parent_lines, lines)
+            if passed:
+                passed_to.append((parent_sha1, parent_info,
+                                  parent_path_sha1s, parent_lines, passed))
 
+        for final_start, start, count in sorted(entries):
+            yield (commit_sha1, start + 1, final_start + 1, count)
+        for parent_sha1, parent_info, parent_path_sha1s, parent_lines, \
+                passed in passed_to:
+            if parent_sha1 in pending:
+                pending[parent_sha1][3].extend(passed)
+            else:
+                pending[parent_sha1] = (parent_info, parent_path_sha1s,
+                                        parent_lines, passed)
+                heapq.heappush(heap, (-parent_info.timestamp, parent_sha1))
 
-def add(paths):
-    """Add all file paths to git index."""
-    paths = [p.replace('\\', '/') for p in paths]
-    all_entries = read_index()
-    entries = [e for e in all_entries if e.path not in paths]
+
+# Changed-path Bloom filter parameters (same as git's commit-graph defaults)
+BLOOM_NUM_HASHES = 7
+BLOOM_BITS_PER_PATH = 10
+BLOOM_MAX_PATHS = 512
+
+
+def diff_tree_paths(tree_sha1, parent_tree_sha1, paths, prefix='',
+                    repo='.'):
+    """Add to set of paths every path (including leading directories) whose
+    entry differs between tree and parent tree (either may be None).
+    Identical subtrees aren't read. Stop early once more than
+    BLOOM_MAX_PATHS paths have been found.
+    """
+    if tree_sha1 == parent_tree_sha1:
+        return
+    entries = {}
+    if tree_sha1 is not None:
+        entries = {path: (mode, sha1) for mode, path, sha1
+                   in read_tree(sha1=tree_sha1, repo=repo)}
+    parent_entries = {}
+    if parent_tree_sha1 is not None:
+        parent_entries = {path: (mode, sha1)
+                          for mode, path, sha1 in read_tree(
+                                  sha1=parent_tree_sha1, repo=repo)}
+    for name in sorted(entries.keys() | parent_entries.keys()):
+        entry = entries.get(name)
+        parent_entry = parent_entries.get(name)
+        if entry == parent_entry:
+            continue
+        paths.add(prefix + name)
+        if len(paths) > BLOOM_MAX_PATHS:
+            return
+        subtree = entry[1] if entry and stat.S_ISDIR(entry[0]) else None
+        parent_subtree = parent_entry[1] if parent_entry and \
+                stat.S_ISDIR(parent_entry[0]) else None
+        if subtree is not None or parent_subtree is not None:
+            diff_tree_paths(subtree, parent_subtree, paths,
+                            prefix + name + '/', repo=repo)
+
+
+def bloom_positions(path, num_bits):
+    """Return list of bit positions for path in a filter of num_bits bits
+    (double hashing over a 64-bit BLAKE2 digest).
+    """
+    digest = hashlib.blake2b(path.encode(), digest_size=8).digest()
+    h1, h2 = struct.unpack('<LL', digest)
+    return [(h1 + i * h2) % num_bits for i in range(BLOOM_NUM_HASHES)]
+
+
+def make_bloom_filter(paths):
+    """Return Bloom filter bytes for given set of changed paths. Too many
+    paths give a filter with every bit set (path may always be present).
+    """
+    if len(paths) > BLOOM_MAX_PATHS:
+        return b'\xff'
+    num_bytes = max(1, (len(paths) * BLOOM_BITS_PER_PATH + 7) // 8)
+    bloom = bytearray(num_bytes)
     for path in paths:
-        sha1 = hash_object(read_file(path), 'blob')
-        st = os.stat(path)
-        flags = len(path.encode())
-        assert flags < (1 << 12)
-        entry = IndexEntry(
-                int(st.st_ctime), 0, int(st.st_mtime), 0, st.st_dev,
-                st.st_ino, st.st_mode, st.st_uid, st.st_gid, st.st_size,
-                bytes.fromhex(sha1), flags, path)
-        entries.append(entry)
-    entries.sort(key=operator.attrgetter('path'))
-    write_index(entries)
+        for pos in bloom_positions(path, num_bytes * 8):
+            bloom[pos >> 3] |= 1 << (pos & 7)
+    return bytes(bloom)
 
 
-def write_tree():
-    """Write a tree object from the current index entries."""
-    tree_entries = []
-    for entry in read_index():
-        assert '/' not in entry.path, \
-                'currently only supports a single, top-level directory'
-        mode_path = '{:o} {}'.format(entry.mode, entry.path).encode()
-        tree_entry = mode_path + b'\x00' + entry.sha1
-        tree_entries.append(tree_entry)
-    return hash_object(b''.join(tree_entries), 'tree')
+def bloom_may_contain(bloom, path):
+    """Return False if path is definitely not in Bloom filter bytes."""
+    return all(bloom[pos >> 3] & (1 << (pos & 7))
+               for pos in bloom_positions(path, len(bloom) * 8))
 
 
-def get_local_master_hash():
-    """Get current commit hash (SHA-1 string) of local master branch."""
-    master_path = os.path.join('.git', 'refs', 'heads', 'master')
+def read_changed_paths(repo='.'):
+    """Read .git/objects/info/changed-paths and return ChangedPaths tuple."""
+    return get_repository(repo).read_changed_paths()
+
+
+def write_changed_paths(commit_sha1, tree_sha1, parent_sha1, repo='.'):
+    """Compute the changed-path Bloom filter of a commit (against its first
+    parent) and append it to .git/objects/info/changed-paths, holding
+    changed-paths.lock meanwhile so concurrent commits don't interleave.
+    """
+    repo = get_repository(repo)
+    parent_tree_sha1 = None
+    if parent_sha1 is not None:
+        parent_tree_sha1 = read_commit_info(parent_sha1, repo).tree
+    paths = set()
+    diff_tree_paths(tree_sha1, parent_tree_sha1, paths, repo=repo)
+    bloom = make_bloom_filter(paths)
+    path = repo.git_path('objects', 'info', 'changed-paths')
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    open(path + '.lock', 'xb').close()
     try:
-        return read_file(master_path).decode().strip()
-    except FileNotFoundError:
-        return None
+        with open(path, 'ab') as f:
+            if f.tell() == 0:
+                f.write(struct.pack('!4sL', b'PCPB', 1))
+            f.write(bytes.fromhex(commit_sha1) +
+                    struct.pack('!L', len(bloom)) + bloom)
+    finally:
+        os.remove(path + '.lock')
 
 
-def commit(message, author=None):
-    """Commit the current state of the index to master with given message.
-    Return hash of commit object.
+def log(rev='HEAD', path=None, repo='.'):
+    """Yield (commit_sha1, CommitInfo) tuples for commits reachable from
+    rev, newest first. If path is given, only yield commits where path
+    differs from their first parent. Commits whose changed-path Bloom filter
+    rules path out are skipped without reading any trees. Commits with the
+    same timestamp come out in the order they were reached, so a child is
+    still listed before its parent.
     """
-    tree = write_tree()
-    parent = get_local_master_hash()
-    if author is None:
-        author = '{} <{}>'.format(
-                os.environ['GIT_AUTHOR_NAME'], os.environ['GIT_AUTHOR_EMAIL'])
-    timestamp = int(time.mktime(time.localtime()))
-    utc_offset = -time.timezone
-    author_time = '{} {}{:02}{:02}'.format(
-            timestamp,
-            '+' if utc_offset > 0 else '-',
-            abs(utc_offset) // 3600,
-            (abs(utc_offset) // 60) % 60)
-    lines = ['tree ' + tree]
-    if parent:
-        lines.append('parent ' + parent)
-    lines.append('author {} {}'.format(author, author_time))
-    lines.append('committer {} {}'.format(author, author_time))
-    lines.append('')
-    lines.append(message)
-    lines.append('')
-    data = '\n'.join(lines).encode()
-    sha1 = hash_object(data, 'commit')
-    master_path = os.path.join('.git', 'refs', 'heads', 'master')
-    write_file(master_path, (sha1 + '\n').encode())
-    print('committed to master: {:7}'.format(sha1))
-    return sha1
+    repo = get_repository(repo)
+    if path is not None:
+        path = path.strip('/')
+        filters = read_changed_paths(repo).filters
+    commit_sha1 = resolve_rev(rev, repo)
+    infos = {commit_sha1: read_commit_info(commit_sha1, repo)}
+    heap = [(-infos[commit_sha1].timestamp, 0, commit_sha1)]
+    seen = {commit_sha1}
+    while heap:
+        _, _, commit_sha1 = heapq.heappop(heap)
+        info = infos.pop(commit_sha1)
+        for parent_sha1 in info.parents:
+            if parent_sha1 not in seen:
+                seen.add(parent_sha1)
+                infos[parent_sha1] = read_commit_info(parent_sha1, repo)
+                heapq.heappush(heap, (-infos[parent_sha1].timestamp,
+                                      len(seen), parent_sha1))
+        if path is None:
+            yield (commit_sha1, info)
+            continue
+        bloom = filters.get(commit_sha1)
+        if bloom is not None and not bloom_may_contain(bloom, path):
+            continue
+        path_sha1s = read_path_sha1s(info.tree, path, repo=repo)
+        parent_path_sha1s = None
+        if info.parents:
+            parent_info = infos.get(info.parents[0]) or \
+                          read_commit_info(info.parents[0], repo)
+            parent_path_sha1s = read_path_sha1s(parent_info.tree, path,
+                                                known=path_sha1s, repo=repo)
+        if (path_sha1s and path_sha1s[-1]) != \
+                (parent_path_sha1s and parent_path_sha1s[-1]):
+            yield (commit_sha1, info)
 
 
 def extract_lines(data):
-    """Extract list of lines from given server data."""
+    """Extract list of lines from given server data. Flush, delimiter and
+    response-end packets give empty lines.
+    """
     lines = []
     i = 0
-    for _ in range(1000):
+    while True:
         line_length = int(data[i:i + 4], 16)
         line = data[i + 4:i + line_length]
         lines.append(line)
-        if line_length == 0:
+        if line_length < 4:
             i += 4
         else:
             i += line_length
@@ -346,47 +3560,122 @@ def build_lines_data(lines):
     return b''.join(result)
 
 
-def http_request(url, username, password, data=None):
+def build_command_data(command, args):
+    """Build byte string for a protocol v2 command request: the command
+    line, a delimiter packet, one line per argument, and a flush packet.
+    """
+    result = build_lines_data(['command={}'.format(command).encode()])
+    return (result[:-4] + b'0001' +
+            build_lines_data([arg.encode() for arg in args]))
+
+
+def http_request(url, username, password, data=None, headers=None):
     """Make an authenticated HTTP request to given URL (GET by default, POST
-    if "data" is not None).
+    if "data" is not None), with optional dict of extra headers.
     """
+    import urllib.request
     password_manager = urllib.request.HTTPPasswordMgrWithDefaultRealm()
     password_manager.add_password(None, url, username, password)
     auth_handler = urllib.request.HTTPBasicAuthHandler(password_manager)
     opener = urllib.request.build_opener(auth_handler)
-    f = opener.open(url, data=data)
+    request = urllib.request.Request(url, data=data, headers=headers or {})
+    f = opener.open(request)
     return f.read()
 
 
-def get_remote_master_hash(git_url, username, password):
-    """Get commit hash of remote master branch, return SHA-1 hex string or
-    None if no remote commits.
+def parse_ref_advertisement(lines):
+    """Parse lines of a protocol v0 ref advertisement (after the service
+    header), return dict mapping full ref name to SHA-1 hex string.
+    """
+    refs = {}
+    for line in lines:
+        if not line:
+            break
+        sha1, name = line.split(b'\x00')[0].split()
+        assert len(sha1) == 40
+        if sha1 != b'0' * 40:
+            refs[name.decode()] = sha1.decode()
+    return refs
+
+
+def get_remote_refs(git_url, username, password):
+    """Get refs advertised by remote, return dict mapping full ref name to
+    SHA-1 hex string (empty if there are no remote commits).
     """
     url = git_url + '/info/refs?service=git-receive-pack'
     response = http_request(url, username, password)
     lines = extract_lines(response)
     assert lines[0] == b'# service=git-receive-pack\n'
     assert lines[1] == b''
-    if lines[2][:40] == b'0' * 40:
-        return None
-    master_sha1, master_ref = lines[2].split(b'\x00')[0].split()
-    assert master_ref == b'refs/heads/master'
-    assert len(master_sha1) == 40
-    return master_sha1.decode()
+    return parse_ref_advertisement(lines[2:])
+
+
+def ls_remote_refs(git_url, username, password, ref_prefixes):
+    """Get remote refs whose names start with one of ref_prefixes, return
+    dict mapping full ref name to SHA-1 hex string. Protocol v2 "ls-refs"
+    is used so the server only sends the refs asked for; a server that
+    only speaks v0 replies to the first request with its full ref
+    advertisement, which is filtered here instead.
+    """
+    headers = {'Git-Protocol': 'version=2'}
+    url = git_url + '/info/refs?service=git-upload-pack'
+    lines = extract_lines(http_request(url, username, password,
+                                       headers=headers))
+    if lines[0].startswith(b'# service='):
+        lines = lines[2:]
+    if lines[0] != b'version 2\n':
+        refs = parse_ref_advertisement(lines)
+    else:
+        capabilities = [line.rstrip(b'\n').split(b'=')[0]
+                        for line in lines[1:] if line]
+        if b'ls-refs' not in capabilities:
+            refs = get_remote_refs(git_url, username, password)
+        else:
+            args = ['ref-prefix {}'.format(p) for p in ref_prefixes]
+            headers['Content-Type'] = 'application/x-git-upload-pack-request'
+            response = http_request(git_url + '/git-upload-pack', username,
+                                    password,
+                                    data=build_command_data('ls-refs', args),
+                                    headers=headers)
+            refs = {}
+            for line in extract_lines(response):
+                if not line:
+                    break
+                sha1, name = line.rstrip(b'\n').split()[:2]
+                refs[name.decode()] = sha1.decode()
+    return {name: sha1 for name, sha1 in refs.items()
+            if any(name.startswith(p) for p in ref_prefixes)}
+
+
+def get_remote_hash(git_url, username, password, ref_name):
+    """Get commit hash of given remote ref (as advertised for fetching),
+    return SHA-1 hex string or None if the remote doesn't have it. Pushes
+    use get_remote_refs instead, so the old SHA-1 comes from the
+    receive-pack endpoint being updated.
+    """
+    return ls_remote_refs(git_url, username, password, [ref_name]).get(
+            ref_name)
+
+
+def get_remote_master_hash(git_url, username, password):
+    """Get commit hash of remote master branch, return SHA-1 hex string or
+    None if no remote commits.
+    """
+    return get_remote_hash(git_url, username, password, 'refs/heads/master')
 
 
-def read_tree(sha1=None, data=None):
+def read_tree(sha1=None, data=None, repo='.'):
     """Read tree object with given SHA-1 (hex string) or data, and return list
     of (mode, path, sha1) tuples.
     """
     if sha1 is not None:
-        obj_type, data = read_object(sha1)
+        obj_type, data = read_object(sha1, repo)
         assert obj_type == 'tree'
     elif data is None:
         raise TypeError('must specify "sha1" or "data"')
     i = 0
     entries = []
-    for _ in range(1000):
+    while True:
         end = data.find(b'\x00', i)
         if end == -1:
             break
@@ -398,51 +3687,364 @@ def read_tree(sha1=None, data=None):
     return entries
 
 
-def find_tree_objects(tree_sha1):
+def find_reachable_objects(commit_sha1s=(), tree_sha1s=(),
+                           max_workers=None, repo='.'):
+    """Return set of SHA-1 hashes of given commits and trees and of every
+    object reachable from them. The walk goes a level at a time, and each
+    level's commits and trees are inflated and parsed on a thread pool
+    (zlib releases the GIL), so upcoming objects are being read while
+    earlier ones are processed. Each object is read at most once.
+    """
+    import concurrent.futures
+    repo = get_repository(repo)
+    objects = set(commit_sha1s) | set(tree_sha1s)
+    commits = sorted(set(commit_sha1s))
+    trees = sorted(set(tree_sha1s))
+    with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+        while commits or trees:
+            commit_links = executor.map(
+                    lambda s: read_commit_links(s, repo), commits)
+            tree_entries = executor.map(
+                    lambda s: read_tree(sha1=s, repo=repo), trees)
+            commits = []
+            trees = []
+            for tree, parents in commit_links:
+                if tree not in objects:
+                    objects.add(tree)
+                    trees.append(tree)
+                for parent in parents:
+                    if parent not in objects:
+                        objects.add(parent)
+                        commits.append(parent)
+            for entries in tree_entries:
+                for mode, path, sha1 in entries:
+                    if sha1 in objects:
+                        continue
+                    objects.add(sha1)
+                    if stat.S_ISDIR(mode):
+                        trees.append(sha1)
+    return objects
+
+
+def find_tree_objects(tree_sha1, repo='.'):
     """Return set of SHA-1 hashes of all objects in this tree (recursively),
     including the hash of the tree itself.
     """
-    objects = {tree_sha1}
-    for mode, path, sha1 in read_tree(sha1=tree_sha1):
-        if stat.S_ISDIR(mode):
-            objects.update(find_tree_objects(sha1))
-        else:
-            objects.add(sha1)
-    return objects
+    return find_reachable_objects(tree_sha1s=[tree_sha1], repo=repo)
 
 
-def find_commit_objects(commit_sha1):
+def find_commit_objects(commit_sha1, repo='.'):
     """Return set of SHA-1 hashes of all objects in this commit (recursively),
     its tree, its parents, and the hash of the commit itself.
     """
-    objects = {commit_sha1}
-    obj_type, commit = read_object(commit_sha1)
-    assert obj_type == 'commit'
-    lines = commit.decode().splitlines()
-    tree = next(l[5:45] for l in lines if l.startswith('tree '))
-    objects.update(find_tree_objects(tree))
-    parents = (l[7:47] for l in lines if l.startswith('parent '))
-    for parent in parents:
-        objects.update(find_commit_objects(parent))
-    return objects
+    return find_reachable_objects(commit_sha1s=[commit_sha1], repo=repo)
+
+
+# Fields of a commit object that history walks need
+CommitInfo = collections.namedtuple('CommitInfo', [
+    'tree', 'parents', 'author', 'timestamp', 'message',
+])
+
+
+def read_commit_info(commit_sha1, repo='.'):
+    """Read commit with given SHA-1 and return CommitInfo tuple (timestamp
+    is the committer time in seconds since the epoch).
+    """
+    obj_type, data = read_object(commit_sha1, repo)
+    assert obj_type == 'commit', 'expected commit, got {}'.format(obj_type)
+    tree = None
+    parents = []
+    author = None
+    timestamp = 0
+    header, _, message = data.partition(b'\n\n')
+    for line in header.split(b'\n'):
+        if line.startswith(b'tree '):
+            tree = line[5:45].decode()
+        elif line.startswith(b'parent '):
+            parents.append(line[7:47].decode())
+        elif line.startswith(b'author '):
+            author = line[7:].decode().rsplit(' ', 2)[0]
+        elif line.startswith(b'committer '):
+            timestamp = int(line.rsplit(b' ', 2)[1])
+    return CommitInfo(tree, parents, author, timestamp,
+                      message.decode(errors='replace'))
+
+
+def read_commit_links(commit_sha1, repo='.'):
+    """Read commit with given SHA-1 and return tuple of (tree_sha1,
+    parent_sha1s).
+    """
+    info = read_commit_info(commit_sha1, repo)
+    return (info.tree, info.parents)
+
+
+# Paint bits used by paint_down_to_common: which side a commit is reachable
+# from, and STALE once a commit (and so everything below it) is known to be
+# reachable from both
+PAINT_ONE = 1
+PAINT_TWO = 2
+PAINT_STALE = 4
+
 
+def paint_down_to_common(one, twos, repo='.'):
+    """Walk history back from commit one and commits twos at the same time,
+    newest commit first (by committer date), painting each commit with
+    PAINT_ONE and/or PAINT_TWO for the side(s) it's reachable from. The walk
+    stops as soon as every commit still queued is reachable from both sides,
+    so only history newer than the common ancestors is read. Return tuple of
+    (common, paint), where common lists commits reachable from both sides
+    that were reached before any of their descendants were, newest first,
+    and paint maps SHA-1 of each commit visited to its paint bits. Like git,
+    this assumes commit dates don't go backwards along history.
+    """
+    repo = get_repository(repo)
+    paint = collections.defaultdict(int)
+    heap = []
+    for sha1, bits in [(one, PAINT_ONE)] + [(two, PAINT_TWO) for two in twos]:
+        paint[sha1] |= bits
+        heapq.heappush(heap, (-read_commit_info(sha1, repo).timestamp, sha1))
+    common = []
+    while any(not paint[sha1] & PAINT_STALE for _, sha1 in heap):
+        _, sha1 = heapq.heappop(heap)
+        bits = paint[sha1] & (PAINT_ONE | PAINT_TWO | PAINT_STALE)
+        if bits == PAINT_ONE | PAINT_TWO:
+            if sha1 not in common:
+                common.append(sha1)
+            bits |= PAINT_STALE
+        for parent_sha1 in read_commit_info(sha1, repo).parents:
+            if paint[parent_sha1] & bits == bits:
+                continue
+            paint[parent_sha1] |= bits
+            heapq.heappush(heap, (
+                    -read_commit_info(parent_sha1, repo).timestamp,
+                    parent_sha1))
+    return (common, dict(paint))
+
+
+def merge_bases(rev1, rev2, repo='.'):
+    """Return list of best common ancestors of commits rev1 and rev2 (ref
+    names or SHA-1 prefixes), newest first: usually one, none if the
+    histories are unrelated, and more for criss-cross merges.
+    """
+    repo = get_repository(repo)
+    sha1_1 = resolve_rev(rev1, repo)
+    sha1_2 = resolve_rev(rev2, repo)
+    if sha1_1 == sha1_2:
+        return [sha1_1]
+    common, _ = paint_down_to_common(sha1_1, [sha1_2], repo)
+    if len(common) <= 1:
+        return common
+    bases = []
+    for i, sha1 in enumerate(common):
+        others = common[:i] + common[i + 1:]
+        below, _ = paint_down_to_common(sha1, others, repo)
+        if sha1 not in below:
+            bases.append(sha1)
+    return bases
+
+
+def is_ancestor(ancestor_rev, rev, repo='.'):
+    """Return True if commit ancestor_rev is rev or one of its ancestors."""
+    return (resolve_rev(ancestor_rev, repo) in
+            merge_bases(ancestor_rev, rev, repo))
+
+
+def ahead_behind(rev1, rev2, repo='.'):
+    """Return tuple of (ahead, behind): the number of commits reachable
+    from rev1 but not rev2, and from rev2 but not rev1, found with a single
+    walk that stops at the common ancestors.
+    """
+    repo = get_repository(repo)
+    sha1_1 = resolve_rev(rev1, repo)
+    sha1_2 = resolve_rev(rev2, repo)
+    if sha1_1 == sha1_2:
+        return (0, 0)
+    _, paint = paint_down_to_common(sha1_1, [sha1_2], repo)
+    sides = collections.Counter(bits & (PAINT_ONE | PAINT_TWO)
+                                for bits in paint.values())
+    return (sides[PAINT_ONE], sides[PAINT_TWO])
+
+
+def parse_rev_range(rev_range):
+    """Parse "A..B" (commits reachable from B but not A), "A...B" (commits
+    reachable from either but not both) or just "B". An omitted side means
+    HEAD. Return tuple of (rev1, rev2, symmetric); rev1 is None for a
+    single rev.
+    """
+    for separator, symmetric in (('...', True), ('..', False)):
+        if separator in rev_range:
+            rev1, rev2 = rev_range.split(separator, 1)
+            return (rev1 or 'HEAD', rev2 or 'HEAD', symmetric)
+    return (None, rev_range, False)
+
+
+def count_commits(rev_range, repo='.'):
+    """Return number of commits in given revision range, like "git rev-list
+    --count" (see parse_rev_range for the syntax).
+    """
+    rev1, rev2, symmetric = parse_rev_range(rev_range)
+    if rev1 is None:
+        return sum(1 for _ in log(rev2, repo=repo))
+    ahead, behind = ahead_behind(rev1, rev2, repo)
+    return ahead + behind if symmetric else behind
+
+
+def decode_bitmap(compressed):
+    """Return bitset (as an int) from zlib-compressed bitmap bytes."""
+    return int.from_bytes(zlib.decompress(compressed), 'little')
+
+
+def encode_bitmap(bits):
+    """Return zlib-compressed bytes for given bitset (as an int)."""
+    return zlib.compress(bits.to_bytes((bits.bit_length() + 7) // 8,
+                                       'little'))
+
+
+def bitmap_to_sha1s(bits, names):
+    """Return set of SHA-1 hashes whose bit positions are set in bits."""
+    binary = bin(bits)[:1:-1]
+    return {names[i] for i, c in enumerate(binary) if c == '1'}
+
+
+def reachable_bitmap(commit_sha1s, bitmaps, positions, names, repo='.'):
+    """Return bitset (as an int) of all objects reachable from given
+    commits. Commits that have a stored bitmap aren't walked past; other
+    commits are read, and their trees are walked down to objects already
+    in the result. Objects not yet in positions are appended to names.
+    """
+    bits = 0
+    trees = []
+    new_commits = []
+    stack = list(commit_sha1s)
+    seen = set()
+    while stack:
+        sha1 = stack.pop()
+        if sha1 in seen:
+            continue
+        seen.add(sha1)
+        if sha1 in bitmaps:
+            bits |= decode_bitmap(bitmaps[sha1])
+            continue
+        tree, parents = read_commit_links(sha1, repo)
+        new_commits.append(sha1)
+        trees.append(tree)
+        stack.extend(parents)
+
+    buf = bytearray(bits.to_bytes((len(names) + 7) // 8, 'little'))
+    def set_bit(sha1):
+        """Set bit for sha1 in buf, return False if it was already set."""
+        pos = positions.get(sha1)
+        if pos is None:
+            pos = positions[sha1] = len(names)
+            names.append(sha1)
+        if pos >> 3 >= len(buf):
+            buf.extend(bytes((pos >> 3) - len(buf) + 1))
+        mask = 1 << (pos & 7)
+        if buf[pos >> 3] & mask:
+            return False
+        buf[pos >> 3] |= mask
+        return True
+
+    for sha1 in new_commits:
+        set_bit(sha1)
+    while trees:
+        tree = trees.pop()
+        if not set_bit(tree):
+            continue
+        for mode, path, sha1 in read_tree(sha1=tree, repo=repo):
+            if stat.S_ISDIR(mode):
+                trees.append(sha1)
+            else:
+                set_bit(sha1)
+    return int.from_bytes(buf, 'little')
+
+
+def read_bitmap_index(repo='.'):
+    """Read .git/objects/info/bitmaps and return BitmapIndex, or None if
+    there's no bitmap file.
+    """
+    return get_repository(repo).read_bitmap_index()
+
+
+def write_bitmaps(interval=100, repo='.'):
+    """Write reachability bitmaps for the tip of every ref plus every
+    interval'th commit (in parents-first order) reachable from them to
+    .git/objects/info/bitmaps. Return tuple of (num_bitmaps, num_objects).
+    """
+    repo = get_repository(repo)
+    tips = {sha1 for name, sha1 in list_refs(repo=repo)}
+    head_sha1 = read_ref('HEAD', repo)
+    if head_sha1 is not None:
+        tips.add(head_sha1)
 
-def find_missing_objects(local_sha1, remote_sha1):
+    order = []
+    stack = [(sha1, False) for sha1 in sorted(tips)]
+    visited = set()
+    while stack:
+        sha1, parents_done = stack.pop()
+        if parents_done:
+            order.append(sha1)
+            continue
+        if sha1 in visited:
+            continue
+        visited.add(sha1)
+        stack.append((sha1, True))
+        tree, parents = read_commit_links(sha1, repo)
+        stack.extend((p, False) for p in parents if p not in visited)
+
+    selected = [sha1 for i, sha1 in enumerate(order)
+                if sha1 in tips or (i + 1) % interval == 0]
+    names = []
+    positions = {}
+    bitmaps = {}
+    for sha1 in selected:
+        bits = reachable_bitmap([sha1], bitmaps, positions, names, repo)
+        bitmaps[sha1] = encode_bitmap(bits)
+
+    parts = [struct.pack('!4sLLL', b'PBMP', 1, len(names), len(bitmaps))]
+    parts.extend(bytes.fromhex(sha1) for sha1 in names)
+    for sha1, compressed in bitmaps.items():
+        parts.append(bytes.fromhex(sha1))
+        parts.append(struct.pack('!L', len(compressed)))
+        parts.append(compressed)
+    data = b''.join(parts)
+    path = repo.git_path('objects', 'info', 'bitmaps')
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    write_file(path + '.lock', data + hashlib.sha1(data).digest())
+    os.replace(path + '.lock', path)
+    return (len(bitmaps), len(names))
+
+
+def find_missing_objects(local_sha1, remote_sha1, repo='.'):
     """Return set of SHA-1 hashes of objects in local commit that are missing
-    at the remote (based on the given remote commit hash).
+    at the remote (based on the given remote commit hash). If reachability
+    bitmaps have been written, this is a bitmap AND-NOT that only walks
+    commits without a bitmap.
     """
-    local_objects = find_commit_objects(local_sha1)
+    repo = get_repository(repo)
+    bitmap_index = read_bitmap_index(repo)
+    if bitmap_index is not None:
+        # reachable_bitmap appends unbitmapped objects, so work on copies
+        # rather than the cached index
+        names = list(bitmap_index.names)
+        positions = dict(bitmap_index.positions)
+        index_args = (bitmap_index.bitmaps, positions, names)
+        bits = reachable_bitmap([local_sha1], *index_args, repo=repo)
+        if remote_sha1 is not None:
+            bits &= ~reachable_bitmap([remote_sha1], *index_args, repo=repo)
+        return bitmap_to_sha1s(bits, names)
+    local_objects = find_commit_objects(local_sha1, repo)
     if remote_sha1 is None:
         return local_objects
-    remote_objects = find_commit_objects(remote_sha1)
+    remote_objects = find_commit_objects(remote_sha1, repo)
     return local_objects - remote_objects
 
 
-def encode_pack_object(obj):
+def encode_pack_object(obj, repo='.'):
     """Encode a single object for a pack file and return bytes (variable-
     length header followed by compressed data bytes).
     """
-    obj_type, data = read_object(obj)
+    obj_type, data = read_object(obj, repo)
     type_num = ObjectType[obj_type].value
     size = len(data)
     byte = (type_num << 4) | (size & 0x0f)
@@ -456,33 +4058,55 @@ def encode_pack_object(obj):
     return bytes(header) + zlib.compress(data)
 
 
-def create_pack(objects):
+def create_pack(objects, max_workers=None, repo='.'):
     """Create pack file containing all objects in given given set of SHA-1
-    hashes, return data bytes of full pack file.
+    hashes, return data bytes of full pack file. Objects are inflated and
+    recompressed on a thread pool, but written in sorted SHA-1 order so the
+    pack is the same however many workers there are.
     """
+    import concurrent.futures
+    repo = get_repository(repo)
     header = struct.pack('!4sLL', b'PACK', 2, len(objects))
-    body = b''.join(encode_pack_object(o) for o in sorted(objects))
+    with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+        body = b''.join(executor.map(lambda obj: encode_pack_object(obj, repo),
+                                     sorted(objects)))
     contents = header + body
     sha1 = hashlib.sha1(contents).digest()
     data = contents + sha1
     return data
 
 
-def push(git_url, username=None, password=None):
-    """Push master branch to given git repo URL."""
-    if username is None:
-        username = os.environ['GIT_USERNAME']
-    if password is None:
-        password = os.environ['GIT_PASSWORD']
-    remote_sha1 = get_remote_master_hash(git_url, username, password)
-    local_sha1 = get_local_master_hash()
-    missing = find_missing_objects(local_sha1, remote_sha1)
-    print('updating remote master from {} to {} ({} object{})'.format(
-            remote_sha1 or 'no commits', local_sha1, len(missing),
-            '' if len(missing) == 1 else 's'))
-    lines = ['{} {} refs/heads/master\x00 report-status'.format(
-            remote_sha1 or ('0' * 40), local_sha1).encode()]
-    data = build_lines_data(lines) + create_pack(missing)
+def parse_refspec(refspec, repo='.'):
+    """Parse push refspec "src[:dst]" and return tuple of (local_sha1,
+    remote_ref_name). If dst is omitted, src must name a local ref and the
+    remote ref of the same name is updated.
+    """
+    repo = get_repository(repo)
+    src, _, dst = refspec.lstrip('+').partition(':')
+    src_ref = resolve_ref_name(src, repo)
+    if src_ref == 'HEAD':
+        src_ref = read_head(repo)
+    local_sha1 = (read_ref(src_ref, repo) if src_ref else
+                  sha1_from_prefix(src, repo))
+    if not dst:
+        if src_ref is None:
+            raise ValueError('refspec {!r} needs a destination'.format(
+                    refspec))
+        dst = src_ref
+    elif not dst.startswith('refs/'):
+        dst = 'refs/heads/' + dst
+    check_ref_name(dst)
+    return (local_sha1, dst)
+
+
+def send_pack(git_url, username, password, ref_name, remote_sha1,
+              local_sha1, pack_data):
+    """Send ref update and pack data to git-receive-pack on given git repo
+    URL, and check the server reports it was applied.
+    """
+    lines = ['{} {} {}\x00 report-status'.format(
+            remote_sha1 or ('0' * 40), local_sha1, ref_name).encode()]
+    data = build_lines_data(lines) + pack_data
     url = git_url + '/git-receive-pack'
     response = http_request(url, username, password, data=data)
     lines = extract_lines(response)
@@ -490,12 +4114,158 @@ def push(git_url, username=None, password=None):
         'expected at least 2 lines, got {}'.format(len(lines))
     assert lines[0] == b'unpack ok\n', \
         "expected line 1 b'unpack ok', got: {}".format(lines[0])
-    assert lines[1] == b'ok refs/heads/master\n', \
-        "expected line 2 b'ok refs/heads/master\n', got: {}".format(lines[1])
+    expected = 'ok {}\n'.format(ref_name).encode()
+    assert lines[1] == expected, \
+        'expected line 2 {!r}, got: {}'.format(expected, lines[1])
+
+
+def get_push_args(username, password, refspec, repo='.'):
+    """Fill in default username, password and refspec for a push, return
+    (username, password, local_sha1, ref_name) tuple.
+    """
+    if username is None:
+        username = os.environ['GIT_USERNAME']
+    if password is None:
+        password = os.environ['GIT_PASSWORD']
+    if refspec is None:
+        refspec = read_head(repo)
+        if refspec is None:
+            raise ValueError('HEAD is detached, specify a refspec to push')
+    local_sha1, ref_name = parse_refspec(refspec, repo)
+    return (username, password, local_sha1, ref_name)
+
+
+def check_fast_forward(ref_name, remote_sha1, local_sha1, repo='.'):
+    """Raise ValueError if updating remote ref from remote_sha1 to local_sha1
+    wouldn't be a fast-forward, that is if the remote commit isn't an
+    ancestor of the local one (or isn't present locally at all).
+    """
+    if remote_sha1 is None or remote_sha1 == local_sha1:
+        return
+    if (not get_repository(repo).contains(remote_sha1) or
+            not is_ancestor(remote_sha1, local_sha1, repo)):
+        raise ValueError('remote {} at {} is not an ancestor of {}, '
+                         'refusing non-fast-forward push (fetch and merge '
+                         'first, or use force)'.format(
+                                 ref_name, remote_sha1, local_sha1))
+
+
+def push(git_url, username=None, password=None, refspec=None, force=False,
+         repo='.'):
+    """Push to given git repo URL. refspec is "src[:dst]" (defaults to the
+    current branch). Unless force is True (or refspec starts with "+"),
+    raise ValueError before building a pack if the push wouldn't be a
+    fast-forward.
+    """
+    repo = get_repository(repo)
+    username, password, local_sha1, ref_name = get_push_args(
+            username, password, refspec, repo)
+    remote_sha1 = get_remote_refs(git_url, username, password).get(ref_name)
+    if not force and not (refspec or '').startswith('+'):
+        check_fast_forward(ref_name, remote_sha1, local_sha1, repo)
+    missing = find_missing_objects(local_sha1, remote_sha1, repo)
+    print('updating remote {} from {} to {} ({} object{})'.format(
+            ref_name, remote_sha1 or 'no commits', local_sha1, len(missing),
+            '' if len(missing) == 1 else 's'))
+    send_pack(git_url, username, password, ref_name, remote_sha1,
+              local_sha1, create_pack(missing, repo=repo))
     return (remote_sha1, missing)
 
 
+def read_remote_urls(repo='.'):
+    """Read the push URLs of all remotes in .git/config, return list of URLs
+    in config file order. A remote's "pushurl" entries are used in place of
+    its "url" entries if it has any.
+    """
+    config = get_repository(repo).read_config()
+    remotes = []
+    for name in config:
+        if name.startswith('remote.') and name.count('.') >= 2:
+            remote = name[len('remote.'):name.rindex('.')]
+            if remote not in remotes:
+                remotes.append(remote)
+    urls = []
+    for remote in remotes:
+        urls.extend(config.get('remote.{}.pushurl'.format(remote)) or
+                    config.get('remote.{}.url'.format(remote), []))
+    return urls
+
+
+def push_all(git_urls, username=None, password=None, refspec=None,
+             max_workers=8, force=False, repo='.'):
+    """Push the same ref to each of given git repo URLs. Remote refs are
+    queried in parallel, one pack is built for each distinct remote state
+    (so mirrors that agree share a pack), and packs are uploaded
+    concurrently. Unless force is True (or refspec starts with "+"),
+    remotes the push wouldn't fast-forward are skipped with an error.
+    Return dict mapping URL to (remote_sha1, num_objects, error) tuple,
+    where error is None or an error message string.
+    """
+    import concurrent.futures
+    repo = get_repository(repo)
+    username, password, local_sha1, ref_name = get_push_args(
+            username, password, refspec, repo)
+    results = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+        futures = {url: executor.submit(get_remote_refs, url, username,
+                                        password)
+                   for url in git_urls}
+        remote_sha1s = {}
+        for url, future in futures.items():
+            try:
+                remote_sha1s[url] = future.result().get(ref_name)
+            except Exception as error:
+                results[url] = (None, 0, 'could not read refs: {}'.format(
+                        error))
+
+        packs = {}
+        for remote_sha1 in sorted(set(remote_sha1s.values()),
+                                  key=lambda s: s or ''):
+            if not force and not (refspec or '').startswith('+'):
+                try:
+                    check_fast_forward(ref_name, remote_sha1, local_sha1,
+                                       repo)
+                except ValueError as error:
+                    packs[remote_sha1] = (0, str(error))
+                    continue
+            try:
+                missing = find_missing_objects(local_sha1, remote_sha1, repo)
+                packs[remote_sha1] = (len(missing),
+                                      create_pack(missing, repo=repo))
+            except (AssertionError, ValueError) as error:
+                packs[remote_sha1] = (0, 'could not build pack: {}'.format(
+                        error))
+
+        futures = {}
+        for url, remote_sha1 in remote_sha1s.items():
+            num_objects, pack_data = packs[remote_sha1]
+            if isinstance(pack_data, str):
+                results[url] = (remote_sha1, 0, pack_data)
+                continue
+            futures[url] = executor.submit(send_pack, url, username,
+                                           password, ref_name, remote_sha1,
+                                           local_sha1, pack_data)
+        for url, future in futures.items():
+            remote_sha1 = remote_sha1s[url]
+            try:
+                future.result()
+                results[url] = (remote_sha1, packs[remote_sha1][0], None)
+            except Exception as error:
+                results[url] = (remote_sha1, 0, str(error))
+
+    for url in git_urls:
+        remote_sha1, num_objects, error = results[url]
+        if error is not None:
+            print('{}: error: {}'.format(url, error))
+        else:
+            print('{}: updated {} from {} to {} ({} object{})'.format(
+                    url, ref_name, remote_sha1 or 'no commits', local_sha1,
+                    num_objects, '' if num_objects == 1 else 's'))
+    return results
+
+
 if __name__ == '__main__':
+    import argparse
     parser = argparse.ArgumentParser()
     sub_parsers = parser.add_subparsers(dest='command', metavar='command')
     sub_parsers.required = True
@@ -505,17 +4275,64 @@ if __name__ == '__main__':
     sub_parser.add_argument('paths', nargs='+', metavar='path',
             help='path(s) of files to add')
 
+    sub_parser = sub_parsers.add_parser('archive',
+            help='write tree of a commit to a tar archive')
+    sub_parser.add_argument('rev',
+            help='ref name or SHA-1 hash of commit to archive')
+    sub_parser.add_argument('--format', choices=['tar', 'tgz'],
+            default='tar', dest='archive_format',
+            help='archive format (default %(default)r)')
+    sub_parser.add_argument('-o', '--output',
+            help='path of archive file to write (default stdout)')
+
+    sub_parser = sub_parsers.add_parser('blame',
+            help='show which commit last changed each line of a file')
+    sub_parser.add_argument('path',
+            help='path of file to blame')
+    sub_parser.add_argument('rev', nargs='?', default='HEAD',
+            help='ref name or SHA-1 hash of commit to start from (default '
+                 '%(default)s)')
+
+    sub_parser = sub_parsers.add_parser('branch',
+            help='list branches, or create a new branch')
+    sub_parser.add_argument('name', nargs='?',
+            help='name of branch to create (lists branches if omitted)')
+    sub_parser.add_argument('start_point', nargs='?', default='HEAD',
+            help='ref name or SHA-1 hash of commit the new branch points '
+                 'at (default %(default)s)')
+
     sub_parser = sub_parsers.add_parser('cat-file',
             help='display contents of object')
     valid_modes = ['commit', 'tree', 'blob', 'size', 'type', 'pretty']
-    sub_parser.add_argument('mode', choices=valid_modes,
+    sub_parser.add_argument('mode', choices=valid_modes, nargs='?',
             help='object type (commit, tree, blob) or display mode (size, '
                  'type, pretty)')
-    sub_parser.add_argument('hash_prefix',
+    sub_parser.add_argument('hash_prefix', nargs='?',
             help='SHA-1 hash (or hash prefix) of object to display')
+    sub_parser.add_argument('--batch', action='store_true',
+            help='read object names from stdin and print header and '
+                 'contents of each')
+    sub_parser.add_argument('--batch-check', action='store_true',
+            help='read object names from stdin and print header of each')
+
+    sub_parser = sub_parsers.add_parser('checkout',
+            help='update index and working copy to match given commit')
+    sub_parser.add_argument('commit',
+            help='branch name or SHA-1 hash (or hash prefix) of commit to '
+                 'check out')
+
+    sub_parser = sub_parsers.add_parser('clone',
+            help='clone a local repo into a new directory')
+    sub_parser.add_argument('source',
+            help='path of repo to clone')
+    sub_parser.add_argument('repo',
+            help='directory name for new repo')
+    sub_parser.add_argument('-s', '--shared', action='store_true',
+            help="use the source's objects via objects/info/alternates "
+                 'instead of copying them')
 
     sub_parser = sub_parsers.add_parser('commit',
-            help='commit current state of index to master branch')
+            help='commit current state of index to current branch')
     sub_parser.add_argument('-a', '--author',
             help='commit author in format "A U Thor <author@example.com>" '
                  '(uses GIT_AUTHOR_NAME and GIT_AUTHOR_EMAIL environment '
@@ -527,6 +4344,21 @@ if __name__ == '__main__':
             help='show diff of files changed (between index and working '
                  'copy)')
 
+    sub_parser = sub_parsers.add_parser('fsck',
+            help='verify objects in the store and their connectivity')
+    sub_parser.add_argument('-j', '--jobs', type=int, dest='max_workers',
+            help='number of worker processes (default: number of CPUs)')
+
+    sub_parser = sub_parsers.add_parser('grep',
+            help='search files of a commit for lines matching a pattern')
+    sub_parser.add_argument('pattern',
+            help='regular expression to search for')
+    sub_parser.add_argument('rev', nargs='?', default='HEAD',
+            help='ref name or SHA-1 hash of commit to search (default '
+                 '%(default)s)')
+    sub_parser.add_argument('-i', '--ignore-case', action='store_true',
+            help='match pattern case-insensitively')
+
     sub_parser = sub_parsers.add_parser('hash-object',
             help='hash contents of given path (and optionally write to '
                  'object store)')
@@ -542,6 +4374,18 @@ if __name__ == '__main__':
             help='initialize a new repo')
     sub_parser.add_argument('repo',
             help='directory name for new repo')
+    sub_parser.add_argument('--object-store', choices=['loose', 'sqlite'],
+            default='loose',
+            help='store objects as loose files (default) or in a single '
+                 'SQLite database')
+
+    sub_parser = sub_parsers.add_parser('log',
+            help='show commit history, optionally limited to a path')
+    sub_parser.add_argument('rev', nargs='?', default='HEAD',
+            help='ref name or SHA-1 hash of commit to start from (default '
+                 '%(default)s)')
+    sub_parser.add_argument('-p', '--path',
+            help='only show commits that changed this file or directory')
 
     sub_parser = sub_parsers.add_parser('ls-files',
             help='list files in index')
@@ -549,10 +4393,45 @@ if __name__ == '__main__':
             help='show object details (mode, hash, and stage number) in '
                  'addition to path')
 
+    sub_parser = sub_parsers.add_parser('merge-base',
+            help='show best common ancestor of two commits')
+    sub_parser.add_argument('rev1',
+            help='ref name or SHA-1 hash of first commit')
+    sub_parser.add_argument('rev2',
+            help='ref name or SHA-1 hash of second commit')
+    sub_parser.add_argument('-a', '--all', action='store_true',
+            help='show all best common ancestors, not just the newest')
+
+    sub_parser = sub_parsers.add_parser('migrate-objects',
+            help='move all objects to a different object store')
+    sub_parser.add_argument('store_type', choices=['loose', 'sqlite'],
+            help='object store to move objects to')
+
+    sub_parser = sub_parsers.add_parser('multi-pack-index',
+            help='write or verify the index of objects across all packs')
+    sub_parser.add_argument('action', choices=['write', 'verify'],
+            help='write a new multi-pack-index or check the existing one')
+
+    sub_parser = sub_parsers.add_parser('pack-refs',
+            help='move loose refs into the packed-refs file')
+
     sub_parser = sub_parsers.add_parser('push',
-            help='push master branch to given git server URL')
-    sub_parser.add_argument('git_url',
-            help='URL of git repo, eg: https://github.com/benhoyt/pygit.git')
+            help='push a branch to given git server URL(s)')
+    sub_parser.add_argument('git_url', nargs='?',
+            help='URL of git repo, eg: https://github.com/benhoyt/pygit.git '
+                 '(omit with --all-remotes)')
+    sub_parser.add_argument('refspec', nargs='?',
+            help='"src[:dst]" ref to push, eg: master or HEAD:refs/heads/dev '
+                 '(default is the current branch)')
+    sub_parser.add_argument('-f', '--force', action='store_true',
+            help='push even if the remote ref is not an ancestor of the '
+                 'local one')
+    sub_parser.add_argument('-a', '--all-remotes', action='store_true',
+            help='push to the URLs of all remotes in .git/config; the only '
+                 'positional argument is then the refspec')
+    sub_parser.add_argument('--url', action='append', default=[],
+            dest='extra_urls', metavar='URL',
+            help='also push to this URL, can be given more than once')
     sub_parser.add_argument('-p', '--password',
             help='password to use for authentication (uses GIT_PASSWORD '
                  'environment variable by default)')
@@ -560,32 +4439,234 @@ if __name__ == '__main__':
             help='username to use for authentication (uses GIT_USERNAME '
                  'environment variable by default)')
 
+    sub_parser = sub_parsers.add_parser('rev-list',
+            help='count commits in a revision range')
+    sub_parser.add_argument('rev_range',
+            help='"A..B" for commits in B but not A, "A...B" for commits in '
+                 'either but not both, or a single ref or SHA-1 hash')
+    sub_parser.add_argument('--count', action='store_true', required=True,
+            help='print the number of commits (the only output supported)')
+    sub_parser.add_argument('--left-right', action='store_true',
+            help='with "A...B", print commits only in A and only in B '
+                 'separately ("ahead behind")')
+
+    sub_parser = sub_parsers.add_parser('sparse-checkout',
+            help='limit the working copy to a cone of directories')
+    sub_parser.add_argument('action', choices=['set', 'list', 'disable'],
+            help='set the cone, list its directories, or check out all '
+                 'files again')
+    sub_parser.add_argument('dirs', nargs='*', metavar='dir',
+            help='directory to include in the cone (for "set")')
+
     sub_parser = sub_parsers.add_parser('status',
             help='show status of working copy')
 
+    sub_parser = sub_parsers.add_parser('write-bitmaps',
+            help='write reachability bitmaps to speed up push')
+    sub_parser.add_argument('-i', '--interval', type=int, default=100,
+            help='also write a bitmap for every N commits (default '
+                 '%(default)s)')
+
     args = parser.parse_args()
     if args.command == 'add':
         add(args.paths)
+    elif args.command == 'archive':
+        try:
+            if args.output is None:
+                archive(args.rev, sys.stdout.buffer,
+                        archive_format=args.archive_format)
+            else:
+                with open(args.output, 'wb') as f:
+                    archive(args.rev, f, archive_format=args.archive_format)
+        except ValueError as error:
+            print(error, file=sys.stderr)
+            sys.exit(1)
+    elif args.command == 'blame':
+        try:
+            for sha1, orig_line, final_line, num_lines in blame(
+                    args.path, rev=args.rev):
+                print('{} {} {} {}'.format(
+                        sha1, orig_line, final_line, num_lines))
+                print('filename {}'.format(args.path), flush=True)
+        except ValueError as error:
+            print(error, file=sys.stderr)
+            sys.exit(1)
+    elif args.command == 'branch':
+        if args.name is None:
+            list_branches()
+        else:
+            try:
+                create_branch(args.name, start_point=args.start_point)
+            except ValueError as error:
+                print(error, file=sys.stderr)
+                sys.exit(1)
     elif args.command == 'cat-file':
+        if args.batch or args.batch_check:
+            cat_file_batch(contents=args.batch)
+        elif args.mode is None or args.hash_prefix is None:
+            parser.error('cat-file requires mode and hash_prefix (or '
+                         '--batch/--batch-check)')
+        else:
+            try:
+                cat_file(args.mode, args.hash_prefix)
+            except ValueError as error:
+                print(error, file=sys.stderr)
+                sys.exit(1)
+    elif args.command == 'checkout':
+        try:
+            written, deleted = checkout(args.commit)
+        except ValueError as error:
+            print(error, file=sys.stderr)
+            sys.exit(1)
+        print('checked out {}: {} file{} written, {} removed'.format(
+                args.commit, len(written), '' if len(written) == 1 else 's',
+                len(deleted)))
+    elif args.command == 'clone':
         try:
-            cat_file(args.mode, args.hash_prefix)
+            commit_sha1 = clone(args.source, args.repo, shared=args.shared)
         except ValueError as error:
             print(error, file=sys.stderr)
             sys.exit(1)
+        print('checked out {}'.format(commit_sha1 or 'nothing (no commits)'))
     elif args.command == 'commit':
         commit(args.message, author=args.author)
     elif args.command == 'diff':
         diff()
+    elif args.command == 'fsck':
+        num_objects, bad, missing = fsck(max_workers=args.max_workers)
+        for sha1, error in sorted(bad.items()):
+            print('bad {}: {}'.format(sha1, error))
+        for sha1, referrer in sorted(missing.items()):
+            print('missing {} (referenced by {})'.format(sha1, referrer))
+        print('checked {} object{}: {} bad, {} missing'.format(
+                num_objects, '' if num_objects == 1 else 's', len(bad),
+                len(missing)))
+        if bad or missing:
+            sys.exit(1)
+    elif args.command == 'grep':
+        try:
+            for path, line_number, line in grep(
+                    args.pattern, rev=args.rev,
+                    ignore_case=args.ignore_case):
+                sys.stdout.buffer.write('{}:{}:'.format(
+                        path, line_number).encode() + line + b'\n')
+                sys.stdout.buffer.flush()
+        except (ValueError, re.error) as error:
+            print(error, file=sys.stderr)
+            sys.exit(1)
     elif args.command == 'hash-object':
         sha1 = hash_object(read_file(args.path), args.type, write=args.write)
         print(sha1)
     elif args.command == 'init':
-        init(args.repo)
+        init(args.repo, object_store=args.object_store)
+    elif args.command == 'log':
+        try:
+            for sha1, info in log(rev=args.rev, path=args.path):
+                print('commit {}'.format(sha1))
+                print('Author: {}'.format(info.author))
+                print('Date:   {}'.format(time.ctime(info.timestamp)))
+                print()
+                for line in info.message.splitlines():
+                    print('    {}'.format(line))
+                print(flush=True)
+        except ValueError as error:
+            print(error, file=sys.stderr)
+            sys.exit(1)
     elif args.command == 'ls-files':
         ls_files(details=args.stage)
+    elif args.command == 'merge-base':
+        try:
+            bases = merge_bases(args.rev1, args.rev2)
+        except ValueError as error:
+            print(error, file=sys.stderr)
+            sys.exit(1)
+        if not bases:
+            sys.exit(1)
+        for sha1 in bases if args.all else bases[:1]:
+            print(sha1)
+    elif args.command == 'migrate-objects':
+        try:
+            num_objects = migrate_objects(args.store_type)
+        except ValueError as error:
+            print(error, file=sys.stderr)
+            sys.exit(1)
+        print('moved {} object{} to {} store'.format(
+                num_objects, '' if num_objects == 1 else 's',
+                args.store_type))
+    elif args.command == 'multi-pack-index':
+        if args.action == 'write':
+            num_packs, num_objects = write_multi_pack_index()
+            print('wrote multi-pack-index of {} object{} in {} pack{}'.format(
+                    num_objects, '' if num_objects == 1 else 's', num_packs,
+                    '' if num_packs == 1 else 's'))
+        else:
+            errors = verify_multi_pack_index()
+            for error in errors:
+                print(error)
+            if errors:
+                sys.exit(1)
+            print('multi-pack-index OK')
+    elif args.command == 'pack-refs':
+        print('packed {} refs'.format(pack_refs()))
     elif args.command == 'push':
-        push(args.git_url, username=args.username, password=args.password)
+        git_urls = args.extra_urls
+        refspec = args.refspec
+        if args.all_remotes:
+            if refspec is None:
+                refspec = args.git_url
+            elif args.git_url is not None:
+                git_urls = [args.git_url] + git_urls
+            git_urls = read_remote_urls() + git_urls
+        elif args.git_url is not None:
+            git_urls = [args.git_url] + git_urls
+        try:
+            if not git_urls:
+                raise ValueError('no git URL to push to')
+            if len(git_urls) == 1 and not args.all_remotes:
+                push(git_urls[0], username=args.username,
+                     password=args.password, refspec=refspec,
+                     force=args.force)
+            else:
+                results = push_all(git_urls, username=args.username,
+                                   password=args.password, refspec=refspec,
+                                   force=args.force)
+                if any(error for _, _, error in results.values()):
+                    sys.exit(1)
+        except ValueError as error:
+            print(error, file=sys.stderr)
+            sys.exit(1)
+    elif args.command == 'rev-list':
+        try:
+            rev1, rev2, symmetric = parse_rev_range(args.rev_range)
+            if args.left_right:
+                if not symmetric:
+                    raise ValueError('--left-right needs a symmetric range '
+                                     '"A...B"')
+                print('{}\t{}'.format(*ahead_behind(rev1, rev2)))
+            else:
+                print(count_commits(args.rev_range))
+        except ValueError as error:
+            print(error, file=sys.stderr)
+            sys.exit(1)
+    elif args.command == 'sparse-checkout':
+        if args.action == 'list':
+            for dir_path in read_sparse_cone() or []:
+                print(dir_path)
+        else:
+            try:
+                written, removed = sparse_checkout(
+                        args.dirs if args.action == 'set' else None)
+            except ValueError as error:
+                print(error, file=sys.stderr)
+                sys.exit(1)
+            print('wrote {} file{}, removed {} file{}'.format(
+                    len(written), '' if len(written) == 1 else 's',
+                    len(removed), '' if len(removed) == 1 else 's'))
     elif args.command == 'status':
         status()
+    elif args.command == 'write-bitmaps':
+        num_bitmaps, num_objects = write_bitmaps(interval=args.interval)
+        print('wrote {} bitmap{} covering {} objects'.format(
+                num_bitmaps, '' if num_bitmaps == 1 else 's', num_objects))
     else:
         assert False, 'unexpected command {!r}'.format(args.command)
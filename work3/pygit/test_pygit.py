@@ -1,16 +1,26 @@
 import pytest
+import collections
 import os
 import tempfile
 import shutil
 import hashlib
 import zlib
 import struct
+import io
+import tarfile
+import http.server
+import threading
 from unittest.mock import patch, MagicMock
 import sys
+import sqlite3
+import subprocess
+import time
 
 # 将pygit.py作为模块导入
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 import pygit
+# 启动开销测试与benchmarks/startup.py共用同一个-X importtime解析函数
+from benchmarks.startup import import_times
 
 
 class TestHashObject:
@@ -146,13 +156,13 @@ class TestReadIndex:
         correct_checksum = hashlib.sha1(header).digest()
         
         # 故意写入错误的校验和
-        invalid_data = header + b'\x00' * 20  # 使用全0作为错误的校验和
+        invalid_data = header + b'\x01' * 20  # 全0表示跳过校验，所以使用全1
         
         with open(index_path, 'wb') as f:
             f.write(invalid_data)
         
-        # 验证抛出断言错误
-        with pytest.raises(AssertionError, match="invalid index checksum"):
+        # 验证抛出ValueError
+        with pytest.raises(ValueError, match="invalid index checksum"):
             pygit.read_index()
     
     def test_read_index_invalid_signature(self, temp_git_dir):
@@ -181,9 +191,9 @@ class TestReadIndex:
         # 创建一个具有不支持版本号的index文件
         index_path = os.path.join('.git', 'index')
         
-        # 创建头部，使用不支持的版本号3（只支持版本2）
+        # 创建头部，使用不支持的版本号4（只支持版本2和3）
         header = b'DIRC'  # 正确的签名
-        header += struct.pack('!L', 3)  # 不支持的版本号
+        header += struct.pack('!L', 4)  # 不支持的版本号
         header += struct.pack('!L', 0)  # 条目数量
         
         # 添加正确的校验和
@@ -205,7 +215,10 @@ class TestCommit:
     def mock_git_env(self):
         """模拟Git环境"""
         with patch('pygit.write_tree') as mock_write_tree, \
-             patch('pygit.get_local_master_hash') as mock_get_master, \
+             patch('pygit.read_head', return_value='refs/heads/master'), \
+             patch('pygit.read_ref') as mock_get_master, \
+             patch('pygit.write_ref'), \
+             patch('pygit.write_changed_paths'), \
              patch('pygit.hash_object') as mock_hash_object, \
              patch('pygit.write_file') as mock_write_file, \
              patch('time.mktime') as mock_mktime, \
@@ -304,6 +317,2250 @@ class TestCommit:
             assert '+0900' in commit_data
 
 
+class TestCheckout:
+    """测试checkout函数 - 只写入与index不同的文件并重建index"""
+
+    @pytest.fixture
+    def temp_repo(self):
+        """创建临时仓库并切换到仓库目录"""
+        temp_dir = tempfile.mkdtemp()
+        original_cwd = os.getcwd()
+        os.chdir(temp_dir)
+        pygit.init('repo')
+        os.chdir('repo')
+        yield temp_dir
+        os.chdir(original_cwd)
+        shutil.rmtree(temp_dir)
+
+    def write_and_commit(self, files, message):
+        """写入文件、加入index并提交，返回提交哈希"""
+        for path, data in files.items():
+            with open(path, 'wb') as f:
+                f.write(data)
+        pygit.add(sorted(files))
+        return pygit.commit(message, author='Test <test@example.com>')
+
+    def test_checkout_restores_old_snapshot(self, temp_repo):
+        """测试分支1: 切换到旧提交时恢复内容并删除后来新增的文件"""
+        first = self.write_and_commit({'a.txt': b'a1', 'b.txt': b'b1'}, 'v1')
+        self.write_and_commit({'a.txt': b'a2', 'c.txt': b'c2'}, 'v2')
+
+        written, deleted = pygit.checkout(first)
+
+        assert written == ['a.txt']
+        assert deleted == ['c.txt']
+        assert pygit.read_file('a.txt') == b'a1'
+        assert not os.path.exists('c.txt')
+        assert [e.path for e in pygit.read_index()] == ['a.txt', 'b.txt']
+        assert pygit.get_status() == ([], [], [])
+
+    def test_checkout_only_touches_changed_files(self, temp_repo):
+        """测试分支2: 内容未变化的文件不应被重写"""
+        first = self.write_and_commit({'same.txt': b'same', 'x.txt': b'1'},
+                                      'v1')
+        self.write_and_commit({'x.txt': b'2'}, 'v2')
+        os.utime('same.txt', ns=(1000000000, 1000000000))
+        pygit.add(['same.txt'])
+
+        written, deleted = pygit.checkout(first)
+
+        assert written == ['x.txt']
+        assert os.stat('same.txt').st_mtime_ns == 1000000000
+        entry = {e.path: e for e in pygit.read_index()}['x.txt']
+        assert entry.mtime_n == os.stat('x.txt').st_mtime_ns % 1000000000
+        assert entry.size == 1
+
+    def test_checkout_nested_tree(self, temp_repo):
+        """测试分支3: 子目录中的文件应被创建，并保留可执行权限"""
+        blob = pygit.hash_object(b'#!/bin/sh\n', 'blob')
+        sub_tree = pygit.hash_object(
+                b'100755 run.sh\x00' + bytes.fromhex(blob), 'tree')
+        tree = pygit.hash_object(
+                b'40000 bin\x00' + bytes.fromhex(sub_tree), 'tree')
+        commit = pygit.hash_object('tree {}\n\nnested\n'.format(
+                tree).encode(), 'commit')
+
+        written, deleted = pygit.checkout(commit)
+
+        assert written == ['bin/run.sh']
+        assert pygit.read_file('bin/run.sh') == b'#!/bin/sh\n'
+        assert os.stat('bin/run.sh').st_mode & 0o100
+        assert pygit.read_index()[0].mode == 0o100755
+
+    def test_checkout_refuses_to_overwrite_local_changes(self, temp_repo):
+        """测试分支4: 工作区有未提交修改时抛出ValueError"""
+        first = self.write_and_commit({'a.txt': b'a1'}, 'v1')
+        self.write_and_commit({'a.txt': b'a2'}, 'v2')
+        with open('a.txt', 'wb') as f:
+            f.write(b'local edit')
+
+        with pytest.raises(ValueError, match='local changes'):
+            pygit.checkout(first)
+        assert pygit.read_file('a.txt') == b'local edit'
+
+    def test_checkout_sha1_detaches_head(self, temp_repo):
+        """测试分支5: 按SHA-1检出时HEAD分离，之后的提交不移动master"""
+        first = self.write_and_commit({'a.txt': b'a1'}, 'v1')
+        second = self.write_and_commit({'a.txt': b'a2'}, 'v2')
+
+        pygit.checkout(first[:10])
+        assert pygit.read_head() is None
+        assert pygit.read_ref('HEAD') == first
+        third = self.write_and_commit({'a.txt': b'a3'}, 'v3')
+
+        assert pygit.get_local_master_hash() == second
+        assert pygit.read_ref('HEAD') == third
+        assert pygit.read_commit_info(third).parents == [first]
+
+
+class TestRefs:
+    """测试引用存储 - 松散引用、packed-refs、分支和任意refspec推送"""
+
+    @pytest.fixture
+    def temp_repo(self):
+        """创建临时仓库并切换到仓库目录"""
+        temp_dir = tempfile.mkdtemp()
+        original_cwd = os.getcwd()
+        os.chdir(temp_dir)
+        pygit.init('repo')
+        os.chdir('repo')
+        yield temp_dir
+        os.chdir(original_cwd)
+        shutil.rmtree(temp_dir)
+
+    def make_commit(self, data=b'data', message='msg'):
+        """写入一个文件并提交，返回提交哈希"""
+        with open('file.txt', 'wb') as f:
+            f.write(data)
+        pygit.add(['file.txt'])
+        return pygit.commit(message, author='Test <test@example.com>')
+
+    def test_loose_ref_overrides_packed_ref(self, temp_repo):
+        """测试分支1: 松散引用优先于packed-refs，缺失时回退到packed-refs"""
+        pygit.write_packed_refs({'refs/heads/a': '1' * 40,
+                                 'refs/heads/b': '2' * 40})
+        pygit.write_ref('refs/heads/a', '3' * 40)
+
+        assert pygit.read_ref('refs/heads/a') == '3' * 40
+        assert pygit.read_ref('refs/heads/b') == '2' * 40
+        assert pygit.read_ref('refs/heads/c') is None
+        assert pygit.read_packed_refs() is pygit.read_packed_refs()
+
+    def test_list_refs_by_prefix(self, temp_repo):
+        """测试分支2: 按前缀枚举时合并两种存储并按名称排序"""
+        pygit.write_packed_refs({'refs/heads/x': '1' * 40,
+                                 'refs/tags/v1': '2' * 40})
+        pygit.write_ref('refs/heads/feature/y', '3' * 40)
+        pygit.write_ref('refs/tags/v2', '4' * 40)
+
+        assert pygit.list_refs('refs/heads/') == [
+                ('refs/heads/feature/y', '3' * 40), ('refs/heads/x', '1' * 40)]
+        assert [n for n, _ in pygit.list_refs()] == [
+                'refs/heads/feature/y', 'refs/heads/x',
+                'refs/tags/v1', 'refs/tags/v2']
+
+    def test_commit_on_branch(self, temp_repo):
+        """测试分支3: 切换分支后提交只移动当前分支"""
+        first = self.make_commit(b'one')
+        pygit.create_branch('dev')
+        with pytest.raises(ValueError, match='already exists'):
+            pygit.create_branch('dev')
+        pygit.checkout('dev')
+        second = self.make_commit(b'two')
+
+        assert pygit.read_head() == 'refs/heads/dev'
+        assert pygit.read_ref('refs/heads/dev') == second
+        assert pygit.get_local_master_hash() == first
+
+    def test_pack_refs(self, temp_repo):
+        """测试分支4: pack_refs后松散文件被删除但引用仍可读取"""
+        sha1 = self.make_commit()
+        pygit.create_branch('topic/one')
+
+        assert pygit.pack_refs() == 2
+        assert not os.path.exists(os.path.join('.git', 'refs', 'heads',
+                                               'topic'))
+        assert os.path.isdir(os.path.join('.git', 'refs', 'heads'))
+        assert pygit.read_ref('refs/heads/topic/one') == sha1
+        assert pygit.resolve_rev('master') == sha1
+
+    def test_ref_names_checked(self, temp_repo):
+        """测试分支6: 含..等非法组成部分的引用名被拒绝，不会读取.git之外的文件"""
+        self.make_commit()
+        for name in ['refs/../config', 'refs/heads/../../config']:
+            with pytest.raises(ValueError, match='invalid ref name'):
+                pygit.read_ref(name)
+        with pytest.raises(ValueError, match='invalid ref name'):
+            pygit.resolve_ref_name('../config')
+        with pytest.raises(ValueError, match='invalid ref name'):
+            pygit.resolve_rev('../../../etc/passwd')
+        assert pygit.resolve_ref_name('master') == 'refs/heads/master'
+
+    def test_push_refspec(self, temp_repo):
+        """测试分支5: push使用refspec指定的远程引用"""
+        sha1 = self.make_commit()
+        advertisement = (b'001f# service=git-receive-pack\n0000' +
+                         pygit.build_lines_data([
+                             b'0' * 40 + b' capabilities^{}\x00report-status']))
+        report = pygit.build_lines_data([b'unpack ok', b'ok refs/heads/dev'])
+        with patch('pygit.http_request',
+                   side_effect=[advertisement, report]) as mock_request:
+            remote_sha1, missing = pygit.push(
+                    'http://x', username='u', password='p',
+                    refspec='master:dev')
+
+        assert remote_sha1 is None
+        assert sha1 in missing
+        sent = mock_request.call_args[1]['data']
+        assert b' refs/heads/dev\x00' in sent
+
+
+class TestBitmaps:
+    """测试可达性位图 - find_missing_objects使用位图差集"""
+
+    @pytest.fixture
+    def temp_repo(self):
+        """创建临时仓库并生成三次提交"""
+        temp_dir = tempfile.mkdtemp()
+        original_cwd = os.getcwd()
+        os.chdir(temp_dir)
+        pygit.init('repo')
+        os.chdir('repo')
+        commits = []
+        for i in range(3):
+            with open('file{}.txt'.format(i), 'wb') as f:
+                f.write('content {}'.format(i).encode())
+            pygit.add(['file{}.txt'.format(i)])
+            commits.append(pygit.commit('commit {}'.format(i),
+                                        author='Test <test@example.com>'))
+        yield commits
+        os.chdir(original_cwd)
+        shutil.rmtree(temp_dir)
+
+    def test_bitmaps_match_full_walk(self, temp_repo):
+        """测试分支1: 位图结果与逐个解压对象的结果一致"""
+        first, second, third = temp_repo
+        expected = pygit.find_missing_objects(third, first)
+
+        assert pygit.write_bitmaps(interval=2) == (2, 9)
+        assert pygit.find_missing_objects(third, first) == expected
+        assert pygit.find_missing_objects(third, None) == \
+                pygit.find_commit_objects(third)
+
+    def test_bitmapped_commits_are_not_inflated(self, temp_repo):
+        """测试分支2: 两端都有位图时不需要读取任何对象"""
+        first, second, third = temp_repo
+        pygit.write_bitmaps(interval=1)
+
+        with patch('pygit.read_object', side_effect=AssertionError):
+            missing = pygit.find_missing_objects(third, second)
+        assert third in missing
+        assert second not in missing
+
+    def test_walks_commits_newer_than_bitmaps(self, temp_repo):
+        """测试分支3: 位图之后的新提交只遍历没有位图的部分"""
+        pygit.write_bitmaps()
+        with open('new.txt', 'wb') as f:
+            f.write(b'new')
+        pygit.add(['new.txt'])
+        fourth = pygit.commit('commit 3', author='Test <test@example.com>')
+        new_blob = pygit.hash_object(b'new', 'blob', write=False)
+
+        missing = pygit.find_missing_objects(fourth, temp_repo[2])
+        tree, parents = pygit.read_commit_links(fourth)
+        assert missing == {fourth, tree, new_blob}
+
+    def test_cached_index_not_modified(self, temp_repo):
+        """测试分支4: 遍历新提交不会修改缓存的位图索引"""
+        pygit.write_bitmaps()
+        with open('new.txt', 'wb') as f:
+            f.write(b'new')
+        pygit.add(['new.txt'])
+        fourth = pygit.commit('commit 3', author='Test <test@example.com>')
+        bitmap_index = pygit.read_bitmap_index()
+        names = list(bitmap_index.names)
+        positions = dict(bitmap_index.positions)
+
+        pygit.find_missing_objects(fourth, temp_repo[2])
+        assert pygit.read_bitmap_index() is bitmap_index
+        assert list(bitmap_index.names) == names
+        assert bitmap_index.positions == positions
+
+
+class TestBlame:
+    """测试blame函数 - 逐行归属到最后修改该行的提交"""
+
+    @pytest.fixture
+    def temp_repo(self):
+        """创建临时仓库并切换到仓库目录"""
+        temp_dir = tempfile.mkdtemp()
+        original_cwd = os.getcwd()
+        os.chdir(temp_dir)
+        pygit.init('repo')
+        os.chdir('repo')
+        yield temp_dir
+        os.chdir(original_cwd)
+        shutil.rmtree(temp_dir)
+
+    def commit_files(self, files, message):
+        """写入文件并提交，返回提交哈希"""
+        for path, data in files.items():
+            with open(path, 'wb') as f:
+                f.write(data)
+        pygit.add(sorted(files))
+        return pygit.commit(message, author='Test <test@example.com>')
+
+    def blame_by_line(self, path):
+        """返回{最终行号: 提交哈希}字典"""
+        result = {}
+        for sha1, orig_line, final_line, num_lines in pygit.blame(path):
+            for i in range(num_lines):
+                result[final_line + i] = sha1
+        return result
+
+    def test_blame_attributes_lines(self, temp_repo):
+        """测试分支1: 新增和修改的行归属到对应提交，其余行归属到初始提交"""
+        first = self.commit_files({'f.txt': b'a\nb\nc\n'}, 'v1')
+        second = self.commit_files({'f.txt': b'a\nB\nc\n'}, 'v2')
+        third = self.commit_files({'f.txt': b'a\nB\nc\nd\n'}, 'v3')
+
+        assert self.blame_by_line('f.txt') == {
+                1: first, 2: second, 3: first, 4: third}
+
+    def test_blame_skips_commits_with_unchanged_blob(self, temp_repo):
+        """测试分支2: 文件未变化的提交不做行级diff"""
+        first = self.commit_files({'f.txt': b'a\nb\n'}, 'v1')
+        for i in range(5):
+            self.commit_files({'other.txt': str(i).encode()}, 'other')
+        last = self.commit_files({'f.txt': b'a\nb\nc\n'}, 'v2')
+
+        with patch('pygit.split_blame_entries',
+                   wraps=pygit.split_blame_entries) as mock_split:
+            result = self.blame_by_line('f.txt')
+        assert result == {1: first, 2: first, 3: last}
+        assert mock_split.call_count == 1
+
+    def test_blame_missing_path(self, temp_repo):
+        """测试分支3: 路径不存在时抛出ValueError"""
+        self.commit_files({'f.txt': b'a\n'}, 'v1')
+        with pytest.raises(ValueError, match='not in'):
+            list(pygit.blame('missing.txt'))
+
+    def test_blame_directory(self, temp_repo):
+        """测试分支4: 路径是目录时抛出ValueError，而不是断言失败"""
+        os.mkdir('d')
+        self.commit_files({'d/f.txt': b'a\n'}, 'v1')
+        with pytest.raises(ValueError, match='not in'):
+            list(pygit.blame('d'))
+
+
+class TestChangedPathBloom:
+    """测试变更路径Bloom过滤器 - 按路径过滤历史时跳过无关提交"""
+
+    @pytest.fixture
+    def temp_repo(self):
+        """创建临时仓库并切换到仓库目录"""
+        temp_dir = tempfile.mkdtemp()
+        original_cwd = os.getcwd()
+        os.chdir(temp_dir)
+        pygit.init('repo')
+        os.chdir('repo')
+        yield temp_dir
+        os.chdir(original_cwd)
+        shutil.rmtree(temp_dir)
+
+    def commit_file(self, path, data):
+        """写入单个文件并提交，返回提交哈希"""
+        with open(path, 'wb') as f:
+            f.write(data)
+        pygit.add([path])
+        return pygit.commit('change ' + path, author='Test <test@example.com>')
+
+    def test_bloom_filter_membership(self):
+        """测试分支1: 加入的路径一定命中，空过滤器一定不命中"""
+        paths = {'src', 'src/main.py', 'README'}
+        bloom = pygit.make_bloom_filter(paths)
+        assert all(pygit.bloom_may_contain(bloom, p) for p in paths)
+        assert not pygit.bloom_may_contain(pygit.make_bloom_filter(set()),
+                                           'src')
+        too_many = {'f{}'.format(i) for i in range(pygit.BLOOM_MAX_PATHS + 1)}
+        assert pygit.bloom_may_contain(pygit.make_bloom_filter(too_many), 'x')
+
+    def test_commit_writes_filters(self, temp_repo):
+        """测试分支2: 每次提交都追加一个过滤器"""
+        first = self.commit_file('a.txt', b'1')
+        second = self.commit_file('b.txt', b'2')
+
+        filters = pygit.read_changed_paths().filters
+        assert set(filters) == {first, second}
+        assert pygit.bloom_may_contain(filters[second], 'b.txt')
+
+    def test_commit_appends_one_record(self, temp_repo):
+        """测试分支3: 每次提交只在文件末尾追加一条记录，不重写已有内容"""
+        self.commit_file('a.txt', b'1')
+        path = os.path.join('.git', 'objects', 'info', 'changed-paths')
+        for i in range(3):
+            before = pygit.read_file(path)
+            inode = os.stat(path).st_ino
+            sha1 = self.commit_file('b.txt', str(i).encode())
+            data = pygit.read_file(path)
+            bloom = pygit.read_changed_paths().filters[sha1]
+
+            assert data[:len(before)] == before
+            assert len(data) == len(before) + 24 + len(bloom)
+            assert data[len(before):len(before) + 20] == bytes.fromhex(sha1)
+            assert os.stat(path).st_ino == inode
+        assert not os.path.exists(path + '.lock')
+
+    def test_torn_record_ignored(self, temp_repo):
+        """测试分支4: 追加中断留下的不完整记录在读取时被忽略"""
+        first = self.commit_file('a.txt', b'1')
+        path = os.path.join('.git', 'objects', 'info', 'changed-paths')
+        with open(path, 'ab') as f:
+            f.write(bytes(20) + struct.pack('!L', 64) + b'\xff' * 10)
+
+        assert set(pygit.read_changed_paths().filters) == {first}
+
+    def test_path_limited_log_skips_trees(self, temp_repo):
+        """测试分支5: 只返回修改过该路径的提交，并且大部分提交不读取树"""
+        first = self.commit_file('a.txt', b'1')
+        for i in range(10):
+            self.commit_file('b.txt', str(i).encode())
+        last = self.commit_file('a.txt', b'2')
+
+        with patch('pygit.read_tree', wraps=pygit.read_tree) as mock_tree:
+            result = [sha1 for sha1, info in pygit.log(path='a.txt')]
+        assert result == [last, first]
+        assert mock_tree.call_count <= 6
+        assert len(list(pygit.log())) == 12
+
+    def test_log_same_timestamp_order(self, temp_repo):
+        """测试分支6: 同一秒内的合并历史按到达顺序输出，子提交总在父提交之前"""
+        def make_commit(parents, message):
+            lines = ['tree ' + pygit.hash_object(b'', 'tree')]
+            lines += ['parent ' + p for p in parents]
+            lines.append('author Test <test@example.com> 1000 +0000')
+            lines.append('committer Test <test@example.com> 1000 +0000')
+            lines += ['', message, '']
+            return pygit.hash_object('\n'.join(lines).encode(), 'commit')
+
+        for i in range(10):
+            base = make_commit([], 'base{}'.format(i))
+            left = make_commit([base], 'left{}'.format(i))
+            right = make_commit([base], 'right{}'.format(i))
+            merge = make_commit([left, right], 'merge{}'.format(i))
+            result = [sha1 for sha1, info in pygit.log(merge)]
+            assert result == [merge, left, right, base]
+
+
+class TestCatFileBatch:
+    """测试cat_file_batch函数 - 单进程处理多个对象请求"""
+
+    @pytest.fixture
+    def temp_git_dir(self):
+        """创建临时的.git目录"""
+        temp_dir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(temp_dir, '.git', 'objects'))
+        original_cwd = os.getcwd()
+        os.chdir(temp_dir)
+        yield temp_dir
+        os.chdir(original_cwd)
+        shutil.rmtree(temp_dir)
+
+    def test_batch_outputs_header_and_contents(self, temp_git_dir):
+        """测试分支1: --batch输出头部、内容和换行，未知对象输出missing"""
+        sha1 = pygit.hash_object(b'hello', 'blob')
+        input_file = io.BytesIO('{}\n{}\nbeef\n'.format(
+                sha1, sha1[:7]).encode())
+        output_file = io.BytesIO()
+
+        pygit.cat_file_batch(input_file=input_file, output_file=output_file)
+
+        header = '{} blob 5\n'.format(sha1).encode()
+        assert output_file.getvalue() == (header + b'hello\n' + header +
+                                          b'hello\nbeef missing\n')
+
+    def test_batch_check_outputs_header_only(self, temp_git_dir):
+        """测试分支2: --batch-check只输出头部"""
+        sha1 = pygit.hash_object(b'hello', 'blob')
+        output_file = io.BytesIO()
+
+        pygit.cat_file_batch(contents=False,
+                             input_file=io.BytesIO(sha1.encode() + b'\n'),
+                             output_file=output_file)
+
+        assert output_file.getvalue() == '{} blob 5\n'.format(sha1).encode()
+
+    def test_header_only_read(self, temp_git_dir, capsys):
+        """测试分支3: 读取类型和大小时不解压整个对象"""
+        data = os.urandom(1 << 20)
+        sha1 = pygit.hash_object(data, 'blob')
+
+        with patch('pygit.read_object', side_effect=AssertionError):
+            assert pygit.read_object_header(sha1) == ('blob', len(data))
+            pygit.cat_file('size', sha1)
+            pygit.cat_file('type', sha1[:8])
+            pygit.cat_file_batch(contents=False,
+                                 input_file=io.BytesIO(sha1.encode()),
+                                 output_file=io.BytesIO())
+        assert capsys.readouterr().out == '{}\nblob\n'.format(len(data))
+
+    def test_find_object_sees_new_objects(self, temp_git_dir):
+        """测试分支4: 目录列表缓存不会漏掉新写入的对象"""
+        first = pygit.hash_object(b'first', 'blob')
+        assert pygit.find_object(first[:6]).endswith(first[2:])
+        second = pygit.hash_object(b'second', 'blob')
+        assert pygit.find_object(second[:6]).endswith(second[2:])
+
+    def test_bad_names_dont_stop_batch(self, temp_git_dir):
+        """测试分支5: 无法解码或有歧义的名称单独报告，后续请求继续处理"""
+        sha1 = pygit.hash_object(b'hello', 'blob')
+        other = pygit.hash_object(b'242', 'blob')
+        assert other[:2] == sha1[:2] == 'b6'
+        input_file = io.BytesIO(b'\xff\nb6\n' + sha1.encode() + b'\n')
+        output_file = io.BytesIO()
+
+        pygit.cat_file_batch(contents=False, input_file=input_file,
+                             output_file=output_file)
+
+        assert output_file.getvalue() == (
+                b'\xff missing\nb6 ambiguous\n' +
+                '{} blob 5\n'.format(sha1).encode())
+
+
+class TestStreamObject:
+    """测试write_object_data函数 - 分块流式输出对象内容"""
+
+    @pytest.fixture
+    def temp_git_dir(self):
+        """创建临时的.git目录"""
+        temp_dir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(temp_dir, '.git', 'objects'))
+        original_cwd = os.getcwd()
+        os.chdir(temp_dir)
+        yield temp_dir
+        os.chdir(original_cwd)
+        shutil.rmtree(temp_dir)
+
+    def test_chunks_are_bounded(self, temp_git_dir):
+        """测试分支1: 每次写出的数据不超过chunk_size"""
+        data = os.urandom(100000) + b'\x00' * 200000
+        sha1 = pygit.hash_object(data, 'blob')
+        output_file = MagicMock()
+
+        result = pygit.write_object_data(sha1, output_file, chunk_size=4096)
+
+        chunks = [c[0][0] for c in output_file.write.call_args_list]
+        assert result == ('blob', len(data))
+        assert max(len(c) for c in chunks) <= 4096
+        assert b''.join(chunks) == data
+
+    def test_cat_file_streams_blob(self, temp_git_dir, capsysbinary):
+        """测试分支2: cat-file blob和pretty模式输出完整内容"""
+        data = b'line\n' * 50000
+        sha1 = pygit.hash_object(data, 'blob')
+
+        pygit.cat_file('blob', sha1)
+        pygit.cat_file('pretty', sha1)
+
+        assert capsysbinary.readouterr().out == data + data
+
+    def test_type_mismatch(self, temp_git_dir):
+        """测试分支3: 对象类型不符时抛出ValueError且不输出内容"""
+        sha1 = pygit.hash_object(b'data', 'blob')
+        output_file = io.BytesIO()
+
+        with pytest.raises(ValueError, match='expected object type tree'):
+            pygit.write_object_data(sha1, output_file, expected_type='tree')
+        assert output_file.getvalue() == b''
+
+    def test_bad_header_closes_file(self, temp_git_dir):
+        """测试分支4: 对象头部无法解析时ObjectReader关闭已打开的文件"""
+        sha1 = 'ab' + '0' * 38
+        os.makedirs(os.path.join('.git', 'objects', 'ab'))
+        with open(os.path.join('.git', 'objects', 'ab', '0' * 38), 'wb') as f:
+            f.write(zlib.compress(b'x' * 100))
+        opened = []
+        store_open = pygit.LooseObjectStore.open
+
+        def open_and_record(store, sha1):
+            f = store_open(store, sha1)
+            opened.append(f)
+            return f
+
+        with patch('pygit.LooseObjectStore.open', autospec=True,
+                   side_effect=open_and_record):
+            with pytest.raises(AssertionError, match='invalid object header'):
+                pygit.ObjectReader(sha1)
+        assert len(opened) == 1 and opened[0].closed
+
+
+class TestProtocolV2:
+    """测试协议v2的ls-refs - 使用本地替身服务器验证过滤和v0回退"""
+
+    REMOTE_REFS = {
+        'refs/heads/master': 'a' * 40,
+        'refs/heads/master-old': 'b' * 40,
+        'refs/pull/1/head': 'c' * 40,
+        'refs/tags/v1.0': 'd' * 40,
+    }
+
+    @pytest.fixture
+    def start_server(self):
+        """返回启动替身服务器的函数，测试结束后关闭服务器"""
+        servers = []
+        remote_refs = self.REMOTE_REFS
+
+        def start(supports_v2):
+            requests = []
+
+            class Handler(http.server.BaseHTTPRequestHandler):
+                def log_message(self, *args):
+                    pass
+
+                def respond(self, body):
+                    self.send_response(200)
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+                def do_GET(self):
+                    protocol = self.headers.get('Git-Protocol') or ''
+                    requests.append(('GET', self.path, protocol))
+                    if supports_v2 and 'version=2' in protocol:
+                        self.respond(pygit.build_lines_data(
+                                [b'version 2', b'ls-refs=unborn', b'fetch']))
+                        return
+                    lines = ['{} {}'.format(sha1, name).encode()
+                             for name, sha1 in sorted(remote_refs.items())]
+                    lines[0] += b'\x00multi_ack'
+                    self.respond(b'001e# service=git-upload-pack\n0000' +
+                                 pygit.build_lines_data(lines))
+
+                def do_POST(self):
+                    length = int(self.headers['Content-Length'])
+                    body = self.rfile.read(length)
+                    requests.append(('POST', self.path, body))
+                    prefixes = [line[len(b'ref-prefix '):-1].decode()
+                                for line in pygit.extract_lines(body)
+                                if line.startswith(b'ref-prefix ')]
+                    lines = ['{} {}'.format(sha1, name).encode()
+                             for name, sha1 in sorted(remote_refs.items())
+                             if any(name.startswith(p) for p in prefixes)]
+                    self.respond(pygit.build_lines_data(lines))
+
+            server = http.server.ThreadingHTTPServer(('127.0.0.1', 0),
+                                                     Handler)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            servers.append(server)
+            return ('http://127.0.0.1:{}'.format(server.server_port),
+                    requests)
+
+        yield start
+        for server in servers:
+            server.shutdown()
+            server.server_close()
+
+    def test_ls_refs_sends_ref_prefix(self, start_server):
+        """测试分支1: 服务器支持v2时只请求并返回需要的引用"""
+        url, requests = start_server(supports_v2=True)
+
+        sha1 = pygit.get_remote_master_hash(url, 'user', 'password')
+
+        assert sha1 == 'a' * 40
+        assert requests[0][2] == 'version=2'
+        method, path, body = requests[1]
+        assert (method, path) == ('POST', '/git-upload-pack')
+        assert b'command=ls-refs\n0001' in body
+        assert b'ref-prefix refs/heads/master\n0000' in body
+
+    def test_ls_refs_filters_by_prefix(self, start_server):
+        """测试分支2: 按多个前缀过滤，不返回其他引用"""
+        url, requests = start_server(supports_v2=True)
+
+        refs = pygit.ls_remote_refs(url, 'user', 'password',
+                                    ['refs/heads/', 'refs/tags/'])
+
+        assert sorted(refs) == ['refs/heads/master', 'refs/heads/master-old',
+                                'refs/tags/v1.0']
+
+    def test_falls_back_to_v0(self, start_server):
+        """测试分支3: 服务器只支持v0时使用第一次请求的完整引用公告"""
+        url, requests = start_server(supports_v2=False)
+
+        sha1 = pygit.get_remote_hash(url, 'user', 'password',
+                                     'refs/tags/v1.0')
+
+        assert sha1 == 'd' * 40
+        assert [r[0] for r in requests] == ['GET']
+
+
+class TestArchive:
+    """测试archive函数 - 不检出工作区，直接把提交的树写成tar流"""
+
+    @pytest.fixture
+    def temp_git_dir(self):
+        """创建临时的.git目录，并写入一个包含子目录的提交"""
+        temp_dir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(temp_dir, '.git', 'objects'))
+        original_cwd = os.getcwd()
+        os.chdir(temp_dir)
+        readme = pygit.hash_object(b'readme\n', 'blob')
+        script = pygit.hash_object(b'x' * 200000, 'blob')
+        sub_tree = pygit.hash_object(
+                b'100755 run.sh\x00' + bytes.fromhex(script), 'tree')
+        tree = pygit.hash_object(
+                b'100644 README\x00' + bytes.fromhex(readme) +
+                b'40000 bin\x00' + bytes.fromhex(sub_tree), 'tree')
+        commit = pygit.hash_object(
+                'tree {}\nauthor A <a@b> 1600000000 +0000\n'
+                'committer A <a@b> 1600000000 +0000\n\nmsg\n'.format(
+                        tree).encode(), 'commit')
+        yield commit
+        os.chdir(original_cwd)
+        shutil.rmtree(temp_dir)
+
+    def read_archive(self, data, mode):
+        """解析tar数据，返回{成员名: (成员信息, 内容)}字典"""
+        members = {}
+        with tarfile.open(fileobj=io.BytesIO(data), mode=mode) as tar:
+            for member in tar:
+                content = tar.extractfile(member).read() \
+                        if member.isfile() else None
+                members[member.name] = (member, content)
+        return members
+
+    def test_archive_tar(self, temp_git_dir):
+        """测试分支1: tar格式包含所有文件、目录、权限和提交时间"""
+        output_file = io.BytesIO()
+        pygit.archive(temp_git_dir, output_file)
+
+        members = self.read_archive(output_file.getvalue(), 'r:')
+        assert list(members) == ['README', 'bin', 'bin/run.sh']
+        readme, content = members['README']
+        assert content == b'readme\n'
+        assert readme.mode == 0o644
+        assert readme.mtime == 1600000000
+        assert members['bin'][0].isdir()
+        script, content = members['bin/run.sh']
+        assert script.mode == 0o755
+        assert content == b'x' * 200000
+
+    def test_archive_tgz(self, temp_git_dir):
+        """测试分支2: tgz格式可以被gzip解压并得到相同内容"""
+        output_file = io.BytesIO()
+        pygit.archive(temp_git_dir[:10], output_file, archive_format='tgz')
+
+        members = self.read_archive(output_file.getvalue(), 'r:gz')
+        assert members['bin/run.sh'][1] == b'x' * 200000
+
+    def test_archive_unknown_format(self, temp_git_dir):
+        """测试分支3: 不支持的格式抛出ValueError"""
+        with pytest.raises(ValueError, match='unknown archive format'):
+            pygit.archive(temp_git_dir, io.BytesIO(), archive_format='zip')
+
+
+class TestGrep:
+    """测试grep函数 - 在提交的树中并行搜索文件内容"""
+
+    @pytest.fixture
+    def temp_git_dir(self):
+        """创建临时的.git目录，并写入一个包含文本和二进制文件的提交"""
+        temp_dir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(temp_dir, '.git', 'objects'))
+        original_cwd = os.getcwd()
+        os.chdir(temp_dir)
+        blobs = {
+            'b.txt': b'alpha\nTODO: fix b\nomega',
+            'a.txt': b'todo lower\nnothing\nTODO: fix a\n',
+            'data.bin': b'TODO\x00\x01binary',
+        }
+        sha1s = {name: pygit.hash_object(data, 'blob')
+                 for name, data in blobs.items()}
+        sub_tree = pygit.hash_object(
+                b'100644 c.txt\x00' + bytes.fromhex(sha1s['b.txt']), 'tree')
+        tree_data = b''.join(
+                '100644 {}\x00'.format(name).encode() +
+                bytes.fromhex(sha1s[name]) for name in sorted(blobs))
+        tree = pygit.hash_object(
+                tree_data + b'40000 sub\x00' + bytes.fromhex(sub_tree), 'tree')
+        commit = pygit.hash_object(
+                'tree {}\n\nmsg\n'.format(tree).encode(), 'commit')
+        yield commit
+        os.chdir(original_cwd)
+        shutil.rmtree(temp_dir)
+
+    def test_grep_in_path_order(self, temp_git_dir):
+        """测试分支1: 结果按路径排序，包含行号，跳过二进制文件"""
+        results = list(pygit.grep('TODO', rev=temp_git_dir))
+
+        assert results == [
+            ('a.txt', 3, b'TODO: fix a'),
+            ('b.txt', 2, b'TODO: fix b'),
+            ('sub/c.txt', 2, b'TODO: fix b'),
+        ]
+
+    def test_grep_ignore_case_and_anchors(self, temp_git_dir):
+        """测试分支2: 忽略大小写，^和$按行匹配"""
+        results = list(pygit.grep('^todo', rev=temp_git_dir,
+                                  ignore_case=True))
+        assert [(p, n) for p, n, line in results] == [
+                ('a.txt', 1), ('a.txt', 3), ('b.txt', 2), ('sub/c.txt', 2)]
+        assert list(pygit.grep('ga$', rev=temp_git_dir)) == [
+                ('b.txt', 3, b'omega'), ('sub/c.txt', 3, b'omega')]
+
+
+class TestRenames:
+    """测试重命名检测 - 精确哈希匹配和基于MinHash的相似度匹配"""
+
+    @pytest.fixture
+    def temp_repo(self):
+        """创建临时仓库并切换到仓库目录"""
+        temp_dir = tempfile.mkdtemp()
+        original_cwd = os.getcwd()
+        os.chdir(temp_dir)
+        pygit.init('repo')
+        os.chdir('repo')
+        yield temp_dir
+        os.chdir(original_cwd)
+        shutil.rmtree(temp_dir)
+
+    def add_files(self, files):
+        """写入文件并加入index"""
+        for path, data in files.items():
+            with open(path, 'wb') as f:
+                f.write(data)
+        pygit.add(sorted(files))
+
+    def move(self, old_path, new_path, data=None):
+        """移动文件，可选地修改内容"""
+        os.rename(old_path, new_path)
+        if data is not None:
+            with open(new_path, 'wb') as f:
+                f.write(data)
+
+    def test_exact_and_similar_renames(self, temp_repo):
+        """测试分支1: 内容相同和内容相似的移动都被识别为重命名"""
+        lines = [b'line %d\n' % i for i in range(20)]
+        self.add_files({'same.txt': b'identical content\n',
+                        'edit.txt': b''.join(lines),
+                        'gone.txt': b'completely different\n'})
+        self.move('same.txt', 'same2.txt')
+        self.move('edit.txt', 'edit2.txt', b''.join(lines[:18]) + b'new\n')
+        os.remove('gone.txt')
+        with open('other.txt', 'wb') as f:
+            f.write(b'unrelated\n')
+
+        changed, new, deleted = pygit.get_status()
+        renames = pygit.find_renames(deleted, new)
+
+        assert renames == [('edit.txt', 'edit2.txt', 0.9),
+                           ('same.txt', 'same2.txt', 1.0)]
+
+    def test_status_and_diff_show_renames(self, temp_repo, capsys):
+        """测试分支2: status和diff显示重命名而不是删除加新增"""
+        self.add_files({'a.txt': b'one\ntwo\nthree\nfour\n'})
+        self.move('a.txt', 'b.txt', b'one\ntwo\nthree\nFOUR\n')
+
+        pygit.status()
+        pygit.diff()
+
+        output = capsys.readouterr().out
+        assert 'renamed files:\n    a.txt -> b.txt (75%)' in output
+        assert 'new files' not in output
+        assert 'rename from a.txt\nrename to b.txt\n' in output
+        assert '-four\n+FOUR' in output
+        assert '+one' not in output
+
+    def test_directory_move_uses_lsh_buckets(self, temp_repo):
+        """测试分支3: 大量文件移动时只对LSH候选对计算相似度"""
+        files = {'f{:02}.txt'.format(i): b''.join(
+                b'file %d line %d\n' % (i, j) for j in range(40))
+                 for i in range(30)}
+        self.add_files(files)
+        for path, data in files.items():
+            self.move(path, 'moved_' + path, data + b'extra\n')
+
+        changed, new, deleted = pygit.get_status()
+        with patch('pygit.similarity', wraps=pygit.similarity) as mock_sim:
+            renames = pygit.find_renames(deleted, new)
+
+        assert [(old, new) for old, new, score in renames] == [
+                (path, 'moved_' + path) for path in sorted(files)]
+        assert mock_sim.call_count < len(files) * 2
+
+    def test_similarity(self):
+        """测试分支4: 相似度按较长文件的行数计算"""
+        assert pygit.similarity([b'a', b'b'], [b'a', b'b']) == 1.0
+        assert pygit.similarity([b'a', b'b', b'c', b'd'], [b'a']) == 0.25
+        assert pygit.similarity([], []) == 0.0
+
+
+class TestPushAll:
+    """测试多远程推送 - 并行查询引用、共享pack并分别报告每个远程的状态"""
+
+    @pytest.fixture
+    def temp_repo(self):
+        """创建临时仓库并切换到仓库目录"""
+        temp_dir = tempfile.mkdtemp()
+        original_cwd = os.getcwd()
+        os.chdir(temp_dir)
+        pygit.init('repo')
+        os.chdir('repo')
+        yield temp_dir
+        os.chdir(original_cwd)
+        shutil.rmtree(temp_dir)
+
+    @pytest.fixture
+    def start_server(self):
+        """返回启动替身receive-pack服务器的函数，测试结束后关闭服务器"""
+        servers = []
+
+        def start(remote_refs, fail=False, upload_refs=None):
+            pushes = []
+
+            class Handler(http.server.BaseHTTPRequestHandler):
+                def log_message(self, *args):
+                    pass
+
+                def respond(self, body, code=200):
+                    self.send_response(code)
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+                def do_GET(self):
+                    service = self.path.split('service=')[1]
+                    refs = remote_refs
+                    if (service == 'git-upload-pack' and
+                            upload_refs is not None):
+                        refs = upload_refs
+                    lines = ['{} {}'.format(sha1, name).encode()
+                             for name, sha1 in sorted(refs.items())]
+                    if not lines:
+                        lines = [b'0' * 40 + b' capabilities^{}']
+                    lines[0] += b'\x00report-status'
+                    header = '# service={}\n'.format(service).encode()
+                    self.respond('{:04x}'.format(len(header) + 4).encode() +
+                                 header + b'0000' +
+                                 pygit.build_lines_data(lines))
+
+                def do_POST(self):
+                    length = int(self.headers['Content-Length'])
+                    body = self.rfile.read(length)
+                    if fail:
+                        self.respond(b'', code=500)
+                        return
+                    command = body[4:int(body[:4], 16)]
+                    old, new, name = command.split(b'\x00')[0].split()
+                    pushes.append((old.decode(), new.decode(), body))
+                    remote_refs[name.decode()] = new.decode()
+                    self.respond(pygit.build_lines_data(
+                            [b'unpack ok', b'ok ' + name]))
+
+            server = http.server.ThreadingHTTPServer(('127.0.0.1', 0),
+                                                     Handler)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            servers.append(server)
+            return ('http://127.0.0.1:{}'.format(server.server_port), pushes)
+
+        yield start
+        for server in servers:
+            server.shutdown()
+            server.server_close()
+
+    def make_commit(self, data, message='msg'):
+        """写入一个文件并提交，返回提交哈希"""
+        with open('file.txt', 'wb') as f:
+            f.write(data)
+        pygit.add(['file.txt'])
+        return pygit.commit(message, author='Test <test@example.com>')
+
+    def test_agreeing_remotes_share_one_pack(self, temp_repo, start_server):
+        """测试分支1: 远程状态一致时只生成一个pack并推送到所有远程"""
+        sha1 = self.make_commit(b'one')
+        servers = [start_server({}) for _ in range(3)]
+
+        with patch('pygit.create_pack', wraps=pygit.create_pack) as mock_pack:
+            results = pygit.push_all([url for url, _ in servers],
+                                     username='u', password='p')
+
+        assert mock_pack.call_count == 1
+        for url, pushes in servers:
+            assert results[url] == (None, 3, None)
+            assert [(old, new) for old, new, _ in pushes] == [('0' * 40, sha1)]
+            assert b'PACK' in pushes[0][2]
+
+    def test_diverging_remotes_get_own_packs(self, temp_repo, start_server):
+        """测试分支2: 远程状态不同时为每种状态生成各自的pack"""
+        first = self.make_commit(b'one')
+        second = self.make_commit(b'two')
+        behind_url, behind_pushes = start_server(
+                {'refs/heads/master': first})
+        empty_url, empty_pushes = start_server({})
+
+        with patch('pygit.create_pack', wraps=pygit.create_pack) as mock_pack:
+            results = pygit.push_all([behind_url, empty_url],
+                                     username='u', password='p')
+
+        assert mock_pack.call_count == 2
+        assert results[behind_url] == (first, 3, None)
+        assert results[empty_url] == (None, 6, None)
+        assert behind_pushes[0][:2] == (first, second)
+        assert empty_pushes[0][:2] == ('0' * 40, second)
+
+    def test_non_fast_forward_refused(self, temp_repo, start_server):
+        """测试分支4: 远程提交不是本地提交的祖先时拒绝推送，强制推送时照常推送"""
+        first = self.make_commit(b'one')
+        second = self.make_commit(b'two')
+        url, pushes = start_server({'refs/heads/master': second})
+
+        with pytest.raises(ValueError, match='non-fast-forward'):
+            pygit.push(url, username='u', password='p',
+                       refspec=first + ':master')
+        results = pygit.push_all([url], username='u', password='p',
+                                 refspec=first + ':master')
+        assert 'non-fast-forward' in results[url][2]
+        assert pushes == []
+
+        with patch('builtins.print'):
+            pygit.push(url, username='u', password='p',
+                       refspec='+' + first + ':master')
+        assert [(old, new) for old, new, _ in pushes] == [(second, first)]
+
+    def test_fast_forward_from_packed_tip(self, temp_repo, start_server):
+        """测试分支6: 远程提交只在pack中时仍判断为快进"""
+        first = self.make_commit(b'one')
+        store = pygit.get_repository().object_store
+        objects = pygit.find_commit_objects(first)
+        pack_dir = os.path.join('.git', 'objects', 'pack')
+        os.makedirs(pack_dir)
+        pack_path = os.path.join(pack_dir, 'pack-1.pack')
+        with open(pack_path, 'wb') as f:
+            f.write(pygit.create_pack(objects))
+        pygit.index_pack(pack_path)
+        for sha1 in objects:
+            os.remove(store.path(sha1))
+        second = self.make_commit(b'two')
+        url, pushes = start_server({'refs/heads/master': first})
+
+        with patch('builtins.print'):
+            pygit.push(url, username='u', password='p')
+        assert [(old, new) for old, new, _ in pushes] == [(first, second)]
+
+    def test_fast_forward_from_shared_clone(self, temp_repo, start_server):
+        """测试分支7: 远程提交只在alternates中时仍判断为快进"""
+        first = self.make_commit(b'one')
+        os.chdir(temp_repo)
+        pygit.clone('repo', 'clone', shared=True)
+        os.chdir('clone')
+        second = self.make_commit(b'two')
+        url, pushes = start_server({'refs/heads/master': first})
+
+        results = pygit.push_all([url], username='u', password='p')
+        assert results[url][:2] == (first, 3)
+        assert results[url][2] is None
+        assert [(old, new) for old, new, _ in pushes] == [(first, second)]
+
+    def test_failing_remote_reported_separately(self, temp_repo, start_server):
+        """测试分支3: 一个远程失败不影响其他远程，错误按URL报告"""
+        sha1 = self.make_commit(b'one')
+        good_url, good_pushes = start_server({})
+        bad_url, _ = start_server({}, fail=True)
+        with open(os.path.join('.git', 'config'), 'a') as f:
+            f.write('[remote "a"]\n\turl = {}\n'
+                    '[remote "b"]\n\turl = http://unused\n'
+                    '\tpushurl = {}\n'.format(good_url, bad_url))
+
+        urls = pygit.read_remote_urls()
+        results = pygit.push_all(urls, username='u', password='p')
+
+        assert urls == [good_url, bad_url]
+        assert results[good_url] == (None, 3, None)
+        assert good_pushes[0][1] == sha1
+        assert results[bad_url][2] is not None
+        assert '500' in results[bad_url][2]
+
+    def test_old_sha1_from_receive_pack(self, temp_repo, start_server):
+        """测试分支5: 旧SHA-1取自receive-pack的引用公告，而不是upload-pack"""
+        first = self.make_commit(b'one')
+        second = self.make_commit(b'two')
+        url, pushes = start_server({'refs/heads/master': first},
+                                   upload_refs={})
+
+        results = pygit.push_all([url], username='u', password='p')
+        assert results[url] == (first, 3, None)
+        with patch('builtins.print'):
+            assert pygit.push(url, username='u', password='p')[0] == second
+        assert [(old, new) for old, new, _ in pushes] == [
+                (first, second), (second, second)]
+
+
+class TestRepository:
+    """测试Repository句柄 - 按路径操作仓库并复用已解析的缓存"""
+
+    @pytest.fixture
+    def temp_dir(self):
+        """创建临时目录，在其中初始化两个仓库（不切换到仓库目录）"""
+        temp_dir = tempfile.mkdtemp()
+        original_cwd = os.getcwd()
+        os.chdir(temp_dir)
+        pygit.init('one')
+        pygit.init('two')
+        yield temp_dir
+        os.chdir(original_cwd)
+        shutil.rmtree(temp_dir)
+
+    def test_repositories_by_path(self, temp_dir):
+        """测试分支1: 不切换目录即可分别读写两个仓库的对象和引用"""
+        one = pygit.Repository(os.path.join(temp_dir, 'one'))
+        two = pygit.get_repository('two')
+        sha1 = one.hash_object(b'only in one', 'blob')
+        one.write_ref('refs/heads/master', sha1)
+
+        assert pygit.get_repository('two') is two
+        assert one.read_object(sha1) == ('blob', b'only in one')
+        with pytest.raises(ValueError, match='not found'):
+            two.read_object(sha1)
+        assert one.list_refs() == [('refs/heads/master', sha1)]
+        assert two.read_ref('HEAD') is None
+        assert not os.path.exists(os.path.join(temp_dir, '.git'))
+
+    def test_index_parsed_once(self, temp_dir):
+        """测试分支2: 索引未变化时不重复解析，写入后读到新内容"""
+        os.chdir('one')
+        with open('a.txt', 'wb') as f:
+            f.write(b'a')
+        pygit.add(['a.txt'])
+        repo = pygit.get_repository()
+
+        with patch('pygit.read_file', wraps=pygit.read_file) as mock_read:
+            first = repo.read_index()
+            first.append(None)
+            second = repo.read_index()
+        assert mock_read.call_count == 0
+        assert [e.path for e in second] == ['a.txt']
+
+        with open('b.txt', 'wb') as f:
+            f.write(b'b')
+        pygit.add(['b.txt'])
+        assert [e.path for e in pygit.read_index()] == ['a.txt', 'b.txt']
+
+    def test_objects_cached(self, temp_dir):
+        """测试分支3: 重复读取同一对象时使用缓存，不再读取对象文件"""
+        repo = pygit.get_repository('one')
+        sha1 = repo.hash_object(b'data', 'blob')
+        repo.read_object(sha1[:7])
+
+        with patch.object(repo.object_store, 'read',
+                          side_effect=AssertionError):
+            assert repo.read_object(sha1) == ('blob', b'data')
+            assert repo.read_object(sha1[:7]) == ('blob', b'data')
+
+    def test_handles_bounded(self, temp_dir):
+        """测试分支4: 只保留最近使用的REPOSITORY_CACHE_SIZE个句柄"""
+        os.mkdir('three')
+        with patch('pygit.REPOSITORY_CACHE_SIZE', 2), \
+                patch('pygit._repositories', collections.OrderedDict()):
+            one = pygit.get_repository('one')
+            two = pygit.get_repository('two')
+            assert pygit.get_repository('one') is one
+            pygit.get_repository('three')
+            assert pygit.get_repository('one') is one
+            assert pygit.get_repository('two') is not two
+            assert pygit.get_repository(two) is two
+
+    def test_commands_take_repo(self, temp_dir, capsys):
+        """测试分支5: 命令通过repo参数操作其他目录的仓库，不依赖当前目录"""
+        one = pygit.get_repository('one')
+        os.makedirs(os.path.join('one', 'sub'))
+        for path, data in [('a.txt', b'a\nb\n'), ('sub/b.txt', b'b\n')]:
+            with open(os.path.join('one', path), 'wb') as f:
+                f.write(data)
+        pygit.add(['a.txt', 'sub/b.txt'], repo='one')
+        first = pygit.commit('first', author='Test <test@example.com>',
+                             repo=one)
+        with open(os.path.join('one', 'a.txt'), 'wb') as f:
+            f.write(b'a\nc\n')
+        pygit.add(['a.txt'], repo=one)
+        second = pygit.commit('second', author='Test <test@example.com>',
+                              repo='one')
+
+        assert pygit.get_status(one) == ([], [], [])
+        assert [sha1 for sha1, info in pygit.log(repo=one)] == [second, first]
+        assert [sha1 for sha1, info in pygit.log(path='sub', repo='one')] \
+                == [first]
+        assert list(pygit.grep('c', repo=one)) == [('a.txt', 2, b'c')]
+        assert {line: sha1 for sha1, _, line, _ in
+                pygit.blame('a.txt', repo=one)} == {1: first, 2: second}
+        output_file = io.BytesIO()
+        pygit.archive('HEAD', output_file, repo=one)
+        assert output_file.getvalue()
+        assert pygit.write_bitmaps(repo=one)[0] == 1
+        assert pygit.fsck(max_workers=1, repo=one) == (8, {}, {})
+
+        pygit.checkout(first, repo='one')
+        assert pygit.read_file(os.path.join('one', 'a.txt')) == b'a\nb\n'
+        assert pygit.read_ref('HEAD', one) == first
+        pygit.status(repo=one)
+        pygit.diff(repo=one)
+        assert capsys.readouterr().out.startswith('committed to master')
+        assert not os.path.exists('.git')
+        assert not os.path.exists('a.txt')
+
+    def test_object_commands_take_repo(self, temp_dir, capsys):
+        """测试分支6: 合并基、打包、cat-file和引用命令通过repo参数操作其他目录的仓库"""
+        one = pygit.get_repository('one')
+        author = 'Test <test@example.com>'
+        with open(os.path.join('one', 'a.txt'), 'wb') as f:
+            f.write(b'a\n')
+        pygit.add(['a.txt'], repo=one)
+        first = pygit.commit('first', author=author, repo=one)
+        pygit.create_branch('topic', repo='one')
+        with open(os.path.join('one', 'a.txt'), 'wb') as f:
+            f.write(b'b\n')
+        pygit.add(['a.txt'], repo=one)
+        second = pygit.commit('second', author=author, repo=one)
+        capsys.readouterr()
+
+        assert pygit.merge_bases('topic', 'master', repo='one') == [first]
+        assert pygit.is_ancestor('topic', 'master', repo=one)
+        assert pygit.ahead_behind('topic', 'master', repo=one) == (0, 1)
+        assert pygit.count_commits('topic..master', repo=one) == 1
+        missing = pygit.find_missing_objects(second, first, repo=one)
+        assert len(missing) == 3
+        pack_path = os.path.join('one', '.git', 'objects', 'pack',
+                                 'pack-1.pack')
+        os.makedirs(os.path.dirname(pack_path), exist_ok=True)
+        pygit.write_file(pack_path, pygit.create_pack(
+                pygit.find_commit_objects(second, one), repo=one))
+        assert pygit.index_pack(pack_path, repo=one) == 6
+        assert pygit.write_multi_pack_index(repo='one') == (1, 6)
+        assert pygit.verify_multi_pack_index(repo=one) == []
+
+        output_file = io.BytesIO()
+        pygit.cat_file_batch(input_file=io.BytesIO(b'topic\n'),
+                             output_file=output_file, repo=one)
+        assert output_file.getvalue().startswith(first.encode() + b' commit')
+        assert pygit.read_object_header(second, repo=one)[0] == 'commit'
+        pygit.cat_file('type', second, repo='one')
+        assert capsys.readouterr().out == 'commit\n'
+
+        assert pygit.pack_refs(repo=one) == 2
+        assert pygit.read_packed_refs(repo=one).by_name['refs/heads/topic'] \
+                == first
+        assert pygit.migrate_objects('sqlite', repo='one') > 0
+        assert pygit.read_object(second, one)[0] == 'commit'
+        pygit.write_sparse_cone(['sub'], repo=one)
+        assert pygit.read_file(one.git_path('info', 'sparse-checkout')) \
+                == b'/*\n!/*/\n/sub/\n'
+        assert not os.path.exists('.git')
+
+
+class TestSqliteObjectStore:
+    """测试SQLite对象库 - 读写、前缀查找、事务以及与松散对象之间的迁移"""
+
+    @pytest.fixture
+    def temp_dir(self):
+        """创建临时目录并切换到该目录"""
+        temp_dir = tempfile.mkdtemp()
+        original_cwd = os.getcwd()
+        os.chdir(temp_dir)
+        yield temp_dir
+        os.chdir(original_cwd)
+        shutil.rmtree(temp_dir)
+
+    def test_read_write_in_sqlite(self, temp_dir):
+        """测试分支1: sqlite仓库的对象写入数据库而不是松散文件"""
+        pygit.init('repo', object_store='sqlite')
+        os.chdir('repo')
+        sha1 = pygit.hash_object(b'hello', 'blob')
+        output = io.BytesIO()
+
+        assert isinstance(pygit.get_repository().object_store,
+                          pygit.SqliteObjectStore)
+        assert os.listdir(os.path.join('.git', 'objects')) == []
+        assert pygit.read_object(sha1[:6]) == ('blob', b'hello')
+        assert pygit.write_object_data(sha1, output) == ('blob', 5)
+        assert output.getvalue() == b'hello'
+        with pytest.raises(ValueError, match='not found'):
+            pygit.find_object('0000')
+
+    def test_transaction_rolls_back(self, temp_dir):
+        """测试分支2: 事务中出错时回滚，批量写入的对象都不保留"""
+        pygit.init('repo', object_store='sqlite')
+        store = pygit.get_repository('repo').object_store
+        sha1 = hashlib.sha1(b'blob 1\x00a').hexdigest()
+
+        with pytest.raises(RuntimeError):
+            with store.transaction():
+                store.write(sha1, b'blob 1\x00a')
+                raise RuntimeError('stop')
+        assert not store.contains(sha1)
+        with store.transaction():
+            store.write(sha1, b'blob 1\x00a')
+        assert list(store.list()) == [sha1]
+
+    def test_migrate_round_trip(self, temp_dir):
+        """测试分支3: 松散对象迁移到sqlite再迁回后，提交历史保持不变"""
+        pygit.init('repo')
+        os.chdir('repo')
+        with open('a.txt', 'wb') as f:
+            f.write(b'a')
+        pygit.add(['a.txt'])
+        sha1 = pygit.commit('first', author='Test <test@example.com>')
+
+        assert pygit.migrate_objects('sqlite') == 3
+        assert os.listdir(os.path.join('.git', 'objects')) == ['info']
+        assert [s for s, _ in pygit.log()] == [sha1]
+        with pytest.raises(ValueError, match='already'):
+            pygit.migrate_objects('sqlite')
+
+        assert pygit.migrate_objects('loose') == 3
+        assert not os.path.exists(os.path.join('.git', 'objects.sqlite'))
+        assert pygit.read_commit_info(sha1).message == 'first\n'
+
+    def test_store_interface(self, temp_dir):
+        """测试分支4: ObjectStore是抽象基类，create()显式创建数据库"""
+        with pytest.raises(TypeError):
+            pygit.ObjectStore()
+
+        store = pygit.SqliteObjectStore('objects.sqlite')
+        store.create()
+        store.close()
+        with sqlite3.connect('objects.sqlite') as conn:
+            tables = conn.execute('SELECT name FROM sqlite_master').fetchall()
+        assert ('objects',) in tables
+
+
+class TestIndexSkipHash:
+    """测试索引缓存和index.skipHash选项 - 空校验和写入与跳过校验"""
+
+    @pytest.fixture
+    def temp_repo(self):
+        """创建临时仓库，添加一个文件并切换到仓库目录"""
+        temp_dir = tempfile.mkdtemp()
+        original_cwd = os.getcwd()
+        os.chdir(temp_dir)
+        pygit.init('repo')
+        os.chdir('repo')
+        with open('a.txt', 'wb') as f:
+            f.write(b'a')
+        yield temp_dir
+        os.chdir(original_cwd)
+        shutil.rmtree(temp_dir)
+
+    def set_skip_hash(self):
+        """在.git/config中打开index.skipHash"""
+        with open(os.path.join('.git', 'config'), 'w') as f:
+            f.write('[core]\n\tbare = false\n[index]\n\tskipHash = true\n')
+
+    def test_writes_null_trailer(self, temp_repo):
+        """测试分支1: 打开skipHash后写入全零校验和，仍可正常读取"""
+        self.set_skip_hash()
+        pygit.add(['a.txt'])
+
+        assert pygit.read_file(os.path.join('.git', 'index'))[-20:] == \
+                b'\x00' * 20
+        pygit.get_repository()._index = None
+        assert [e.path for e in pygit.read_index()] == ['a.txt']
+
+    def test_read_skips_checksum(self, temp_repo):
+        """测试分支2: 校验和为全零时读取不计算SHA-1"""
+        self.set_skip_hash()
+        pygit.add(['a.txt'])
+        repo = pygit.Repository('.')
+
+        with patch('hashlib.sha1') as mock_sha1:
+            assert [e.path for e in repo.read_index()] == ['a.txt']
+        mock_sha1.assert_not_called()
+        assert repo.config_bool('index.skiphash')
+        assert not repo.config_bool('core.bare', default=True)
+
+    def test_read_after_option_turned_off(self, temp_repo):
+        """测试分支3: 打开skipHash写入后再关闭，读取仍按全零校验和跳过校验"""
+        self.set_skip_hash()
+        pygit.add(['a.txt'])
+        repo = pygit.Repository('.')
+        repo.set_config('index.skipHash', 'false')
+
+        assert not repo.config_bool('index.skiphash')
+        assert [e.path for e in repo.read_index()] == ['a.txt']
+
+    def test_checksum_verified_with_option_on(self, temp_repo):
+        """测试分支4: 关闭skipHash写入的索引，打开选项后仍校验非零校验和"""
+        pygit.add(['a.txt'])
+        path = os.path.join('.git', 'index')
+        data = pygit.read_file(path)
+        pygit.write_file(path, data[:-20] + bytes(19) + b'\x01')
+        self.set_skip_hash()
+
+        with pytest.raises(ValueError, match='invalid index checksum'):
+            pygit.Repository('.').read_index()
+
+    def test_cache_invalidated_by_replaced_file(self, temp_repo):
+        """测试分支5: 其他进程替换索引文件后重新解析"""
+        pygit.add(['a.txt'])
+        repo = pygit.get_repository()
+        entries = repo.read_index()
+        other = pygit.Repository('.')
+        other.write_index([])
+
+        assert repo.read_index() == []
+        other.write_index(entries)
+        assert repo.read_index() == entries
+
+
+class TestSplitIndex:
+    """测试拆分索引 - 共享基础索引加小的增量索引，读取时合并，变化过多时折叠"""
+
+    @pytest.fixture
+    def temp_repo(self):
+        """创建临时仓库，打开core.splitIndex并添加10个文件"""
+        temp_dir = tempfile.mkdtemp()
+        original_cwd = os.getcwd()
+        os.chdir(temp_dir)
+        pygit.init('repo')
+        os.chdir('repo')
+        pygit.get_repository().set_config('core.splitIndex', 'true')
+        for i in range(10):
+            with open('f{}.txt'.format(i), 'wb') as f:
+                f.write(str(i).encode())
+        pygit.add(['f{}.txt'.format(i) for i in range(10)])
+        yield temp_dir
+        os.chdir(original_cwd)
+        shutil.rmtree(temp_dir)
+
+    def shared_index_files(self):
+        """返回.git下的sharedindex.*文件名列表"""
+        return [name for name in os.listdir('.git')
+                if name.startswith('sharedindex.')]
+
+    def test_add_writes_only_changes(self, temp_repo):
+        """测试分支1: 修改一个文件后只写入增量，新的Repository读取结果与合并前一致"""
+        shared = self.shared_index_files()
+        with open('f3.txt', 'wb') as f:
+            f.write(b'changed')
+        with open('new.txt', 'wb') as f:
+            f.write(b'new')
+        pygit.add(['f3.txt', 'new.txt'])
+
+        assert self.shared_index_files() == shared
+        split_entries, extensions = pygit.parse_index_data(
+                pygit.read_file(os.path.join('.git', 'index')))
+        assert [e.path for e in split_entries] == ['', 'new.txt']
+        assert b'link' in extensions
+        entries = pygit.Repository('.').read_index()
+        assert entries == pygit.read_index()
+        assert [e.path for e in entries] == sorted(
+                ['f{}.txt'.format(i) for i in range(10)] + ['new.txt'])
+        f3 = [e for e in entries if e.path == 'f3.txt'][0]
+        assert f3.sha1 == bytes.fromhex(
+                pygit.hash_object(b'changed', 'blob', write=False))
+
+    def test_removal_recorded_in_delete_bitmap(self, temp_repo):
+        """测试分支2: 删除条目记录在删除位图中"""
+        entries = pygit.read_index()
+        pygit.write_index([e for e in entries if e.path != 'f5.txt'])
+
+        split_entries, extensions = pygit.parse_index_data(
+                pygit.read_file(os.path.join('.git', 'index')))
+        assert split_entries == []
+        deleted, _ = pygit.decode_ewah(extensions[b'link'], 20)
+        assert deleted == [5]
+        assert 'f5.txt' not in [e.path for e in
+                                pygit.Repository('.').read_index()]
+
+    def test_folds_when_delta_too_large(self, temp_repo):
+        """测试分支3: 增量超过splitIndex.maxPercentChange时写入新的共享索引，旧的暂时保留"""
+        old_shared = self.shared_index_files()
+        entries = pygit.read_index()
+        pygit.write_index(entries[:7])
+
+        shared = [name for name in self.shared_index_files()
+                  if name not in old_shared]
+        assert len(shared) == 1
+        assert sorted(self.shared_index_files()) == sorted(shared + old_shared)
+        split_entries, extensions = pygit.parse_index_data(
+                pygit.read_file(os.path.join('.git', 'index')))
+        assert split_entries == []
+        assert extensions[b'link'][:20].hex() == shared[0][12:]
+        assert pygit.Repository('.').read_index() == entries[:7]
+
+    def test_ewah_round_trip(self):
+        """测试分支4: EWAH位图编码后解码得到相同的位置"""
+        for positions in ([], [0], [5, 63, 64, 1000], list(range(130))):
+            data = pygit.encode_ewah(positions)
+            assert pygit.decode_ewah(data) == (positions, len(data))
+
+    def test_expired_shared_index_removed(self, temp_repo):
+        """测试分支5: 只删除超过SHARED_INDEX_EXPIRE未使用的旧共享索引"""
+        old_shared = self.shared_index_files()
+        old_path = os.path.join('.git', old_shared[0])
+        entries = pygit.read_index()
+        pygit.write_index(entries[:7])
+        pygit.write_index(entries[:4])
+        assert len(self.shared_index_files()) == 3
+
+        expired = time.time() - pygit.SHARED_INDEX_EXPIRE - 60
+        os.utime(old_path, (expired, expired))
+        pygit.write_index(entries[:1])
+
+        shared = self.shared_index_files()
+        assert len(shared) == 3 and old_shared[0] not in shared
+        link = pygit.parse_index_data(
+                pygit.read_file(os.path.join('.git', 'index')))[1][b'link']
+        assert 'sharedindex.' + link[:20].hex() in shared
+
+    def test_used_shared_index_refreshed(self, temp_repo):
+        """测试分支6: 复用共享索引时刷新其修改时间"""
+        path = os.path.join('.git', self.shared_index_files()[0])
+        expired = time.time() - pygit.SHARED_INDEX_EXPIRE - 60
+        os.utime(path, (expired, expired))
+        with open('f3.txt', 'wb') as f:
+            f.write(b'changed')
+        pygit.add(['f3.txt'])
+
+        assert os.stat(path).st_mtime > expired + 60
+
+
+class TestSparseCheckout:
+    """测试稀疏检出 - cone定义、稀疏索引中的目录条目以及status跳过这些目录"""
+
+    FILES = {
+        'top.txt': b'top',
+        'src/s.txt': b's',
+        'src/app/a.txt': b'a',
+        'src/lib/l.txt': b'l',
+        'docs/d.txt': b'd',
+        'docs/deep/x.txt': b'x',
+    }
+
+    @pytest.fixture
+    def temp_repo(self):
+        """创建临时仓库，提交多层目录中的文件"""
+        temp_dir = tempfile.mkdtemp()
+        original_cwd = os.getcwd()
+        os.chdir(temp_dir)
+        pygit.init('repo')
+        os.chdir('repo')
+        for path, data in self.FILES.items():
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            with open(path, 'wb') as f:
+                f.write(data)
+        pygit.add(sorted(self.FILES))
+        self.first = pygit.commit('first', author='Test <test@example.com>')
+        yield temp_dir
+        os.chdir(original_cwd)
+        shutil.rmtree(temp_dir)
+
+    def test_set_collapses_outside_cone(self, temp_repo):
+        """测试分支1: cone外的目录折叠为一个索引条目，status不遍历它们"""
+        written, removed = pygit.sparse_checkout(['src/app'])
+
+        assert removed == ['docs/d.txt', 'docs/deep/x.txt', 'src/lib/l.txt']
+        assert not os.path.exists('docs')
+        assert [e.path for e in pygit.read_index()] == [
+                'docs/', 'src/app/a.txt', 'src/lib/', 'src/s.txt', 'top.txt']
+        assert pygit.read_sparse_cone() == ['src/app']
+        os.makedirs('docs')
+        with open(os.path.join('docs', 'stray.txt'), 'wb') as f:
+            f.write(b'not walked')
+        assert pygit.get_status() == ([], [], [])
+
+    def test_commit_and_checkout_stay_sparse(self, temp_repo):
+        """测试分支2: 稀疏索引提交的树与完整索引相同，检出时不展开cone外目录"""
+        full_tree = pygit.write_tree()
+        pygit.sparse_checkout(['src/app'])
+        assert pygit.write_tree() == full_tree
+
+        with open(os.path.join('src', 'app', 'a.txt'), 'wb') as f:
+            f.write(b'a2')
+        pygit.add(['src/app/a.txt'])
+        second = pygit.commit('second', author='Test <test@example.com>')
+        assert pygit.read_tree_recursive(pygit.read_commit_tree(second))[
+                'docs/deep/x.txt'][1] == pygit.hash_object(b'x', 'blob',
+                                                           write=False)
+
+        with patch('pygit.read_tree', wraps=pygit.read_tree) as mock_read:
+            written, deleted = pygit.checkout(self.first)
+        assert written == ['src/app/a.txt']
+        assert mock_read.call_count == 3
+        assert 'docs/' in [e.path for e in pygit.read_index()]
+
+    def test_disable_restores_files(self, temp_repo):
+        """测试分支3: 关闭稀疏检出后恢复所有文件；有本地修改时拒绝移除"""
+        with open(os.path.join('docs', 'd.txt'), 'wb') as f:
+            f.write(b'local edit')
+        with pytest.raises(ValueError, match='local changes'):
+            pygit.sparse_checkout(['src'])
+        with open(os.path.join('docs', 'd.txt'), 'wb') as f:
+            f.write(b'd')
+        pygit.sparse_checkout(['src'])
+
+        written, removed = pygit.sparse_checkout(None)
+
+        assert written == ['docs/d.txt', 'docs/deep/x.txt']
+        assert pygit.read_sparse_cone() is None
+        assert pygit.read_file(os.path.join('docs', 'deep', 'x.txt')) == b'x'
+        assert pygit.get_status() == ([], [], [])
+        repo = pygit.Repository('.')
+        assert not repo.config_bool('index.sparse')
+        assert not repo.config_bool('core.sparsecheckoutcone')
+
+    def test_takes_repo(self, temp_repo):
+        """测试分支4: 通过repo参数在其他目录下设置和关闭稀疏检出"""
+        os.chdir(temp_repo)
+        repo = pygit.get_repository('repo')
+
+        written, removed = pygit.sparse_checkout(['src/app'], repo='repo')
+        assert removed == ['docs/d.txt', 'docs/deep/x.txt', 'src/lib/l.txt']
+        assert not os.path.exists(os.path.join('repo', 'docs'))
+        assert pygit.read_sparse_cone(repo) == ['src/app']
+        assert pygit.get_status(repo) == ([], [], [])
+
+        written, removed = pygit.sparse_checkout(None, repo=repo)
+        assert written == ['docs/d.txt', 'docs/deep/x.txt', 'src/lib/l.txt']
+        assert pygit.read_file(os.path.join('repo', 'src', 'lib', 'l.txt')) \
+                == b'l'
+        assert pygit.get_status(repo) == ([], [], [])
+        assert not os.path.exists('.git')
+        assert not os.path.exists('src')
+
+
+class TestParallelPack:
+    """测试并行遍历与打包 - 每个对象只读取一次，pack输出顺序确定"""
+
+    @pytest.fixture
+    def temp_repo(self):
+        """创建临时仓库并生成三次共享子目录的提交"""
+        temp_dir = tempfile.mkdtemp()
+        original_cwd = os.getcwd()
+        os.chdir(temp_dir)
+        pygit.init('repo')
+        os.chdir('repo')
+        os.makedirs(os.path.join('lib', 'sub'))
+        with open(os.path.join('lib', 'sub', 'shared.txt'), 'wb') as f:
+            f.write(b'shared')
+        commits = []
+        for i in range(3):
+            with open('file.txt', 'wb') as f:
+                f.write(b'version %d' % i)
+            pygit.add(['file.txt', 'lib/sub/shared.txt'])
+            commits.append(pygit.commit('commit %d' % i,
+                                        author='Test <test@example.com>'))
+        yield commits
+        os.chdir(original_cwd)
+        shutil.rmtree(temp_dir)
+
+    def test_walk_reads_each_object_once(self, temp_repo):
+        """测试分支1: 多个提交共享的子树只读取一次"""
+        with patch('pygit.read_tree', wraps=pygit.read_tree) as mock_read:
+            objects = pygit.find_commit_objects(temp_repo[-1])
+
+        read = [c[1]['sha1'] for c in mock_read.call_args_list]
+        assert len(read) == len(set(read)) == 5
+        assert len(objects) == 3 + 3 + 3 + 3
+
+    def test_pack_is_deterministic(self, temp_repo):
+        """测试分支2: 不同线程数生成的pack完全相同且对象顺序按SHA-1排序"""
+        objects = pygit.find_commit_objects(temp_repo[-1])
+
+        serial = pygit.create_pack(objects, max_workers=1)
+        parallel = pygit.create_pack(objects, max_workers=8)
+
+        assert serial == parallel
+        assert struct.unpack('!4sLL', serial[:12]) == (b'PACK', 2,
+                                                        len(objects))
+        assert serial[-20:] == hashlib.sha1(serial[:-20]).digest()
+        first = sorted(objects)[0]
+        assert serial[12:].startswith(pygit.encode_pack_object(first))
+
+
+class TestFsck:
+    """测试fsck - 重新计算SHA-1、检查头部与大小以及对象之间的连通性"""
+
+    @pytest.fixture
+    def temp_repo(self):
+        """创建临时仓库并提交两个文件"""
+        temp_dir = tempfile.mkdtemp()
+        original_cwd = os.getcwd()
+        os.chdir(temp_dir)
+        pygit.init('repo')
+        os.chdir('repo')
+        os.makedirs('sub')
+        with open('a.txt', 'wb') as f:
+            f.write(b'a' * 100000)
+        with open(os.path.join('sub', 'b.txt'), 'wb') as f:
+            f.write(b'b')
+        pygit.add(['a.txt', 'sub/b.txt'])
+        pygit.commit('first', author='Test <test@example.com>')
+        yield temp_dir
+        os.chdir(original_cwd)
+        shutil.rmtree(temp_dir)
+
+    def rewrite_object(self, sha1, full_data):
+        """用给定的未压缩内容替换松散对象文件"""
+        path = pygit.get_repository().object_store.path(sha1)
+        os.remove(path)
+        with open(path, 'wb') as f:
+            f.write(zlib.compress(full_data))
+
+    def test_clean_repo(self, temp_repo):
+        """测试分支1: 完好的仓库没有坏对象或缺失对象"""
+        assert pygit.fsck(max_workers=2) == (5, {}, {})
+
+    def test_corrupt_objects(self, temp_repo):
+        """测试分支2: 内容被改动和大小不符的对象被报告，且不影响其他对象"""
+        a_sha1 = pygit.hash_object(b'a' * 100000, 'blob', write=False)
+        b_sha1 = pygit.hash_object(b'b', 'blob', write=False)
+        self.rewrite_object(a_sha1, b'blob 100000\x00' + b'a' * 99999 + b'x')
+        self.rewrite_object(b_sha1, b'blob 5\x00b')
+
+        num_objects, bad, missing = pygit.fsck(max_workers=2)
+
+        assert num_objects == 5
+        assert sorted(bad) == sorted([a_sha1, b_sha1])
+        assert bad[a_sha1].startswith('hash mismatch')
+        assert bad[b_sha1] == 'expected size 5, got 1 bytes'
+        assert missing == {}
+
+    def test_missing_objects(self, temp_repo):
+        """测试分支3: 树引用的对象缺失时报告缺失对象及引用它的对象"""
+        b_sha1 = pygit.hash_object(b'b', 'blob', write=False)
+        os.remove(pygit.get_repository().object_store.path(b_sha1))
+        sub_tree = [sha1 for mode, path, sha1 in pygit.read_tree(
+                sha1=pygit.read_commit_tree(pygit.get_local_master_hash()))
+                if path == 'sub'][0]
+
+        num_objects, bad, missing = pygit.fsck(max_workers=1)
+
+        assert (num_objects, bad) == (4, {})
+        assert missing == {b_sha1: sub_tree}
+
+    def test_unreadable_header(self, temp_repo):
+        """测试分支4: 头部无法解析的对象类型报告为unknown"""
+        b_sha1 = pygit.hash_object(b'b', 'blob', write=False)
+        path = pygit.get_repository().object_store.path(b_sha1)
+        os.remove(path)
+        with open(path, 'wb') as f:
+            f.write(b'not zlib data')
+
+        obj_type, links, error = pygit.check_object(b_sha1)
+        assert (obj_type, links) == ('unknown', [])
+        assert error is not None
+        assert pygit.fsck(max_workers=1)[1] == {b_sha1: error}
+
+
+class TestStartup:
+    """测试CLI启动开销 - 用-X importtime检查各子命令不导入不需要的慢模块"""
+
+    # 导入耗时预算与机器负载有关，不在测试中检查，见benchmarks/startup.py
+    # 只有少数子命令需要的慢模块，不能在启动时导入
+    LAZY_MODULES = {'concurrent.futures', 'difflib', 'sqlite3', 'tarfile',
+                    'urllib.request'}
+
+    @pytest.fixture
+    def temp_repo(self):
+        """创建临时仓库并添加一个文件"""
+        temp_dir = tempfile.mkdtemp()
+        original_cwd = os.getcwd()
+        os.chdir(temp_dir)
+        pygit.init('repo')
+        os.chdir('repo')
+        with open('a.txt', 'wb') as f:
+            f.write(b'a\n')
+        pygit.add(['a.txt'])
+        yield temp_dir
+        os.chdir(original_cwd)
+        shutil.rmtree(temp_dir)
+
+    def test_subcommand_lazy_imports(self, temp_repo):
+        """测试分支1: 每个子命令只导入自己需要的慢模块"""
+        baseline = set(import_times(['-c', 'pass']))
+        sha1 = pygit.hash_object(b'a\n', 'blob', write=False)
+        commands = {
+            'hash-object': ['hash-object', 'a.txt'],
+            'ls-files': ['ls-files'],
+            'status': ['status'],
+            'add': ['add', 'a.txt'],
+            'cat-file': ['cat-file', 'blob', sha1],
+            'diff': ['diff'],
+        }
+        script = os.path.abspath(pygit.__file__)
+        for command, args in commands.items():
+            imported = set(import_times([script] + args)) - baseline
+            allowed = {'difflib'} if command == 'diff' else set()
+            assert not (imported & (self.LAZY_MODULES - allowed)), command
+
+    def test_import_skips_slow_modules(self, temp_repo):
+        """测试分支2: 作为模块导入pygit时不加载慢模块和argparse"""
+        path = os.path.dirname(os.path.abspath(pygit.__file__))
+        imported = set(import_times(
+                ['-c', 'import sys; sys.path.insert(0, {!r}); '
+                       'import pygit'.format(path)]))
+        assert 'pygit' in imported
+        assert not (imported & (self.LAZY_MODULES | {'argparse'}))
+
+
+class TestMergeBase:
+    """测试merge-base与rev-list --count - 双向按日期的优先队列遍历"""
+
+    @pytest.fixture
+    def temp_repo(self):
+        """创建临时仓库并切换到仓库目录"""
+        temp_dir = tempfile.mkdtemp()
+        original_cwd = os.getcwd()
+        os.chdir(temp_dir)
+        pygit.init('repo')
+        os.chdir('repo')
+        yield temp_dir
+        os.chdir(original_cwd)
+        shutil.rmtree(temp_dir)
+
+    def make_commit(self, parents, timestamp, message='msg'):
+        """直接写入给定父提交和提交时间的提交对象，返回提交哈希"""
+        tree = pygit.hash_object(b'', 'tree')
+        lines = ['tree ' + tree] + ['parent ' + p for p in parents]
+        lines.append('author Test <test@example.com> {} +0000'.format(
+                timestamp))
+        lines.append('committer Test <test@example.com> {} +0000'.format(
+                timestamp))
+        lines += ['', message, '']
+        return pygit.hash_object('\n'.join(lines).encode(), 'commit')
+
+    def test_fork(self, temp_repo):
+        """测试分支1: 分叉的两条分支，合并基础、领先/落后数量和祖先判断"""
+        root = self.make_commit([], 1000)
+        base = self.make_commit([root], 1100)
+        master = self.make_commit([self.make_commit([base], 1200)], 1300)
+        topic = self.make_commit([base], 1250)
+        pygit.write_ref('refs/heads/master', master)
+        pygit.write_ref('refs/heads/topic', topic)
+
+        assert pygit.merge_bases('master', 'topic') == [base]
+        assert pygit.ahead_behind('master', 'topic') == (2, 1)
+        assert pygit.count_commits('topic..master') == 2
+        assert pygit.count_commits('master..topic') == 1
+        assert pygit.count_commits('master...topic') == 3
+        assert pygit.count_commits('master') == 4
+        assert pygit.is_ancestor(root, 'master')
+        assert not pygit.is_ancestor('topic', 'master')
+
+    def test_walk_stops_at_common_ancestor(self, temp_repo):
+        """测试分支2: 只读取比共同祖先新的历史"""
+        parent = None
+        for i in range(50):
+            parent = self.make_commit([parent] if parent else [], 1000 + i)
+        one = self.make_commit([parent], 2000)
+        two = self.make_commit([parent], 2001)
+
+        with patch('pygit.read_commit_info',
+                   wraps=pygit.read_commit_info) as mock_read:
+            assert pygit.merge_bases(one, two) == [parent]
+        read = {c[0][0] for c in mock_read.call_args_list}
+        assert len(read) <= 4
+
+    def test_criss_cross_has_two_bases(self, temp_repo):
+        """测试分支3: 交叉合并时返回两个最佳共同祖先"""
+        root = self.make_commit([], 1000)
+        a = self.make_commit([root], 1100)
+        b = self.make_commit([root], 1200)
+        one = self.make_commit([a, b], 1300)
+        two = self.make_commit([b, a], 1400)
+
+        assert sorted(pygit.merge_bases(one, two)) == sorted([a, b])
+        assert pygit.merge_bases(one, root) == [root]
+        assert pygit.ahead_behind(one, two) == (1, 1)
+
+    def test_left_right_needs_symmetric_range(self, temp_repo):
+        """测试分支4: rev-list --left-right只接受A...B，其他范围报错"""
+        root = self.make_commit([], 1000)
+        one = self.make_commit([root], 1100)
+        two = self.make_commit([root], 1200)
+        script = os.path.abspath(pygit.__file__)
+
+        def rev_list(rev_range):
+            return subprocess.run(
+                    [sys.executable, script, 'rev-list', '--count',
+                     '--left-right', rev_range],
+                    stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+        result = rev_list('{}...{}'.format(one, two))
+        assert (result.returncode, result.stdout) == (0, b'1\t1\n')
+        for rev_range in ['{}..{}'.format(one, two), one]:
+            result = rev_list(rev_range)
+            assert result.returncode == 1 and result.stdout == b''
+            assert b'symmetric range' in result.stderr
+
+
+class TestMultiPackIndex:
+    """测试pack读取与multi-pack-index - 多个pack中的对象用一次二分查找定位"""
+
+    @pytest.fixture
+    def temp_repo(self):
+        """创建临时仓库并切换到仓库目录"""
+        temp_dir = tempfile.mkdtemp()
+        original_cwd = os.getcwd()
+        os.chdir(temp_dir)
+        pygit.init('repo')
+        os.chdir('repo')
+        os.makedirs(os.path.join('.git', 'objects', 'pack'))
+        yield temp_dir
+        os.chdir(original_cwd)
+        shutil.rmtree(temp_dir)
+
+    def write_pack(self, pack_data):
+        """把pack数据写入objects/pack并生成.idx，返回pack路径"""
+        path = os.path.join('.git', 'objects', 'pack', 'pack-{}.pack'.format(
+                hashlib.sha1(pack_data).hexdigest()))
+        with open(path, 'wb') as f:
+            f.write(pack_data)
+        pygit.index_pack(path)
+        return path
+
+    def pack_blobs(self, blobs):
+        """把若干blob写成一个pack并删除松散对象，返回SHA-1列表"""
+        store = pygit.get_repository().object_store
+        sha1s = [pygit.hash_object(data, 'blob') for data in blobs]
+        self.write_pack(pygit.create_pack(set(sha1s)))
+        for sha1 in sha1s:
+            os.remove(store.path(sha1))
+        return sha1s
+
+    def test_read_from_packs_and_midx(self, temp_repo):
+        """测试分支1: 从多个pack读取对象，写入multi-pack-index后只剩一个索引"""
+        sha1s = []
+        for i in range(3):
+            sha1s += self.pack_blobs([b'pack %d blob %d' % (i, j)
+                                      for j in range(5)])
+        repo = pygit.get_repository()
+        assert len(repo.pack_store.indexes()) == 3
+
+        assert pygit.write_multi_pack_index() == (3, 15)
+        assert len(repo.pack_store.indexes()) == 1
+        assert pygit.verify_multi_pack_index() == []
+        for i, sha1 in enumerate(sha1s):
+            assert pygit.find_object(sha1[:10]) == sha1
+            assert pygit.Repository('.').read_object(sha1) == (
+                    'blob', b'pack %d blob %d' % (i // 5, i % 5))
+        assert pygit.read_object_header(sha1s[0]) == ('blob', 13)
+        assert pygit.fsck(max_workers=1) == (15, {}, {})
+
+    def test_deltas(self, temp_repo):
+        """测试分支2: 解析OFS_DELTA和REF_DELTA条目"""
+        base = b'hello world'
+        target = b'hello there world'
+        base_sha1 = pygit.hash_object(base, 'blob', write=False)
+        target_sha1 = pygit.hash_object(target, 'blob', write=False)
+        # 复制base[0:6]，插入"there "，复制base[6:11]
+        delta = bytes([11, 17, 0x90, 6, 6]) + b'there ' + \
+                bytes([0x91, 6, 5])
+        # 类型和大小头部：base是blob(3)，两个delta分别是OFS_DELTA(6)和REF_DELTA(7)
+        base_entry = bytes([0x30 | len(base)]) + zlib.compress(base)
+        ofs_entry = bytes([0x60 | len(delta), len(base_entry)]) + \
+                zlib.compress(delta)
+        ref_entry = bytes([0x70 | len(delta)]) + bytes.fromhex(base_sha1) + \
+                zlib.compress(delta)
+        pack = struct.pack('!4sLL', b'PACK', 2, 3) + base_entry + \
+                ofs_entry + ref_entry
+        path = self.write_pack(pack + hashlib.sha1(pack).digest())
+
+        assert pygit.read_object(target_sha1) == ('blob', target)
+        assert pygit.get_repository().pack_store.list() == sorted(
+                [base_sha1, target_sha1])
+        with open(path, 'rb') as f:
+            offset = 12 + len(base_entry) + len(ofs_entry)
+            assert pygit.read_pack_object(f, offset, pygit.read_object) == \
+                    ('blob', target)
+        output = io.BytesIO()
+        assert pygit.write_object_data(target_sha1, output) == (
+                'blob', len(target))
+        assert output.getvalue() == target
+
+    def test_verify_detects_bad_offset(self, temp_repo):
+        """测试分支3: multi-pack-index中的偏移与pack的.idx不一致时报告错误"""
+        sha1s = self.pack_blobs([b'one', b'two'])
+        pygit.write_multi_pack_index()
+        path = os.path.join('.git', 'objects', 'pack', 'multi-pack-index')
+        data = bytearray(pygit.read_file(path)[:-20])
+        ooff = data.index(b'OOFF')
+        start, = struct.unpack_from('!Q', data, ooff + 4)
+        data[start + 7] ^= 1
+        with open(path, 'wb') as f:
+            f.write(bytes(data) + hashlib.sha1(data).digest())
+
+        errors = pygit.verify_multi_pack_index()
+        assert len(errors) == 1 and errors[0].endswith('has wrong offset')
+        assert min(sha1s) in errors[0]
+
+    def test_verify_detects_missing_object(self, temp_repo):
+        """测试分支4: pack的.idx中有而multi-pack-index中缺少的对象被报告"""
+        sha1s = self.pack_blobs([b'one', b'two', b'three'])
+        read_pack_index = pygit.read_pack_index
+
+        def drop_last(path):
+            index = read_pack_index(path)
+            table = index.sha1s
+            return index._replace(sha1s=pygit.SHA1Table(
+                    table.data, table.start, len(table) - 1))
+
+        with patch('pygit.read_pack_index', side_effect=drop_last):
+            assert pygit.write_multi_pack_index() == (1, 2)
+        with pytest.raises(ValueError, match='not found'):
+            pygit.Repository('.').find_object(max(sha1s))
+
+        errors = pygit.verify_multi_pack_index()
+        assert len(errors) == 1
+        assert errors[0].startswith('object {}'.format(max(sha1s)))
+        assert errors[0].endswith('not in multi-pack-index')
+
+    def test_stream_packed_object(self, temp_repo):
+        """测试分支5: 非delta的pack对象直接从pack文件流式解压，不在内存中整体解析"""
+        data = b''.join(b'line %d\n' % i for i in range(50000))
+        sha1, = self.pack_blobs([data])
+        output = io.BytesIO()
+
+        with patch('pygit.read_pack_object') as mock_read:
+            assert pygit.write_object_data(sha1, output, chunk_size=4096) == \
+                    ('blob', len(data))
+            assert pygit.read_object_header(sha1) == ('blob', len(data))
+            assert pygit.check_object(sha1, chunk_size=4096) == (
+                    'blob', [], None)
+            with pygit.ObjectReader(sha1) as reader:
+                assert reader.read(10) == b'line 0\nlin'
+        assert mock_read.call_count == 0
+        assert output.getvalue() == data
+
+    def test_pack_file_opened_once(self, temp_repo):
+        """测试分支6: 读取多个pack对象只打开一次.pack文件，文件替换后重新打开"""
+        sha1s = self.pack_blobs([b'blob %d' % i for i in range(20)])
+        path, = [os.path.join('.git', 'objects', 'pack', name)
+                 for name in os.listdir(os.path.join('.git', 'objects', 'pack'))
+                 if name.endswith('.pack')]
+        pack_data = pygit.read_file(path)
+        repo = pygit.Repository('.')
+        input_file = io.BytesIO(''.join(s + '\n' for s in sha1s).encode())
+
+        with patch('pygit.open', wraps=open, create=True) as mock_open:
+            for i, sha1 in enumerate(sha1s):
+                assert repo.read_object(sha1) == ('blob', b'blob %d' % i)
+            pygit.cat_file_batch(input_file=input_file,
+                                 output_file=io.BytesIO(), repo=repo)
+            assert pygit.read_object_header(sha1s[0], repo) == ('blob', 6)
+            pack_opens = [c for c in mock_open.call_args_list
+                          if c.args[0].endswith('.pack')]
+            assert len(pack_opens) == 1
+
+            pygit.write_file(path + '.tmp', pack_data)
+            os.replace(path + '.tmp', path)
+            repo._objects.clear()
+            assert repo.read_object(sha1s[1]) == ('blob', b'blob 1')
+            pack_opens = [c for c in mock_open.call_args_list
+                          if c.args[0].endswith('.pack')]
+            assert len(pack_opens) == 2
+
+    def test_pack_files_closed_with_repository(self, temp_repo):
+        """测试分支7: 关闭或从缓存中淘汰仓库句柄时关闭其.pack文件"""
+        sha1, = self.pack_blobs([b'blob'])
+        repo = pygit.Repository('.')
+        repo.read_object(sha1)
+        (_, f, _), = repo.pack_store._files.values()
+        repo.close()
+        assert f.closed
+        assert repo.read_object(sha1) == ('blob', b'blob')
+
+        with patch('pygit.REPOSITORY_CACHE_SIZE', 1), \
+                patch('pygit._repositories', collections.OrderedDict()):
+            repo = pygit.get_repository('.')
+            repo._objects.clear()
+            repo.read_object(sha1)
+            (_, f, _), = repo.pack_store._files.values()
+            pygit.get_repository('..')
+            assert f.closed
+
+
+class TestAlternates:
+    """测试alternates共享对象库与clone --shared - 查找和读取对象时回退到其他对象目录"""
+
+    @pytest.fixture
+    def temp_repo(self):
+        """在临时目录中创建含一次提交的源仓库source，停留在临时目录"""
+        temp_dir = tempfile.mkdtemp()
+        original_cwd = os.getcwd()
+        os.chdir(temp_dir)
+        pygit.init('source')
+        os.chdir('source')
+        os.makedirs('sub')
+        for path, data in [('a.txt', b'a'), ('sub/b.txt', b'b')]:
+            with open(path, 'wb') as f:
+                f.write(data)
+        pygit.add(['a.txt', 'sub/b.txt'])
+        commit_sha1 = pygit.commit('first', author='Test <test@example.com>')
+        os.chdir(temp_dir)
+        yield commit_sha1
+        os.chdir(original_cwd)
+        shutil.rmtree(temp_dir)
+
+    def loose_objects(self, repo):
+        """返回仓库中松散对象的SHA-1列表"""
+        return list(pygit.get_repository(repo).object_store.list())
+
+    def test_shared_clone(self, temp_repo):
+        """测试分支1: clone --shared不复制对象，读取回退到源仓库，新提交只写入新对象"""
+        assert pygit.clone('source', 'clone', shared=True) == temp_repo
+
+        assert self.loose_objects('clone') == []
+        alternates = pygit.read_file(os.path.join(
+                'clone', '.git', 'objects', 'info', 'alternates'))
+        assert alternates.decode().strip() == os.path.abspath(
+                os.path.join('source', '.git', 'objects'))
+        os.chdir('clone')
+        assert pygit.get_local_master_hash() == temp_repo
+        assert pygit.read_file(os.path.join('sub', 'b.txt')) == b'b'
+        assert pygit.get_status() == ([], [], [])
+        assert pygit.find_object(temp_repo[:7]) == temp_repo
+
+        with open('c.txt', 'wb') as f:
+            f.write(b'c')
+        pygit.add(['c.txt'])
+        pygit.commit('second', author='Test <test@example.com>')
+        assert len(self.loose_objects('.')) == 3
+        assert pygit.fsck(max_workers=1)[1:] == ({}, {})
+
+    def test_alternates_file_format(self, temp_repo):
+        """测试分支2: 相对路径和注释行，链式alternates，不存在的对象仍报错"""
+        pygit.init('middle')
+        pygit.init('leaf')
+        info_dir = os.path.join('middle', '.git', 'objects', 'info')
+        os.makedirs(info_dir)
+        with open(os.path.join(info_dir, 'alternates'), 'w') as f:
+            f.write('# comment\n\n../../../source/.git/objects\n')
+        info_dir = os.path.join('leaf', '.git', 'objects', 'info')
+        os.makedirs(info_dir)
+        with open(os.path.join(info_dir, 'alternates'), 'w') as f:
+            f.write(os.path.abspath(os.path.join('middle', '.git',
+                                                 'objects')) + '\n')
+
+        leaf = pygit.Repository('leaf')
+        assert len(leaf.read_alternates()) == 2
+        assert leaf.read_object(temp_repo)[0] == 'commit'
+        with pytest.raises(ValueError, match='not found'):
+            leaf.find_object('0' * 40)
+
+    def test_copying_clone(self, temp_repo):
+        """测试分支3: 不加--shared时复制对象，删除源仓库后仍可读取"""
+        with patch('os.chdir', side_effect=AssertionError):
+            pygit.clone('source', 'clone')
+        assert pygit.read_file(os.path.join('clone', 'sub', 'b.txt')) == b'b'
+        shutil.rmtree('source')
+
+        assert not os.path.exists(os.path.join(
+                'clone', '.git', 'objects', 'info', 'alternates'))
+        repo = pygit.Repository('clone')
+        assert repo.read_object(temp_repo)[0] == 'commit'
+        assert len(self.loose_objects('clone')) == 5
+
+    def test_copying_clone_keeps_relative_alternates(self, temp_repo):
+        """测试分支4: 源仓库的相对路径alternates在副本中改写为绝对路径"""
+        pygit.init('base')
+        blob = pygit.get_repository('base').hash_object(b'base', 'blob')
+        info_dir = os.path.join('source', '.git', 'objects', 'info')
+        os.makedirs(info_dir, exist_ok=True)
+        with open(os.path.join(info_dir, 'alternates'), 'w') as f:
+            f.write('# comment\n../../../base/.git/objects\n')
+
+        os.mkdir('clones')
+        pygit.clone('source', os.path.join('clones', 'clone'))
+        alternates = pygit.read_file(os.path.join(
+                'clones', 'clone', '.git', 'objects', 'info', 'alternates'))
+        assert alternates.decode() == '# comment\n{}\n'.format(
+                os.path.abspath(os.path.join('base', '.git', 'objects')))
+        repo = pygit.Repository(os.path.join('clones', 'clone'))
+        assert repo.read_object(blob) == ('blob', b'base')
+
+
+class TestCompactIndex:
+    """测试CompactIndex - 定长记录+路径块存储的索引，二分查找路径"""
+
+    @pytest.fixture
+    def temp_repo(self):
+        """创建临时仓库并切换到仓库目录"""
+        temp_dir = tempfile.mkdtemp()
+        original_cwd = os.getcwd()
+        os.chdir(temp_dir)
+        pygit.init('repo')
+        os.chdir('repo')
+        yield temp_dir
+        os.chdir(original_cwd)
+        shutil.rmtree(temp_dir)
+
+    def make_entries(self, count):
+        """返回按路径排序的count个IndexEntry，含非ASCII路径和skip-worktree标志"""
+        entries = []
+        for i in range(count):
+            path = 'dir{}/文件{}.txt'.format(i % 7, i)
+            flags = len(path.encode())
+            if i % 5 == 0:
+                flags |= pygit.INDEX_SKIP_WORKTREE
+            entries.append(pygit.IndexEntry(
+                    i, i + 1, 2 * i, 0xffffffff, 3, i * 11, 0o100644, 1000,
+                    1000, i, hashlib.sha1(path.encode()).digest(), flags,
+                    path))
+        entries.sort(key=lambda e: e.path)
+        return entries
+
+    def test_same_entries_as_list(self, temp_repo):
+        """测试分支1: 迭代、下标、切片与IndexEntry列表一致，读写往返不变"""
+        entries = self.make_entries(50)
+        compact = pygit.CompactIndex(entries)
+
+        assert len(compact) == 50
+        assert list(compact) == entries
+        assert compact == entries
+        assert compact[0] == entries[0] and compact[-1] == entries[-1]
+        assert compact[10:13] == entries[10:13]
+        with pytest.raises(IndexError):
+            compact[50]
+
+        pygit.write_index(entries)
+        repo = pygit.Repository('.')
+        assert repo.read_compact_index() == compact
+        assert repo.read_index() == entries
+        assert pygit.CompactIndex() == []
+        # 记录和路径字节相同、只有路径分界不同的两个索引不相等
+        entry = entries[0]._replace(flags=0)
+        split1 = [entry._replace(path='ab'), entry._replace(path='c')]
+        split2 = [entry._replace(path='a'), entry._replace(path='bc')]
+        assert pygit.CompactIndex(split1) != pygit.CompactIndex(split2)
+
+    def test_find_by_binary_search(self, temp_repo):
+        """测试分支2: 按路径二分查找，不存在返回None，未排序时线性查找"""
+        entries = self.make_entries(50)
+        compact = pygit.CompactIndex(entries)
+
+        for i, entry in enumerate(entries):
+            assert compact.find(entry.path) == i
+            assert compact.get(entry.path) == entry
+        assert compact.find('dir0') is None
+        assert compact.find('zzz') is None
+        assert compact.get('') is None
+
+        unsorted = pygit.CompactIndex(entries[::-1])
+        assert not unsorted.sorted
+        assert unsorted.find(entries[0].path) == 49
+
+    def test_memory_per_entry(self, temp_repo):
+        """测试分支3: 每个条目占用几十字节（定长记录+路径）"""
+        entries = self.make_entries(1000)
+        compact = pygit.CompactIndex(entries)
+        path_bytes = sum(len(e.path.encode()) for e in entries)
+
+        size = (sys.getsizeof(compact.records) + sys.getsizeof(compact.paths)
+                + sys.getsizeof(compact.offsets))
+        assert (size - path_bytes) / len(entries) < 80
+
+
 if __name__ == '__main__':
     # 可以直接运行此文件进行测试
-    pytest.main([__file__, '-v'])
\ No newline at end of file
+    pytest.main([__file__, '-v'])